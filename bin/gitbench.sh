@@ -9,11 +9,12 @@ ROOT=`dirname $0`/../
 SCRATCH=$ROOT/scratch/
 
 
-python pyrtree/bench/bench_rtree.py > scratch/working.log
+mkdir -p $SCRATCH
+python -m pyrtree.bench run -o $SCRATCH/working.json "$@"
 
 git stash save
-python pyrtree/bench/bench_rtree.py > scratch/committed.log
+python -m pyrtree.bench run -o $SCRATCH/committed.json "$@"
 git stash pop
 
-
-python pyrtree/bench/bview.py scratch/committed.log scratch/working.log
\ No newline at end of file
+# Exits non-zero if the working copy regressed:
+python -m pyrtree.bench compare $SCRATCH/committed.json $SCRATCH/working.json
\ No newline at end of file
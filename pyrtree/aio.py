@@ -0,0 +1,127 @@
+## Stepped queries, for event loops: aquery_rect, aquery_point, anearest.
+#
+# A big query_rect runs start to finish in one go, and on an event loop
+#  that stalls every other coroutine until it's done.  These run the same
+#  queries in steps of at most 'nodes' internal nodes expanded: each is an
+#  iterator whose next() runs one step and returns its results, a list
+#  (often empty).  The caller hands control back to the loop between
+#  steps, or runs each step in an executor:
+#
+#   for found in tree.aquery_rect(r):
+#       handle(found)
+#       await asyncio.sleep(0)
+#
+#   steps = tree.aquery_rect(r)
+#   while True:
+#       found = await loop.run_in_executor(ex, next, steps, None)
+#       if found is None: break
+#       handle(found)
+#
+# (The package is Python 2, with no asyncio, so it hands out plain
+#  iterators rather than async ones.)
+#
+# They query a snapshot, so writes made between steps don't disturb them,
+#  and steps may run in other threads.  A query on an RTree takes a fresh
+#  one, so it sees every write made before it started; but then the next
+#  write copies the pools (see RTree.snapshot).  Given 'max_age', it takes
+#  the tree's last snapshot instead if that's at most max_age seconds old,
+#  so that queries started close together share one view, and writes in
+#  between don't copy the pools for each of them.  A query on a Snapshot
+#  queries that.  They don't use the tree's cache or
+#  report to its metrics sink, but do refine against its geometry store.
+
+import heapq
+
+from rtree import RTree, _box, _exact_box, _refine
+import geometry
+
+NODES_PER_STEP=64 # default step size, in internal nodes expanded.
+
+def _rect_steps(tree, x, y, xx, yy, closed, nodes):
+    """ rtree._iter_hits in steps: yields a list of leaf_pool indices (maybe
+    empty) after every 'nodes' internal nodes expanded. """
+    rp = tree.rect_pool
+    npool = tree.node_pool
+    ex = tree.exact_rects
+    stack = [0]
+    hits = []
+    n = 0
+    while stack:
+        c = npool[stack.pop()*2 + 1]
+        while c != 0:
+            ri = c*4
+            bx = rp[ri]
+            bxx = rp[ri+2]
+            leaf = bx > bxx
+            if leaf: bx,bxx = bxx,bx
+            w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+            by = rp[ri+1]
+            byy = rp[ri+3]
+            h = (byy if byy < yy else yy) - (by if by > y else y)
+            if (w >= 0 and h >= 0) if closed else (w > 0 and h > 0):
+                if leaf: hits.append(c)
+                else: stack.append(c)
+            c = npool[c*2]
+        n += 1
+        if n >= nodes or not stack:
+            if ex: hits = _refine(tree, hits, x, y, xx, yy, closed)
+            if tree.geometry is not None:
+                hits = geometry._refine_hits(tree, hits, x, y, xx, yy)
+            yield [ npool[c*2 + 1] for c in hits ]
+            hits = []
+            n = 0
+
+def _nearest_steps(tree, px, py, k, nodes):
+    """ RTree.nearest in steps, as _rect_steps: leaf_pool indices, nearest
+    first. """
+    rp = tree.rect_pool
+    npool = tree.node_pool
+    ex = tree.exact_rects
+    heap = [(0.0, 0, False)] # (distance, node, is leaf)
+    found = []
+    left = k
+    n = 0
+    while heap and (left is None or left > 0):
+        d,idx,leaf = heapq.heappop(heap)
+        if leaf:
+            found.append(npool[idx*2 + 1])
+            if left is not None: left -= 1
+            continue
+        c = npool[idx*2 + 1]
+        while c != 0:
+            leaf = rp[c*4] > rp[c*4 + 2]
+            x,y,xx,yy = _exact_box(tree, c) if leaf and ex else _box(rp, c)
+            dx = x - px if px < x else (px - xx if px > xx else 0.0)
+            dy = y - py if py < y else (py - yy if py > yy else 0.0)
+            heapq.heappush(heap, (dx*dx + dy*dy, c, leaf))
+            c = npool[c*2]
+        n += 1
+        if n >= nodes:
+            yield found
+            found = []
+            n = 0
+    yield found
+
+def _view(tree, max_age):
+    if isinstance(tree, RTree): return tree.snapshot(max_age)
+    return tree
+
+def _results(view, steps, ids):
+    """ The steps' leaf_pool indices, or their leaf objects. """
+    lp = view.leaf_pool
+    for found in steps:
+        yield found if ids else [ lp[li] for li in found ]
+
+def query_rect(tree, r, ids=False, nodes=NODES_PER_STEP, max_age=None):
+    view = _view(tree, max_age)
+    return _results(view, _rect_steps(view, r.x, r.y, r.xx, r.yy, False, nodes), ids)
+
+def query_point(tree, p, ids=False, nodes=NODES_PER_STEP, max_age=None):
+    x,y = p
+    view = _view(tree, max_age)
+    return _results(view, _rect_steps(view, x, y, x, y, True, nodes), ids)
+
+def nearest(tree, p, k=1, ids=False, nodes=NODES_PER_STEP, max_age=None):
+    px,py = p
+    view = _view(tree, max_age)
+    return _results(view, _nearest_steps(view, px, py, k, nodes), ids)
@@ -0,0 +1,5 @@
+# python -m pyrtree.bench: see runner.py.
+import sys
+from pyrtree.bench.runner import main
+
+sys.exit(main())
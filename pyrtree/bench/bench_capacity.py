@@ -0,0 +1,60 @@
+# Node capacity sweep: for each max_children, build the same workload and
+#  report build time, pool memory per entry and query latency, to pick a
+#  fan-out for a dataset.  Prints
+#   max_children,build_t,bytes_per_entry,rect_query_t,point_query_t
+#
+# BUILD=insert (default) or BUILD=bulk chooses how the trees are built;
+#  CAPACITIES is a comma-separated list of fan-outs to try.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=20000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=1000
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+BUILD=os.getenv("BUILD", "insert")
+CAPACITIES=[ int(c) for c in os.getenv("CAPACITIES", "4,6,8,10,16,24,32,64").split(",") ]
+
+def pool_bytes(rt):
+    # Only the slots in use: the arrays themselves over-allocate.
+    return rt.node_count * (4 * rt.rect_pool.itemsize + 2 * rt.node_pool.itemsize)
+
+def build(m, data):
+    kw = dict(max_children=m, min_children=max(1, m * 2 // 5))
+    if BUILD == "bulk":
+        return RTree.bulk_load([ (v,r) for (v,r) in enumerate(data) ], **kw)
+    rt = RTree(**kw)
+    for (v,r) in enumerate(data): rt.insert(v,r)
+    return rt
+
+def per_query(f, qs):
+    t = time.time()
+    for q in qs:
+        for x in f(q): pass
+    return (time.time() - t) / len(qs)
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    data = [ G.rect(0.01) for i in range(SIZE) ]
+    rects = [ G.rect(0.2) for i in range(QUERIES) ]
+    points = [ G.pointInside(r) for r in rects ]
+
+    for m in CAPACITIES:
+        t = time.time()
+        rt = build(m, data)
+        dt = time.time() - t
+        print("%d,%f,%f,%f,%f" % (m, dt, pool_bytes(rt) / float(SIZE),
+                                  per_query(rt.search_rect, rects),
+                                  per_query(rt.search_point, points)))
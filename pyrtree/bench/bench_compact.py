@@ -0,0 +1,53 @@
+# Pool compaction: a tree built by inserts, with churn (a third of it
+#  deleted and inserted again), queried before and after RTree.compact().
+#  Prints
+#   when,node_count,free_nodes,pool_bytes,query_t
+#  and the time compact() took.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=100000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=5000
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+
+def pool_bytes(rt):
+    # What the arrays hold, spare room included.
+    return (len(rt.rect_pool) * rt.rect_pool.itemsize +
+            len(rt.node_pool) * rt.node_pool.itemsize +
+            len(rt.count_pool) * rt.count_pool.itemsize)
+
+def report(when, rt, qs):
+    t = time.time()
+    for q in qs:
+        for h in rt.search_rect(q, ids=True): pass
+    print("%s,%d,%d,%d,%f" % (when, rt.node_count, len(rt.free_nodes),
+                              pool_bytes(rt), time.time() - t))
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    data = [ (v, G.rect(0.01)) for v in range(SIZE) ]
+    qs = [ G.rect(0.2) for i in range(QUERIES) ]
+    rt = RTree(split="quadratic")
+    for (v,r) in data: rt.insert(v,r)
+    churn = random.sample(data, SIZE // 3)
+    for (v,r) in churn: rt.delete(v,r)
+    for (v,r) in churn: rt.insert(v,r)
+
+    report("before", rt, qs)
+    t = time.time()
+    rt.compact()
+    print("compact_t,%f" % (time.time() - t))
+    report("after", rt, qs)
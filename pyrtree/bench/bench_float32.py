@@ -0,0 +1,67 @@
+# Coordinate storage: doubles against float32 (RTree coord_type='f'), with
+#  long and 32-bit node indices (index_type), and with and without exact
+#  rects kept on the side ('exact').  Prints
+#   data,coord_type,index_type,exact,pool_bytes,exact_bytes,build_t,query_t,hits
+#
+# pool_bytes is the rect/node/count pools; exact_bytes is the exact rects
+#  float32 mode keeps on the side for entries it had to round.  Two data
+#  sets: "grid", with coordinates float32 holds exactly (nothing kept on
+#  the side), and "double", with full-precision ones (nearly everything).
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rect import Rect
+from pyrtree.rtree import RTree
+
+import os, random, sys, time
+
+SIZE=200000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=5000
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+
+def rects(n, grid):
+    out = []
+    for i in range(n):
+        x, y = random.random() * 1000, random.random() * 1000
+        w, h = random.random() * 5 + 0.1, random.random() * 5 + 0.1
+        if grid: # multiples of 1/64: exact in float32.
+            x, y, w, h = [ round(v * 64) / 64.0 for v in (x, y, w, h) ]
+        out.append(Rect(x, y, x + w, y + h))
+    return out
+
+def pool_bytes(rt):
+    n = rt.node_count
+    return n * (4 * rt.rect_pool.itemsize + 2 * rt.node_pool.itemsize +
+                rt.count_pool.itemsize)
+
+def exact_bytes(rt):
+    ex = rt.exact_rects
+    if not ex: return 0
+    # dict slot, plus the tuple and its four floats:
+    e = sys.getsizeof(ex.itervalues().next()) + 4 * sys.getsizeof(0.0)
+    return sys.getsizeof(ex) + len(ex) * e
+
+if __name__ == "__main__":
+    for data in ("grid", "double"):
+        random.seed(0)
+        items = list(enumerate(rects(SIZE, data == "grid")))
+        qs = rects(QUERIES, False)
+        for (ct, it, exact) in (('d', 'L', True), ('f', 'L', True),
+                                ('f', 'I', True), ('f', 'I', False)):
+            t = time.time()
+            rt = RTree.bulk_load(items, coord_type=ct, index_type=it, exact=exact)
+            build = time.time() - t
+            t = time.time()
+            hits = 0
+            for q in qs:
+                for h in rt.search_rect(q, ids=True): hits += 1
+            query = time.time() - t
+            print("%s,%s,%s,%d,%d,%d,%f,%f,%d" % (data, ct, it, exact, pool_bytes(rt),
+                                                  exact_bytes(rt), build, query, hits))
@@ -0,0 +1,80 @@
+# Filter and refine: window queries over polygons (VERTS-gons inscribed in
+#  their rects), refined one candidate at a time in Python, as a caller
+#  would without a geometry store, against the tree's batched refinement
+#  (RTree(geometry=...)).  Prints
+#   how,query_t,candidates,hits
+#
+# TEST_FSIZE and TEST_QSIZE size the features and the query windows: big
+#  features in small windows make most candidates straddle the window's
+#  edge, where refining is all edge tests; small features in big windows
+#  are mostly settled by their bboxes.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.geometry import GeometryStore
+from pyrtree.rtree import RTree
+from pyrtree.tests.test_rtree import RectangleGen
+
+import math, os, random, time
+
+SIZE=50000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=500
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+VERTS=int(os.getenv("TEST_VERTS", "32"))
+QSIZE=float(os.getenv("TEST_QSIZE", "0.5")) # query window size.
+FSIZE=float(os.getenv("TEST_FSIZE", "0.05")) # feature size.
+
+def polygon(r):
+    cx, cy = (r.x + r.xx) / 2, (r.y + r.yy) / 2
+    rx, ry = (r.xx - r.x) / 2, (r.yy - r.y) / 2
+    return [ (cx + rx * math.cos(a), cy + ry * math.sin(a))
+             for a in [ 2 * math.pi * i / VERTS for i in range(VERTS) ] ]
+
+def meets(pts, q):
+    """ The per-candidate test: an edge meets q, or q's corner is inside. """
+    inside = False
+    for i in range(len(pts)):
+        (x1,y1),(x2,y2) = pts[i - 1],pts[i]
+        if (y1 > q.y) != (y2 > q.y) and q.x < (x2 - x1) * (q.y - y1) / (y2 - y1) + x1:
+            inside = not inside
+        t0, t1 = 0.0, 1.0
+        for (p,d) in ((x1 - x2, x1 - q.x), (x2 - x1, q.xx - x1),
+                      (y1 - y2, y1 - q.y), (y2 - y1, q.yy - y1)):
+            if p == 0:
+                if d < 0: t0 = 2.0
+            elif p < 0: t0 = max(t0, d / p)
+            else: t1 = min(t1, d / p)
+        if t0 <= t1: return True
+    return inside
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    data = [ (v, G.rect(FSIZE)) for v in range(SIZE) ]
+    qs = [ G.rect(QSIZE) for i in range(QUERIES) ]
+    shapes = dict([ (v, polygon(r)) for (v,r) in data ])
+    gs = GeometryStore()
+    for (v,pts) in shapes.items(): gs.add_polygon(v, [pts])
+    rt = RTree.bulk_load(data)
+
+    t = time.time()
+    cands = hits = 0
+    for q in qs:
+        for v in rt.search_rect(q):
+            cands += 1
+            if meets(shapes[v], q): hits += 1
+    print("python,%f,%d,%d" % (time.time() - t, cands, hits))
+
+    rt.geometry = gs
+    t = time.time()
+    hits = 0
+    for q in qs:
+        for v in rt.search_rect(q): hits += 1
+    print("batched,%f,%d,%d" % (time.time() - t, cands, hits))
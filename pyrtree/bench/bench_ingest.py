@@ -0,0 +1,36 @@
+# Batched ingest: a loop of insert() against insert_many() in batches of
+#  BATCH entries, for each split policy.  Prints
+#   policy,insert_t,insert_many_t,speedup
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=20000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+BATCH=int(os.getenv("BATCH", "1000"))
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    data = [ (v, G.rect(0.01)) for v in range(SIZE) ]
+
+    for split in ("cluster", "linear", "quadratic", "rstar"):
+        rt = RTree(split=split)
+        t = time.time()
+        for (v,r) in data: rt.insert(v,r)
+        one = time.time() - t
+
+        rt = RTree(split=split)
+        t = time.time()
+        for i in range(0, SIZE, BATCH): rt.insert_many(data[i:i+BATCH])
+        many = time.time() - t
+        print("%s,%f,%f,%.2f" % (split, one, many, one / many))
@@ -0,0 +1,65 @@
+# Streaming ingestion (pyrtree.ingest): writes SIZE random boxes to a CSV, a
+#  line-delimited GeoJSON and a WKB file, then loads each into a new tree,
+#  both ways.  Prints
+#   format,how,records,wall_s,records_per_s,peak_rss_kb
+#
+# peak_rss_kb is the process's high-water mark, so it only grows down the
+#  list: run one format/way at a time (TEST_FORMAT, TEST_HOW) to see each
+#  one's own.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree import ingest
+from pyrtree.rtree import RTree
+
+import json, os, random, shutil, struct, tempfile
+
+SIZE=200000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+FORMATS=os.getenv("TEST_FORMAT", "csv,geojson,wkb").split(",")
+HOWS=os.getenv("TEST_HOW", "build,load").split(",")
+
+def boxes(n):
+    for i in range(n):
+        x, y = random.random() * 1000, random.random() * 1000
+        yield x, y, x + random.random() * 5 + 0.1, y + random.random() * 5 + 0.1
+
+def write(d):
+    paths = {}
+    paths["csv"] = p = os.path.join(d, "boxes.csv")
+    with open(p, "wb") as f:
+        f.write("minx,miny,maxx,maxy\n")
+        for b in boxes(SIZE): f.write("%r,%r,%r,%r\n" % b)
+    paths["geojson"] = p = os.path.join(d, "boxes.geojson")
+    with open(p, "wb") as f:
+        for (x,y,xx,yy) in boxes(SIZE):
+            f.write(json.dumps({ "type" : "Feature", "geometry" : {
+                "type" : "Polygon",
+                "coordinates" : [[[x,y],[xx,y],[xx,yy],[x,yy],[x,y]]] } }) + "\n")
+    paths["wkb"] = p = os.path.join(d, "boxes.wkb")
+    with open(p, "wb") as f:
+        for (x,y,xx,yy) in boxes(SIZE):
+            f.write(struct.pack("<BIII10d", 1, 3, 1, 5, x,y, xx,y, xx,yy, x,yy, x,y))
+    return paths
+
+READERS = { "csv" : ingest.CSVReader, "geojson" : ingest.GeoJSONReader, "wkb" : ingest.WKBReader }
+
+if __name__ == "__main__":
+    random.seed(0)
+    d = tempfile.mkdtemp()
+    try:
+        paths = write(d)
+        for fmt in FORMATS:
+            for how in HOWS:
+                r = READERS[fmt](paths[fmt])
+                if how == "build": stats = ingest.build(r)[1]
+                else: stats = ingest.load(RTree(split="quadratic"), r)
+                print("%s,%s,%d,%f,%f,%s" % (fmt, how, stats["records"], stats["wall_s"],
+                                             stats["records_per_s"], stats["peak_rss_kb"]))
+    finally:
+        shutil.rmtree(d)
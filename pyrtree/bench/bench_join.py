@@ -0,0 +1,41 @@
+# Spatial join: one query_rect per entry of the smaller tree vs. the
+#  synchronized traversal in RTree.join.  Prints name,seconds,pairs.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=50000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+SMALL=SIZE // 5
+if "TEST_SMALL" in os.environ:
+    SMALL=int(os.getenv("TEST_SMALL"))
+
+def timed(name, f):
+    t = time.time()
+    n = 0
+    for pair in f(): n += 1
+    print("%s,%f,%d" % (name, time.time() - t, n))
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    big = [ (v, G.rect(0.01)) for v in range(SIZE) ]
+    small = [ (v, G.rect(0.05)) for v in range(SMALL) ]
+    a = RTree.bulk_load(small)
+    b = RTree.bulk_load(big)
+
+    def per_query():
+        for (v,r) in small:
+            for o in b.search_rect(r): yield v,o
+    timed("query_per_entry", per_query)
+    timed("join", lambda: a.join(b))
+    timed("join_ids", lambda: a.join(b, ids=True))
@@ -0,0 +1,51 @@
+# Query throughput over worker processes (parallel.ParallelQueryExecutor)
+#  against running the same queries serially.  Prints
+#   name,processes,seconds,hits
+#
+# PROCESSES is a comma-separated list of pool sizes to try.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.parallel import ParallelQueryExecutor
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time, multiprocessing
+
+SIZE=100000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=20000
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+PROCESSES=[ int(p) for p in os.getenv("PROCESSES", "1,2,4,%d" % multiprocessing.cpu_count()).split(",") ]
+
+def hits(results):
+    return sum([ len(r) for r in results ])
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    rt = RTree.bulk_load([ (v, G.rect(0.01)) for v in range(SIZE) ])
+    rects = [ G.rect(0.2) for i in range(QUERIES) ]
+    points = [ G.pointInside(r) for r in rects ]
+
+    t = time.time()
+    res = [ list(rt.search_rect(q, ids=True)) for q in rects ]
+    print("rect,serial,%f,%d" % (time.time() - t, hits(res)))
+    t = time.time()
+    res = [ list(rt.search_point(p, ids=True)) for p in points ]
+    print("point,serial,%f,%d" % (time.time() - t, hits(res)))
+
+    for n in PROCESSES:
+        with ParallelQueryExecutor(rt, processes=n, chunksize=256) as ex:
+            t = time.time()
+            res = ex.query_rects(rects, ids=True)
+            print("rect,%d,%f,%d" % (n, time.time() - t, hits(res)))
+            t = time.time()
+            res = ex.query_points(points, ids=True)
+            print("point,%d,%f,%d" % (n, time.time() - t, hits(res)))
@@ -0,0 +1,52 @@
+# Query throughput: the old cursor walk vs. the raw-pool query engine.
+#  Prints name,seconds,hits for each way of running the same queries.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.rect import Rect
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=100000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=2000
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+
+def timed(name, f, qs):
+    t = time.time()
+    hits = 0
+    for q in qs: hits += f(q)
+    print("%s,%f,%d" % (name, time.time() - t, hits))
+
+def count(it):
+    n = 0
+    for x in it: n += 1
+    return n
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    rt = RTree.bulk_load([ (v, G.rect(0.01)) for v in range(SIZE) ])
+    rects = [ G.rect(0.2) for i in range(QUERIES) ]
+    points = [ G.pointInside(r) for r in rects ]
+
+    nop = lambda o: None
+    timed("rect_cursor_walk", lambda q: count([ c for c in rt.cursor.query_rect(q) if c.is_leaf() ]), rects)
+    timed("rect_query", lambda q: count(rt.query_rect(q)), rects)
+    timed("rect_search", lambda q: count(rt.search_rect(q)), rects)
+    timed("rect_search_ids", lambda q: count(rt.search_rect(q, ids=True)), rects)
+    timed("rect_visit", lambda q: rt.visit_rect(q, nop), rects)
+    timed("rect_count", rt.count, rects)
+
+    timed("point_cursor_walk", lambda p: count([ c for c in rt.cursor.query_point(p) if c.is_leaf() ]), points)
+    timed("point_query", lambda p: count(rt.query_point(p)), points)
+    timed("point_search", lambda p: count(rt.search_point(p)), points)
+    timed("point_visit", lambda p: rt.visit_point(p, nop), points)
@@ -8,7 +8,7 @@ if __name__ == "__main__":
 from pyrtree.rtree import RTree
 from pyrtree.tests.test_rtree import RectangleGen,TstO
 
-import time
+from timeit import default_timer as clock
 
 # TODO: make these command-line params.
 import os
@@ -19,32 +19,45 @@ if "TEST_ITER" in os.environ:
 INTERVAL=1000 # log at every 1k
 if "TEST_INTERVAL" in os.environ:
     INTERVAL=int(os.getenv("TEST_INTERVAL"))
+ANALYZE_INTERVAL=100000 # tree quality (RTree.analyze) every 100k; 0 for never.
+if "TEST_ANALYZE_INTERVAL" in os.environ:
+    ANALYZE_INTERVAL=int(os.getenv("TEST_ANALYZE_INTERVAL"))
+SPLIT_ENGINE="python" # or "numpy", to compare the two.
+if "SPLIT_ENGINE" in os.environ:
+    SPLIT_ENGINE=os.getenv("SPLIT_ENGINE")
 
 
 if __name__ == "__main__":
     gc.disable() # FFFFUUUUUUUUUUU
     G = RectangleGen()
-    rt = RTree()
-    start = time.clock()
-    interval_start = time.clock()
+    rt = RTree(split_engine=SPLIT_ENGINE)
+    start = clock()
+    interval_start = clock()
     for v in range(ITER):
         if 0 == (v % INTERVAL):
             # interval time taken, total time taken, # rects, cur max depth
-            t = time.clock()
+            t = clock()
             
             dt = t - interval_start
             print("%d,%s,%f" % (v, "itime_t", dt))
             print("%d,%s,%f" % (v, "avg_insert_t", (dt/float(INTERVAL))))
-            for (k,val) in rt.stats.iteritems():
+            for (k,val) in rt.stats.items():
                 print("%d,%s,%f" % (v, k, val))
             for k in rt.stats.keys():
                 if k.endswith("_f"): rt.stats[k] = 0.0
 
 
-            #print("%d,%s,%d" % (v, "max_depth", rt.node.max_depth()))
-            #print("%d,%s,%d" % (v, "mean_depth", rt.node.mean_depth()))
+            if ANALYZE_INTERVAL and 0 == (v % ANALYZE_INTERVAL) and v:
+                q = rt.analyze()
+                ld = q["leaf_depth"]
+                print("%d,%s,%d" % (v, "max_depth", q["height"]))
+                print("%d,%s,%f" % (v, "mean_depth",
+                                    sum([ d * n for (d,n) in ld.items() ]) / float(q["entries"])))
+                print("%d,%s,%f" % (v, "fill", q["fill"]))
+                print("%d,%s,%f" % (v, "overlap", q["overlap"]))
+                print("%d,%s,%f" % (v, "dead_space", q["dead_space"]))
 
-            interval_start = time.clock()
+            interval_start = clock()
         o = TstO(G.rect(0.000001))
         rt.insert(v,o.rect)
 
@@ -0,0 +1,60 @@
+# Split policies side by side: build time against query quality.
+#  Prints policy,build_t,avg_insert_t,nodes_per_query,hits for each.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rtree import RTree
+from pyrtree.split import RStarSplit
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=20000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+QUERIES=500
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+
+POLICIES = [
+    ("cluster", lambda: RTree(split="cluster")),
+    ("linear", lambda: RTree(split="linear")),
+    ("quadratic", lambda: RTree(split="quadratic")),
+    ("rstar", lambda: RTree(split="rstar")),
+    ("rstar_reinsert", lambda: RTree(split=RStarSplit(reinsert=True))),
+    ]
+
+def nodes_visited(rt, q):
+    """ (nodes whose rect was tested, leaf hits) for a window query. """
+    seen = [0]
+    def pred(c, o):
+        seen[0] += 1
+        return q.does_intersect(c.rect)
+    hits = 0
+    for c in rt.walk(pred):
+        if c.is_leaf(): hits += 1
+    return seen[0], hits
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    data = [ G.rect(0.01) for i in range(SIZE) ]
+    queries = [ G.rect(0.5) for i in range(QUERIES) ]
+
+    for (name,make) in POLICIES:
+        rt = make()
+        t = time.time()
+        for (v,r) in enumerate(data): rt.insert(v,r)
+        build = time.time() - t
+
+        visited = hits = 0
+        for q in queries:
+            n,h = nodes_visited(rt, q)
+            visited += n
+            hits += h
+        print("%s,%f,%f,%f,%d" % (name, build, build / SIZE,
+                                  visited / float(QUERIES), hits))
@@ -0,0 +1,64 @@
+# Moving objects: SIZE boxes, each moved by up to TEST_STEP per tick for
+#  TICKS ticks, by delete()+insert() and by update().  Prints
+#   how,split,wall_s,moves_per_s,in_place,query_t
+#
+# in_place is the fraction of updates that only rewrote the leaf's rect;
+#  query_t, the time for QUERIES window queries afterwards (how much the
+#  moves have worn the tree).
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.metrics import HistogramSink
+from pyrtree.rect import Rect
+from pyrtree.rtree import RTree
+from pyrtree.tests.test_rtree import RectangleGen
+
+import os, random, time
+
+SIZE=20000
+if "TEST_ITER" in os.environ:
+    SIZE=int(os.getenv("TEST_ITER"))
+TICKS=int(os.getenv("TEST_TICKS", "3"))
+STEP=float(os.getenv("TEST_STEP", "0.02"))
+QUERIES=2000
+if "TEST_QUERIES" in os.environ:
+    QUERIES=int(os.getenv("TEST_QUERIES"))
+
+def moves(rects):
+    random.seed(1)
+    for t in range(TICKS):
+        for (v,r) in enumerate(rects):
+            dx, dy = random.uniform(-STEP, STEP), random.uniform(-STEP, STEP)
+            nr = Rect(r.x + dx, r.y + dy, r.xx + dx, r.yy + dy)
+            yield v, r, nr
+            rects[v] = nr
+
+if __name__ == "__main__":
+    random.seed(0)
+    G = RectangleGen()
+    data = [ G.rect(0.05) for v in range(SIZE) ]
+    qs = [ G.rect(0.5) for i in range(QUERIES) ]
+    for split in ("cluster", "quadratic"):
+        for how in ("delete+insert", "update"):
+            rt = RTree(split=split)
+            for (v,r) in enumerate(data): rt.insert(v, r)
+            sink = rt.metrics = HistogramSink()
+            t = time.time()
+            if how == "update":
+                for (v,r,nr) in moves(list(data)): rt.update(v, r, nr)
+            else:
+                for (v,r,nr) in moves(list(data)):
+                    rt.delete(v, r)
+                    rt.insert(v, nr)
+            wall = time.time() - t
+            h = sink.histogram("update", "in_place")
+            rt.metrics = None
+            t = time.time()
+            for q in qs:
+                for v in rt.search_rect(q): pass
+            print("%s,%s,%f,%f,%s,%f" % (how, split, wall, SIZE * TICKS / wall,
+                                         "%.3f" % h.mean() if h else "", time.time() - t))
@@ -0,0 +1,351 @@
+## Benchmark runner: named scenarios, fixed seeds, JSON results.
+#
+#  python -m pyrtree.bench list
+#  python -m pyrtree.bench run [-s SCENARIO ...] [-o results.json]
+#  python -m pyrtree.bench compare baseline.json results.json
+#
+# Each scenario runs in a process of its own (so its peak memory is its
+#  own), from the same seed every time: once untimed to warm up, then
+#  --repeat times.  Every operation in it (a query; or a whole build) is
+#  timed separately, and the results give percentiles over all of them.
+#  compare exits with status 1 if anything got slower (or bigger) than the
+#  baseline by more than the threshold.
+
+# TODO: path hackery.
+if __name__ == "__main__":
+    import sys, os
+    mypath = os.path.dirname(sys.argv[0])
+    sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
+
+from pyrtree.rect import Rect
+from pyrtree.rtree import RTree
+from pyrtree.cache import QueryCache
+
+import argparse, json, math, os, platform, random, resource, subprocess, sys, time
+import multiprocessing
+from timeit import default_timer as clock
+
+SIZE=10000
+QUERIES=1000
+REPEAT=3
+WARMUP=1
+SEED=1
+SELECTIVITIES=(0.0001, 0.001, 0.01) # window area, as a fraction of the world.
+
+class Context(object):
+    """
+    What a scenario builds its operations from: a seeded random source and
+    a dataset of 'size' small rects in the unit square.  A scenario sets
+    'index' to the tree it ran against, for the size report.
+    """
+    def __init__(self, seed, size, queries):
+        self.rng = random.Random(seed)
+        self.size = size
+        self.queries = queries
+        self.data = self.rects(size)
+        self.index = None
+
+    def rects(self, n, scale=1.0):
+        """ n (id, Rect) entries, sized so that n of them cover about the
+        whole square. """
+        rng = self.rng
+        side = scale / math.sqrt(max(n, 1))
+        out = []
+        for i in range(n):
+            w = side * (0.1 + rng.random())
+            h = side * (0.1 + rng.random())
+            x = rng.random() * (1.0 - w)
+            y = rng.random() * (1.0 - h)
+            out.append((i, Rect(x, y, x + w, y + h)))
+        return out
+
+    def windows(self, selectivity):
+        rng = self.rng
+        side = math.sqrt(selectivity)
+        out = []
+        for i in range(self.queries):
+            x = rng.random() * (1.0 - side)
+            y = rng.random() * (1.0 - side)
+            out.append(Rect(x, y, x + side, y + side))
+        return out
+
+    def points(self):
+        rng = self.rng
+        return [ (rng.random(), rng.random()) for i in range(self.queries) ]
+
+    def tree(self):
+        self.index = RTree.bulk_load(self.data)
+        return self.index
+
+def _drain(it):
+    for x in it: pass
+
+# Scenarios: functions of a Context returning a list of operations (no-arg
+#  callables), each to be timed on its own.  Setup they do isn't timed.
+
+def build_insert(ctx):
+    def op():
+        ctx.index = RTree()
+        for (o,r) in ctx.data: ctx.index.insert(o, r)
+    return [ op ]
+
+def build_insert_many(ctx):
+    def op():
+        ctx.index = RTree()
+        for i in range(0, len(ctx.data), 1000):
+            ctx.index.insert_many(ctx.data[i:i+1000])
+    return [ op ]
+
+def build_bulk(ctx):
+    def op(): ctx.index = RTree.bulk_load(ctx.data)
+    return [ op ]
+
+def point_query(ctx):
+    rt = ctx.tree()
+    return [ (lambda p=p: _drain(rt.search_point(p))) for p in ctx.points() ]
+
+def window_query(ctx, selectivity):
+    rt = ctx.tree()
+    return [ (lambda q=q: _drain(rt.search_rect(q))) for q in ctx.windows(selectivity) ]
+
+def window_query_packed(ctx, selectivity):
+    pk = ctx.tree().pack()
+    return [ (lambda q=q: _drain(pk.search_rect(q))) for q in ctx.windows(selectivity) ]
+
+def viewport_query(ctx, cached):
+    """ Window queries repeating a few viewports, as a tile server sees. """
+    rt = ctx.tree()
+    if cached: rt.cache = QueryCache()
+    views = ctx.windows(0.001)[:20]
+    qs = [ ctx.rng.choice(views) for i in range(ctx.queries) ]
+    return [ (lambda q=q: _drain(rt.search_rect(q))) for q in qs ]
+
+def window_count(ctx, selectivity):
+    rt = ctx.tree()
+    return [ (lambda q=q: rt.count(q)) for q in ctx.windows(selectivity) ]
+
+def nearest(ctx, k):
+    rt = ctx.tree()
+    return [ (lambda p=p: _drain(rt.nearest(p, k))) for p in ctx.points() ]
+
+def join(ctx):
+    rt = ctx.tree()
+    other = RTree.bulk_load(ctx.rects(ctx.size // 5, 2.0))
+    return [ lambda: _drain(rt.join(other)) ]
+
+def mixed(ctx, write_fraction=0.1):
+    """ Window queries, with inserts and deletes mixed in. """
+    rt = ctx.tree()
+    rng = ctx.rng
+    fresh = [ (("new", o), r) for (o,r) in ctx.rects(ctx.queries) ]
+    added = []
+    ops = []
+    for q in ctx.windows(0.001):
+        if rng.random() >= write_fraction:
+            ops.append(lambda q=q: _drain(rt.search_rect(q)))
+        elif added and rng.random() < 0.5:
+            o,r = added.pop(rng.randrange(len(added)))
+            ops.append(lambda o=o, r=r: rt.delete(o, r))
+        else:
+            o,r = fresh.pop()
+            added.append((o,r))
+            ops.append(lambda o=o, r=r: rt.insert(o, r))
+    return ops
+
+SCENARIOS = [
+    ("build_insert", build_insert, ()),
+    ("build_insert_many", build_insert_many, ()),
+    ("build_bulk", build_bulk, ()),
+    ("point_query", point_query, ()),
+    ] + [
+    ("window_query_%g" % s, window_query, (s,)) for s in SELECTIVITIES
+    ] + [
+    ("window_query_packed_%g" % s, window_query_packed, (s,)) for s in SELECTIVITIES
+    ] + [
+    ("window_count_%g" % s, window_count, (s,)) for s in SELECTIVITIES
+    ] + [
+    ("viewport_query", viewport_query, (False,)),
+    ("viewport_query_cached", viewport_query, (True,)),
+    ("nearest_1", nearest, (1,)),
+    ("nearest_10", nearest, (10,)),
+    ("join", join, ()),
+    ("mixed", mixed, ()),
+    ]
+
+def _percentile(xs, p):
+    """ Nearest-rank percentile of sorted 'xs'. """
+    i = int(math.ceil(p / 100.0 * len(xs))) - 1
+    return xs[min(max(i, 0), len(xs) - 1)]
+
+def _index_bytes(rt):
+    if rt is None: return None
+    n = rt.node_count
+    return n * (4 * rt.rect_pool.itemsize + 2 * rt.node_pool.itemsize +
+                rt.count_pool.itemsize)
+
+def run_scenario(name, size=SIZE, queries=QUERIES, repeat=REPEAT,
+                 warmup=WARMUP, seed=SEED):
+    """ Run one scenario here, in this process; returns its result dict. """
+    fn, args = dict([ (n, (f, a)) for (n,f,a) in SCENARIOS ])[name]
+    times = []
+    for i in range(warmup + repeat):
+        ctx = Context(seed, size, queries)
+        ops = fn(ctx, *args)
+        if i < warmup:
+            for op in ops: op()
+            continue
+        for op in ops:
+            t = clock()
+            op()
+            times.append(clock() - t)
+    times.sort()
+    total = sum(times)
+    return {
+        "ops" : len(times) // repeat,
+        "total_s" : total / repeat,
+        "mean_s" : total / len(times),
+        "min_s" : times[0],
+        "p50_s" : _percentile(times, 50),
+        "p90_s" : _percentile(times, 90),
+        "p99_s" : _percentile(times, 99),
+        "max_s" : times[-1],
+        "ops_per_s" : len(times) / total if total > 0 else None,
+        "index_bytes" : _index_bytes(ctx.index),
+        "peak_rss_kb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+def _child(conn, name, kwargs):
+    try:
+        conn.send(run_scenario(name, **kwargs))
+    except Exception, e:
+        conn.send({ "error" : "%s: %s" % (type(e).__name__, e) })
+    conn.close()
+
+def run(names=None, isolate=True, **kwargs):
+    """ Run scenarios (all of them by default); returns the report. """
+    if names is None: names = [ n for (n,f,a) in SCENARIOS ]
+    known = [ n for (n,f,a) in SCENARIOS ]
+    for n in names:
+        if n not in known: raise ValueError("unknown scenario %r" % (n,))
+    results = {}
+    for name in names:
+        if isolate:
+            parent, child = multiprocessing.Pipe(False)
+            p = multiprocessing.Process(target=_child, args=(child, name, kwargs))
+            p.start()
+            child.close() # so recv() sees EOF if the child dies without sending.
+            try:
+                results[name] = parent.recv()
+            except EOFError:
+                results[name] = None
+            parent.close()
+            p.join()
+            if results[name] is None:
+                results[name] = { "error" : "worker died (exit code %s)" % (p.exitcode,) }
+        else:
+            results[name] = run_scenario(name, **kwargs)
+
+    meta = dict(size=SIZE, queries=QUERIES, repeat=REPEAT, warmup=WARMUP, seed=SEED)
+    meta.update(kwargs)
+    meta["python"] = platform.python_version()
+    meta["platform"] = platform.platform()
+    meta["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    meta["commit"] = _commit()
+    return { "meta" : meta, "scenarios" : results }
+
+def _commit():
+    try:
+        out = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                               stderr=open(os.devnull, "w")).communicate()[0]
+        return out.strip() or None
+    except OSError:
+        return None
+
+def compare(base, cur, metric="p50_s", threshold=0.10, memory_threshold=0.25):
+    """
+    Rows of (scenario, what, baseline, current, ratio, status) for the
+    scenarios in both reports.  Status is "REGRESSION" where current is
+    worse by more than the threshold, "improved" where it's better by as
+    much, else "ok".  'metric' is compared at 'threshold', and
+    peak_rss_kb at 'memory_threshold'.
+
+    A scenario that failed (a result of {"error": ...}) in either report
+    gets one row instead, with 'what' "error", the errors (or None) as
+    baseline and current, and no ratio: a REGRESSION if it failed in the
+    current report, "improved" if only in the baseline.
+    """
+    rows = []
+    bs, cs = base["scenarios"], cur["scenarios"]
+    for name in sorted(set(bs) & set(cs)):
+        be, ce = bs[name].get("error"), cs[name].get("error")
+        if be is not None or ce is not None:
+            rows.append((name, "error", be, ce, None,
+                         "REGRESSION" if ce is not None else "improved"))
+            continue
+        for (what, thr) in ((metric, threshold), ("peak_rss_kb", memory_threshold)):
+            b, c = bs[name].get(what), cs[name].get(what)
+            if not b or c is None: continue
+            ratio = c / float(b)
+            if ratio > 1.0 + thr: status = "REGRESSION"
+            elif ratio < 1.0 / (1.0 + thr): status = "improved"
+            else: status = "ok"
+            rows.append((name, what, b, c, ratio, status))
+    return rows
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m pyrtree.bench",
+                                 description="pyrtree benchmark runner")
+    sub = ap.add_subparsers(dest="command")
+    sub.add_parser("list", help="list the scenarios")
+
+    r = sub.add_parser("run", help="run scenarios, write JSON")
+    r.add_argument("-s", "--scenario", action="append", dest="names",
+                   help="scenario to run (repeatable; default all)")
+    r.add_argument("-o", "--output", help="write the JSON here (default stdout)")
+    r.add_argument("--size", type=int, default=SIZE)
+    r.add_argument("--queries", type=int, default=QUERIES)
+    r.add_argument("--repeat", type=int, default=REPEAT)
+    r.add_argument("--warmup", type=int, default=WARMUP)
+    r.add_argument("--seed", type=int, default=SEED)
+    r.add_argument("--inline", action="store_true",
+                   help="run in this process (peak memory is then shared)")
+
+    c = sub.add_parser("compare", help="flag regressions against a baseline")
+    c.add_argument("baseline")
+    c.add_argument("current")
+    c.add_argument("--metric", default="p50_s")
+    c.add_argument("--threshold", type=float, default=0.10)
+    c.add_argument("--memory-threshold", type=float, default=0.25)
+
+    args = ap.parse_args(argv)
+    if args.command == "list":
+        for (n,f,a) in SCENARIOS: print(n)
+        return 0
+
+    if args.command == "run":
+        report = run(args.names, isolate=not args.inline, size=args.size,
+                     queries=args.queries, repeat=args.repeat,
+                     warmup=args.warmup, seed=args.seed)
+        out = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            f = open(args.output, "w")
+            f.write(out + "\n")
+            f.close()
+        else:
+            print(out)
+        return 0
+
+    base = json.load(open(args.baseline))
+    cur = json.load(open(args.current))
+    rows = compare(base, cur, args.metric, args.threshold, args.memory_threshold)
+    for (name, what, b, c, ratio, status) in rows:
+        if ratio is None:
+            print("%-22s %-12s %s -> %s  %s" % (name, what, b, c, status))
+        else:
+            print("%-22s %-12s %12.6g %12.6g %6.2fx  %s" % (name, what, b, c, ratio, status))
+    for name in sorted(set(base["scenarios"]) ^ set(cur["scenarios"])):
+        print("%-22s (only in one report)" % name)
+    return 1 if [ r for r in rows if r[5] == "REGRESSION" ] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
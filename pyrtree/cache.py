@@ -0,0 +1,82 @@
+## Query result cache.
+#
+# An RTree with a cache (RTree(cache=...), or set its 'cache') answers a
+#  query_rect/query_point it has seen before -- same coords, same kind --
+#  from the cache instead of walking the tree.  Results are kept as leaf
+#  node indices, least recently used dropped first.
+#
+# Writes invalidate by area: a change to an entry with rect R drops the
+#  cached queries whose boxes touch R, and only those.  That covers entries
+#  that move inside the tree, too (forced reinsertion, delete's orphans):
+#  the writers invalidate for every rect they take out or put back.
+
+import threading
+from collections import OrderedDict
+
+class QueryCache(object):
+    """
+    LRU of query results, bounded both in entries ('max_entries') and in
+    leaf indices held over all entries ('max_ids'; a result bigger than
+    that isn't cached at all).
+
+    hits, misses, evictions (dropped to make room) and invalidations
+    (dropped because a write touched them) count from creation; stats()
+    has them all.
+    """
+    def __init__(self, max_entries=1024, max_ids=1 << 20):
+        if max_entries < 1 or max_ids < 1:
+            raise ValueError("cache bounds must be at least 1")
+        self.max_entries = max_entries
+        self.max_ids = max_ids
+        self._entries = OrderedDict() # (closed, x, y, xx, yy) -> tuple of node indices
+        self._ids = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ The cached result for 'key', or None; counts a hit or miss. """
+        with self._lock:
+            res = self._entries.pop(key, None)
+            if res is None:
+                self.misses += 1
+                return None
+            self._entries[key] = res # most recently used goes last.
+            self.hits += 1
+            return res
+
+    def put(self, key, res):
+        if len(res) >= self.max_ids: return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None: self._ids -= len(old) + 1
+            self._entries[key] = res
+            self._ids += len(res) + 1
+            while len(self._entries) > self.max_entries or self._ids > self.max_ids:
+                k,v = self._entries.popitem(last=False)
+                self._ids -= len(v) + 1
+                self.evictions += 1
+
+    def invalidate(self, x, y, xx, yy):
+        """ Drop cached queries whose boxes touch (x,y,xx,yy). """
+        with self._lock:
+            if not self._entries: return
+            stale = [ k for k in self._entries
+                      if k[1] <= xx and k[3] >= x and k[2] <= yy and k[4] >= y ]
+            for k in stale:
+                self._ids -= len(self._entries.pop(k)) + 1
+            self.invalidations += len(stale)
+
+    def clear(self):
+        """ Drop everything (counted as invalidations). """
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries = OrderedDict()
+            self._ids = 0
+
+    def stats(self):
+        return { "hits" : self.hits, "misses" : self.misses,
+                 "evictions" : self.evictions, "invalidations" : self.invalidations,
+                 "entries" : len(self._entries), "ids" : self._ids }
@@ -0,0 +1,217 @@
+## Exact geometries, for filter-and-refine queries.
+#
+# The tree only knows rects, so its hits are candidates: entries whose
+#  rects meet the query.  Give a tree a GeometryStore (RTree(geometry=...),
+#  or set its 'geometry') and register shapes for its leaf objects, and
+#  query_rect/query_point (search_*, visit_*, the batch queries and the
+#  aquery_* ones, and those of its snapshots and packed copies) keep only
+#  the candidates whose shapes meet the query too.
+#  Objects with no shape registered are taken at their rect.
+#
+# Shapes are polygons (rings: outer and holes, or several polygons' worth,
+#  by the even-odd rule) or polylines, stored as their edges, packed:
+#
+#   edges: x1,y1,x2,y2 per edge (array('d')).
+#   slot s (a shape): first[s], count[s] -- its edges; areal[s], whether
+#    it has an inside; bbox[4s:4s+4], its bounding box.
+#   slots: leaf object -> slot.
+#
+# Candidates are tested many at a time, with numpy (needed).  Those whose
+#  shapes' bboxes lie inside the query box, or miss it, are settled by
+#  that; the rest have their edges gathered and clipped against the query
+#  boxes in one go, rather than one shape at a time in Python.  A shape
+#  meets a box if an edge does, or -- for a polygon -- if the box's corner
+#  is inside it; touching counts.
+
+import array, itertools, threading
+
+REFINE_BATCH=256 # candidates tested at a time, by the tree's queries.
+
+class GeometryStore(object):
+    """
+    Shapes by leaf object (which must be hashable; the ones a tree is
+    given, not leaf_pool indices, so they survive compact() and the
+    like).  Safe to share between a tree and its snapshots: changes take a
+    lock, and are seen by queries from then on.
+    """
+    def __init__(self):
+        self.edges = array.array('d')
+        self.first = array.array('L')
+        self.count = array.array('L')
+        self.areal = array.array('B')
+        self.bbox = array.array('d')
+        self.slots = {}
+        self.free_slots = []
+        self.garbage = 0 # room in 'edges' of removed shapes, not yet reclaimed.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, o):
+        return o in self.slots
+
+    def add_polygon(self, o, rings):
+        """ Register polygon rings -- sequences of (x,y), closing edge
+        implied -- as o's shape, replacing any it had. """
+        self._add(o, rings, True)
+
+    def add_line(self, o, *lines):
+        """ Register polylines (sequences of (x,y)) as o's shape. """
+        self._add(o, lines, False)
+
+    def _add(self, o, parts, areal):
+        es = []
+        for pts in parts:
+            pts = list(pts)
+            if areal and pts and pts[0] != pts[-1]: pts.append(pts[0])
+            for i in range(len(pts) - 1):
+                es.extend((pts[i][0], pts[i][1], pts[i+1][0], pts[i+1][1]))
+        if not es: raise ValueError("a shape needs at least one edge")
+        with self._lock:
+            self._drop(o)
+            if self.free_slots:
+                s = self.free_slots.pop()
+            else:
+                s = len(self.first)
+                self.first.append(0)
+                self.count.append(0)
+                self.areal.append(0)
+                self.bbox.extend((0, 0, 0, 0))
+            self.first[s] = len(self.edges) // 4
+            self.count[s] = len(es) // 4
+            self.areal[s] = areal
+            self.bbox[s*4:s*4+4] = array.array('d', (min(es[0::2]), min(es[1::2]),
+                                                     max(es[0::2]), max(es[1::2])))
+            self.edges.extend(es)
+            self.slots[o] = s
+            self._tidy()
+
+    def remove(self, o):
+        """ Forget o's shape; whether it had one. """
+        with self._lock:
+            found = self._drop(o)
+            self._tidy()
+            return found
+
+    def _drop(self, o):
+        s = self.slots.pop(o, None)
+        if s is None: return False
+        self.garbage += self.count[s] * 4
+        self.count[s] = 0
+        self.free_slots.append(s)
+        return True
+
+    def _tidy(self):
+        """ Repack, once removed shapes' edges are half the array. """
+        if self.garbage * 2 > len(self.edges): self._repack()
+
+    def _repack(self):
+        """ Copy the live edges to a new array, in slot order. """
+        old, new = self.edges, array.array('d')
+        for s in sorted(self.slots.values()):
+            f = self.first[s] * 4
+            self.first[s] = len(new) // 4
+            new.extend(old[f:f + self.count[s] * 4])
+        self.edges = new
+        self.garbage = 0
+
+    def test_rects(self, objs, boxes):
+        """
+        Bool numpy array: whether objs[i]'s shape meets box i ((x,y,xx,yy)
+        rows of 'boxes'; a point is (x,y,x,y)), or the one box, if 'boxes'
+        is a single (x,y,xx,yy).  True for objects without a shape.
+        """
+        import numpy
+        boxes = numpy.asarray(boxes, dtype=numpy.float64)
+        one = boxes.ndim == 1
+        boxes = boxes.reshape(-1,4)
+        n = len(objs)
+        out = numpy.ones(n, dtype=bool)
+        with self._lock:
+            get = self.slots.get
+            sl = [ get(o) for o in objs ]
+            js = numpy.array([ j for (j,s) in enumerate(sl) if s is not None ], dtype=numpy.int64)
+            if not len(js): return out
+            ss = numpy.array([ sl[j] for j in js ], dtype=numpy.int64)
+            b = numpy.frombuffer(self.bbox, dtype=numpy.float64).reshape(-1,4)[ss]
+            q = boxes if one else boxes[js]
+            # Shapes inside the box meet it; shapes whose bboxes miss it don't.
+            inb = (b[:,0] >= q[:,0]) & (b[:,1] >= q[:,1]) & (b[:,2] <= q[:,2]) & (b[:,3] <= q[:,3])
+            off = (b[:,0] > q[:,2]) | (b[:,1] > q[:,3]) | (b[:,2] < q[:,0]) | (b[:,3] < q[:,1])
+            out[js[off]] = False
+            rest = ~(inb | off)
+            js, ss = js[rest], ss[rest]
+            if not len(js): return out
+            first = numpy.frombuffer(self.first, dtype=self.first.typecode)[ss].astype(numpy.int64)
+            cnt = numpy.frombuffer(self.count, dtype=self.count.typecode)[ss].astype(numpy.int64)
+            areal = numpy.frombuffer(self.areal, dtype=numpy.uint8)[ss].astype(bool)
+            edges = numpy.frombuffer(self.edges, dtype=numpy.float64).reshape(-1,4)
+            # Every candidate's edges, each tagged with its candidate:
+            owner = numpy.repeat(numpy.arange(len(js)), cnt)
+            ei = numpy.repeat(first - (numpy.cumsum(cnt) - cnt), cnt) + numpy.arange(cnt.sum())
+            e = edges[ei]
+        x1,y1,x2,y2 = e[:,0],e[:,1],e[:,2],e[:,3]
+        if one: qx,qy,qxx,qyy = boxes[0]
+        else:
+            q = boxes[js][owner]
+            qx,qy,qxx,qyy = q[:,0],q[:,1],q[:,2],q[:,3]
+
+        # Edge meets box: Liang-Barsky clipping of the edge to the box.
+        dx, dy = x2 - x1, y2 - y1
+        t0 = numpy.zeros(len(e))
+        t1 = numpy.ones(len(e))
+        miss = numpy.zeros(len(e), dtype=bool)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            for (p,d) in ((-dx, x1 - qx), (dx, qxx - x1), (-dy, y1 - qy), (dy, qyy - y1)):
+                miss |= (p == 0) & (d < 0)
+                r = d / p
+                numpy.maximum(t0, r, out=t0, where=p < 0)
+                numpy.minimum(t1, r, out=t1, where=p > 0)
+        hit = numpy.bincount(owner[~miss & (t0 <= t1)], minlength=len(js)) > 0
+
+        # Box corner inside a polygon: crossings of a ray from it, even-odd.
+        px, py = qx, qy
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            cross = ((y1 > py) != (y2 > py)) & (px < dx * (py - y1) / dy + x1)
+        inside = numpy.bincount(owner[cross], minlength=len(js)) % 2 == 1
+
+        out[js] = hit | (inside & areal)
+        return out
+
+    def test_points(self, objs, points):
+        """ test_rects, for (x,y) points. """
+        import numpy
+        ps = numpy.asarray(points, dtype=numpy.float64).reshape(-1,2)
+        return self.test_rects(objs, numpy.hstack([ ps, ps ]))
+
+def _refine_hits(tree, hits, x, y, xx, yy):
+    """ Leaf node indices from 'hits' whose leaf objects' shapes meet
+    (x,y,xx,yy), tested REFINE_BATCH at a time. """
+    npool = tree.node_pool
+    lp = tree.leaf_pool
+    return _refine(tree.geometry, hits, lambda c: lp[npool[c*2 + 1]], (x, y, xx, yy))
+
+def _refine_leaves(tree, hits, x, y, xx, yy):
+    """ _refine_hits, for leaf_pool indices (PackedTree's hits). """
+    return _refine(tree.geometry, hits, tree.leaf_pool.__getitem__, (x, y, xx, yy))
+
+def _refine(store, hits, obj, box):
+    test = store.test_rects
+    hits = iter(hits)
+    while True:
+        batch = list(itertools.islice(hits, REFINE_BATCH))
+        if not batch: return
+        keep = test([ obj(c) for c in batch ], box)
+        for (c,k) in zip(batch, keep):
+            if k: yield c
+
+def _refine_pairs(tree, boxes, qi, li):
+    """ _refine_hits, for the (query index, leaf index) arrays of the
+    batch queries. """
+    import numpy
+    if not len(li): return qi, li
+    lp = tree.leaf_pool
+    q = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1,4)[qi]
+    keep = tree.geometry.test_rects([ lp[l] for l in li.tolist() ], q)
+    return qi[keep], li[keep]
@@ -0,0 +1,271 @@
+## Streaming ingestion: bounding boxes out of files, into a tree.
+#
+# (Not called io: with pyrtree/ itself on sys.path, as the scripts here
+#  that do path hackery can have it, that would shadow the standard
+#  library's io, which tempfile and others import.)
+#
+# A reader (CSVReader, GeoJSONReader, WKBReader) goes through its file
+#  once, handing out chunks of at most 'chunk' records: (objs, boxes),
+#  where objs is a list of the records' objects (an id; see each reader)
+#  and boxes an array('d') of x,y,xx,yy per record.  So however big the
+#  file, a reader holds one chunk, and there's no Rect per record:
+#
+#   load(tree, reader) -- RTree.insert_boxes, chunk by chunk.
+#   build(reader, **kwargs) -- a new tree, with RTree.bulk_load_boxes
+#    (the chunks are kept until the end: 32 bytes per box, plus objs).
+#
+# Both return stats: records (read), loaded, skipped, chunks, wall_s,
+#  records_per_s, and peak_rss_kb (the process's, or None where it can't
+#  be had).
+#
+# Records that can't be indexed -- no coordinates, or a box with no width
+#  (a point, say: see 'pad', which widens every box) -- are skipped, and
+#  counted.
+
+import array, csv, json, mmap, os, struct, time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from rtree import RTree
+
+CHUNK=65536 # records per chunk.
+
+class _Reader(object):
+    """ Chunking, padding and counting; subclasses yield (obj, x, y, xx,
+    yy) from _records(), with x None for a record without coordinates. """
+    def __init__(self, pad, chunk):
+        if chunk < 1: raise ValueError("chunk must be at least 1")
+        self.pad = pad
+        self.chunk = chunk
+        self.records = self.skipped = 0
+
+    def __iter__(self):
+        pad, chunk = self.pad, self.chunk
+        objs, boxes = [], array.array('d')
+        for (o,x,y,xx,yy) in self._records():
+            self.records += 1
+            if x is not None:
+                x,y,xx,yy = x - pad, y - pad, xx + pad, yy + pad
+            if x is None or not (xx > x and yy >= y): # (NaNs fail too.)
+                self.skipped += 1
+                continue
+            objs.append(o)
+            boxes.extend((x, y, xx, yy))
+            if len(objs) >= chunk:
+                yield objs, boxes
+                objs, boxes = [], array.array('d')
+        if objs: yield objs, boxes
+
+def _open(f, mode):
+    """ (file, whether we opened it) for a path or an open file. """
+    if isinstance(f, basestring): return open(f, mode), True
+    return f, False
+
+class CSVReader(_Reader):
+    """
+    Boxes from the columns named in 'columns' (min x, min y, max x, max y;
+    looked up in the header row), or at those positions, if they're
+    numbers and not 'header'.  A record's object is its 'id_column', or its
+    number (from 0) if that's None.  Other keyword arguments go to
+    csv.reader.
+    """
+    def __init__(self, f, columns=("minx", "miny", "maxx", "maxy"),
+                 id_column=None, header=True, pad=0.0, chunk=CHUNK, **fmtparams):
+        _Reader.__init__(self, pad, chunk)
+        if len(columns) != 4: raise ValueError("need 4 coordinate columns")
+        self.f = f
+        self.columns = columns
+        self.id_column = id_column
+        self.header = header
+        self.fmtparams = fmtparams
+
+    def _records(self):
+        f, mine = _open(self.f, "rb")
+        try:
+            rows = csv.reader(f, **self.fmtparams)
+            cols, idc = list(self.columns), self.id_column
+            if self.header:
+                names = rows.next()
+                cols = [ names.index(c) for c in cols ]
+                if idc is not None: idc = names.index(idc)
+            i0,i1,i2,i3 = cols
+            for (n,row) in enumerate(rows):
+                if not row: continue
+                o = n if idc is None else row[idc]
+                try:
+                    yield o, float(row[i0]), float(row[i1]), float(row[i2]), float(row[i3])
+                except ValueError: # an empty (or junk) field.
+                    yield o, None, None, None, None
+        finally:
+            if mine: f.close()
+
+class GeoJSONReader(_Reader):
+    """
+    Boxes of line-delimited GeoJSON: a Feature (or a bare geometry) per
+    line.  The box is the feature's "bbox" if it has one, else that of its
+    coordinates.  A record's object is the property 'id_field', or the
+    feature's "id" if that's None, or else its line number (from 0).
+    """
+    def __init__(self, f, id_field=None, pad=0.0, chunk=CHUNK):
+        _Reader.__init__(self, pad, chunk)
+        self.f = f
+        self.id_field = id_field
+
+    def _records(self):
+        f, mine = _open(self.f, "rb")
+        idf = self.id_field
+        try:
+            for (n,line) in enumerate(f):
+                if not line.strip(): continue
+                feat = json.loads(line)
+                if idf is not None: o = (feat.get("properties") or {}).get(idf)
+                else: o = feat.get("id", n)
+                b = feat.get("bbox")
+                if b is not None:
+                    d = len(b) // 2 # 2 or 3 dimensions.
+                    yield o, b[0], b[1], b[d], b[d+1]
+                    continue
+                geom = feat.get("geometry", feat) if feat.get("type") == "Feature" else feat
+                box = _geojson_box(geom)
+                if box is None: yield o, None, None, None, None
+                else: yield (o,) + box
+        finally:
+            if mine: f.close()
+
+def _geojson_box(geom):
+    """ (x,y,xx,yy) of a GeoJSON geometry's coordinates, or None. """
+    x = y = xx = yy = None
+    todo = [geom]
+    while todo:
+        g = todo.pop()
+        if g is None: continue
+        if "geometries" in g:
+            todo.extend(g["geometries"])
+            continue
+        cs = [g.get("coordinates")]
+        while cs:
+            c = cs.pop()
+            if not c: continue
+            if isinstance(c[0], (int, long, float)): # a position.
+                px,py = c[0],c[1]
+                if x is None: x,y,xx,yy = px,py,px,py
+                else:
+                    if px < x: x = px
+                    if py < y: y = py
+                    if px > xx: xx = px
+                    if py > yy: yy = py
+            else: cs.extend(c)
+    return None if x is None else (x, y, xx, yy)
+
+_WKB_Z, _WKB_M, _WKB_SRID = 0x80000000, 0x40000000, 0x20000000 # EWKB flags.
+
+class WKBReader(_Reader):
+    """
+    Boxes of WKB geometries laid end to end (as in a dump of a geometry
+    column).  ISO (Z/M types 1001..3007) and EWKB (Z/M/SRID flags) variants
+    are read too; boxes are of x and y.  The file is mmapped, not read in.
+    A record's object is its number (from 0).
+    """
+    def __init__(self, path, pad=0.0, chunk=CHUNK):
+        _Reader.__init__(self, pad, chunk)
+        self.path = path
+
+    def _records(self):
+        f = open(self.path, "rb")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if not size: return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            off = n = 0
+            while off < size:
+                box = [None, None, None, None]
+                off = _wkb_box(m, off, box)
+                yield (n,) + tuple(box)
+                n += 1
+        finally:
+            m.close()
+
+def _wkb_box(buf, off, box):
+    """ Grow 'box' ([x,y,xx,yy], Nones to start) by the geometry at 'off';
+    returns the offset just past it. """
+    bo = "<" if buf[off] == "\x01" else ">"
+    t, = struct.unpack_from(bo + "I", buf, off + 1)
+    off += 5
+    dims = 2 + bool(t & _WKB_Z) + bool(t & _WKB_M)
+    if t & _WKB_SRID: off += 4
+    t &= 0x0fffffff
+    dims += (1, 1, 2)[t // 1000 - 1] if t >= 1000 else 0 # ISO: Z, M, ZM.
+    t %= 1000
+    if t == 1:
+        _wkb_points(buf, off, bo, 1, dims, box)
+        return off + 8 * dims
+    n, = struct.unpack_from(bo + "I", buf, off)
+    off += 4
+    if t == 2:
+        _wkb_points(buf, off, bo, n, dims, box)
+        return off + 8 * dims * n
+    if t == 3:
+        for i in range(n):
+            k, = struct.unpack_from(bo + "I", buf, off)
+            _wkb_points(buf, off + 4, bo, k, dims, box)
+            off += 4 + 8 * dims * k
+        return off
+    if 4 <= t <= 7:
+        for i in range(n): off = _wkb_box(buf, off, box)
+        return off
+    raise ValueError("unsupported WKB geometry type %d at offset %d" % (t, off - 5))
+
+def _wkb_points(buf, off, bo, n, dims, box):
+    if not n: return
+    vs = struct.unpack_from("%s%dd" % (bo, n * dims), buf, off)
+    xs = [ v for v in vs[0::dims] if v == v ] # an empty point is NaNs.
+    ys = [ v for v in vs[1::dims] if v == v ]
+    if not xs or not ys: return
+    x,y,xx,yy = min(xs),min(ys),max(xs),max(ys)
+    if box[0] is None: box[:] = [x, y, xx, yy]
+    else:
+        if x < box[0]: box[0] = x
+        if y < box[1]: box[1] = y
+        if xx > box[2]: box[2] = xx
+        if yy > box[3]: box[3] = yy
+
+def _stats(reader, loaded, chunks, t):
+    wall = time.time() - t
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+    return { "records" : reader.records, "loaded" : loaded,
+             "skipped" : reader.skipped, "chunks" : chunks, "wall_s" : wall,
+             "records_per_s" : reader.records / wall if wall > 0 else None,
+             "peak_rss_kb" : rss }
+
+def load(tree, reader, progress=None):
+    """ Insert everything 'reader' has into 'tree' (insert_boxes, a chunk
+    at a time).  progress, if given, is called with the stats so far after
+    each chunk.  Returns the stats. """
+    t = time.time()
+    loaded = chunks = 0
+    for (objs, boxes) in reader:
+        tree.insert_boxes(objs, boxes)
+        loaded += len(objs)
+        chunks += 1
+        if progress is not None: progress(_stats(reader, loaded, chunks, t))
+    return _stats(reader, loaded, chunks, t)
+
+def build(reader, progress=None, **kwargs):
+    """ A new tree of everything 'reader' has, bulk loaded; keyword
+    arguments go to the RTree constructor.  Returns (tree, stats). """
+    t = time.time()
+    objs, boxes = [], array.array('d')
+    chunks = 0
+    for (o, b) in reader:
+        objs.extend(o)
+        boxes.extend(b)
+        chunks += 1
+        if progress is not None: progress(_stats(reader, len(objs), chunks, t))
+    tree = RTree.bulk_load_boxes(objs, boxes, **kwargs)
+    return tree, _stats(reader, len(objs), chunks, t)
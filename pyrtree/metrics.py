@@ -0,0 +1,116 @@
+## Metrics sinks for RTree instrumentation.
+#
+# Set a tree's 'metrics' to a sink (or pass metrics= to the constructor)
+#  and each operation reports to it: sink.record(event, fields), with
+#  'fields' a dict of numbers.  With no sink (the default) the tree only
+#  pays for a check per operation.
+#
+# Events and their fields:
+#  query_rect, query_point, count, nearest, join -- wall_s, nodes_visited
+#   (internal nodes -- node pairs, for join -- expanded), leaves_tested,
+#   leaves_returned, depth (deepest level expanded; the root is 0).
+#   For queries that stream results, wall_s runs until the results are
+#   used up, so it includes the caller's time in between.
+#  insert -- wall_s, depth (of the node the entry went into), splits,
+#   reinserted (entries put back by forced reinsertion).
+#  insert_many -- wall_s, entries, splits.
+#  delete -- wall_s, found (0 or 1), splits, reinserted.
+#  update -- wall_s, found (0 or 1), in_place (1 if only the leaf's rect
+#   was rewritten), splits.
+#  split -- cpu_s, children (of the node split), groups.
+#  compact -- wall_s, nodes (after), reclaimed (node slots).
+
+import logging, math
+
+class Sink(object):
+    """ Base class: receives one record() call per operation. """
+    def record(self, event, fields):
+        raise NotImplementedError
+
+class CallbackSink(Sink):
+    """ Calls fn(event, fields). """
+    def __init__(self, fn):
+        self.fn = fn
+
+    def record(self, event, fields):
+        self.fn(event, fields)
+
+class LogSink(Sink):
+    """ Logs one line per operation, to the "pyrtree.metrics" logger by
+    default. """
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger("pyrtree.metrics")
+        self.level = level
+
+    def record(self, event, fields):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "%s %s", event,
+                            " ".join([ "%s=%s" % kv for kv in sorted(fields.items()) ]))
+
+class Histogram(object):
+    """
+    Count, sum, min and max of a series, and how many values fell into
+    each power-of-two bucket: bucket b holds values in [2**b, 2**(b+1));
+    zeros (and negatives) go in bucket None.
+    """
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+        self.buckets = {}
+
+    def add(self, v):
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min: self.min = v
+        if self.max is None or v > self.max: self.max = v
+        b = int(math.floor(math.log(v, 2))) if v > 0 else None
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile (capped
+        at the max seen). """
+        if not self.count: return None
+        want = p / 100.0 * self.count
+        seen = 0
+        for b in sorted(self.buckets, key=lambda b: -1e9 if b is None else b):
+            seen += self.buckets[b]
+            if seen >= want:
+                return 0 if b is None else min(2.0 ** (b + 1), self.max)
+        return self.max
+
+class HistogramSink(Sink):
+    """ Keeps a Histogram per (event, field), and a count per event. """
+    def __init__(self):
+        self.events = {}
+        self.histograms = {}
+
+    def record(self, event, fields):
+        self.events[event] = self.events.get(event, 0) + 1
+        hs = self.histograms
+        for (k,v) in fields.items():
+            h = hs.get((event, k))
+            if h is None: h = hs[(event, k)] = Histogram()
+            h.add(v)
+
+    def histogram(self, event, field):
+        return self.histograms.get((event, field))
+
+    def summary(self):
+        """ {event: {field: {count, mean, min, max, p50, p90, p99}}} """
+        out = {}
+        for ((event, field), h) in self.histograms.items():
+            out.setdefault(event, {})[field] = {
+                "count" : h.count, "mean" : h.mean(), "min" : h.min, "max" : h.max,
+                "p50" : h.percentile(50), "p90" : h.percentile(90),
+                "p99" : h.percentile(99) }
+        return out
+
+    def clear(self):
+        self.events = {}
+        self.histograms = {}
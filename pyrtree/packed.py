@@ -0,0 +1,231 @@
+## Packed (block) layout: a read-only copy of an RTree, from RTree.pack().
+#
+# The RTree pools link children into sibling lists (node_pool's
+#  next_sibling/first_child), and leaves are full nodes flagged by a
+#  swapped x.  Here the internal nodes are renumbered breadth-first, so
+#  that each node's children sit in one contiguous block:
+#
+#   node i, internal (the root is 0): box[4i:4i+4]; its children are
+#    slots first[i] .. first[i] + size[i] - 1, of the leaf block arrays if
+#    leafy[i], else of the node arrays (the same numbering).
+#   leaf slot j: leaf_box[4j:4j+4], plain x,y,xx,yy (no flag);
+#    leaf_id[j], its leaf_pool index.
+#   entries[i]: entries under node i (as RTree.count_pool).
+#
+# So a node's children are one slice -- of the arrays, or of numpy views
+#  on them (see query_rects_batch) -- rather than a chain of hops around
+#  the pools.
+
+import array
+
+from rtree import _typecode
+
+class PackedTree(object):
+    """
+    The tree as it was when packed, in the block layout above.  It has
+    the read-only queries (search_*, visit_*, count and the batch
+    queries), which give the same answers as the tree's; nothing changes
+    it, so any number of threads can query it.  Hits are refined against
+    the tree's geometry store, which it shares.
+    """
+    def __init__(self, tree):
+        rp, npool = tree.rect_pool, tree.node_pool
+        ct, it = _typecode(rp), _typecode(npool)
+        self.generation = tree.generation
+        self.leaf_pool = list(tree.leaf_pool)
+        self.exact_rects = dict(tree.exact_rects) if tree.exact_rects else None
+        self.geometry = tree.geometry
+        self.box = array.array(ct)
+        self.first = array.array(it)
+        self.size = array.array(it)
+        self.leafy = array.array('B')
+        self.entries = array.array(it)
+        self.leaf_box = array.array(ct)
+        self.leaf_id = array.array(it)
+
+        cp = tree.count_pool
+        order = [0] # tree node indices, breadth first; position = packed index.
+        for idx in order:
+            ri = idx * 4
+            self.box.extend(rp[ri:ri+4])
+            self.entries.append(cp[idx] if len(cp) else 0)
+            kids = []
+            c = npool[idx*2 + 1]
+            while c != 0:
+                kids.append(c)
+                c = npool[c*2]
+            self.size.append(len(kids))
+            if kids and rp[kids[0]*4] > rp[kids[0]*4 + 2]:
+                self.leafy.append(1)
+                self.first.append(len(self.leaf_id))
+                for c in kids:
+                    ri = c * 4
+                    x,y,xx,yy = rp[ri+2],rp[ri+1],rp[ri],rp[ri+3] # x unswapped.
+                    self.leaf_box.extend((x,y,xx,yy))
+                    self.leaf_id.append(npool[c*2 + 1])
+            else:
+                self.leafy.append(0)
+                self.first.append(len(order))
+                order.extend(kids)
+        self.node_count = len(order)
+        self.leaf_count = len(self.leaf_id)
+
+    def children(self, i):
+        """ (leafy, slice) of node i's block. """
+        s = self.first[i]
+        return bool(self.leafy[i]), slice(s, s + self.size[i])
+
+    def _hits(self, x, y, xx, yy, closed):
+        """ leaf_id of entries overlapping (x,y,xx,yy), refined against the
+        geometry store if there is one. """
+        hits = self._iter_hits(x, y, xx, yy, closed)
+        if self.geometry is not None:
+            import geometry
+            hits = geometry._refine_leaves(self, hits, x, y, xx, yy)
+        return hits
+
+    def _iter_hits(self, x, y, xx, yy, closed):
+        """ leaf_id of entries overlapping (x,y,xx,yy); see rtree._iter_hits. """
+        box, first, size, leafy = self.box, self.first, self.size, self.leafy
+        lb, lid = self.leaf_box, self.leaf_id
+        ex = self.exact_rects
+        stack = [0]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            i = pop()
+            s = first[i]
+            leaves = leafy[i]
+            b = (lb if leaves else box)[s*4:(s + size[i])*4] # the block, in one go.
+            for k in range(0, len(b), 4):
+                bx,by,bxx,byy = b[k],b[k+1],b[k+2],b[k+3]
+                w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+                h = (byy if byy < yy else yy) - (by if by > y else y)
+                if (w >= 0 and h >= 0) if closed else (w > 0 and h > 0):
+                    if not leaves:
+                        push(s + k // 4)
+                        continue
+                    li = lid[s + k // 4]
+                    if ex and li in ex and not _exact_hit(ex[li], x, y, xx, yy, closed):
+                        continue
+                    yield li
+
+    def search_rect(self, r, ids=False):
+        """ As RTree.search_rect. """
+        hits = self._hits(r.x, r.y, r.xx, r.yy, False)
+        if ids: return hits
+        lp = self.leaf_pool
+        return (lp[i] for i in hits)
+
+    def search_point(self, p, ids=False):
+        """ As RTree.search_point. """
+        x,y = p
+        hits = self._hits(x, y, x, y, True)
+        if ids: return hits
+        lp = self.leaf_pool
+        return (lp[i] for i in hits)
+
+    def visit_rect(self, r, fn, ids=False):
+        """ As RTree.visit_rect. """
+        n = 0
+        for o in self.search_rect(r, ids):
+            fn(o)
+            n += 1
+        return n
+
+    def visit_point(self, p, fn, ids=False):
+        """ As RTree.visit_point. """
+        n = 0
+        for o in self.search_point(p, ids):
+            fn(o)
+            n += 1
+        return n
+
+    def count(self, r=None):
+        """ As RTree.count. """
+        if r is None: return self.entries[0]
+        x,y,xx,yy = r.x,r.y,r.xx,r.yy
+        box, first, size, leafy = self.box, self.first, self.size, self.leafy
+        lb, lid, entries = self.leaf_box, self.leaf_id, self.entries
+        ex = self.exact_rects
+        n = 0
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            s = first[i]
+            inner = not leafy[i]
+            b = (box if inner else lb)[s*4:(s + size[i])*4]
+            for k in range(0, len(b), 4):
+                bx,by,bxx,byy = b[k],b[k+1],b[k+2],b[k+3]
+                if bx >= x and by >= y and bxx <= xx and byy <= yy:
+                    n += entries[s + k // 4] if inner else 1
+                elif (bxx if bxx < xx else xx) >= (bx if bx > x else x) and \
+                     (byy if byy < yy else yy) >= (by if by > y else y):
+                    if inner: stack.append(s + k // 4)
+                    else:
+                        li = lid[s + k // 4]
+                        if not (ex and li in ex) or _exact_hit(ex[li], x, y, xx, yy, True):
+                            n += 1
+        return n
+
+    def query_rects_batch(self, boxes):
+        """ As RTree.query_rects_batch (needs numpy). """
+        import numpy, vectorized
+        qs = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1,4)
+        return self._search_batch(qs, vectorized._rects_hit, False)
+
+    def query_points_batch(self, points):
+        """ As RTree.query_points_batch (needs numpy). """
+        import numpy, vectorized
+        ps = numpy.asarray(points, dtype=numpy.float64).reshape(-1,2)
+        return self._search_batch(ps, vectorized._points_hit, True)
+
+    def _search_batch(self, queries, hit_test, closed):
+        """ Level-synchronous descent, as vectorized._search, but reading
+        the blocks as they are: no CSR to build first. """
+        import numpy
+        from vectorized import _view
+        box = _view(self.box).reshape(-1,4)
+        lbox = _view(self.leaf_box).reshape(-1,4)
+        first = _view(self.first).astype(numpy.int64)
+        size = _view(self.size).astype(numpy.int64)
+        leafy = _view(self.leafy).astype(bool)
+        lid = _view(self.leaf_id)
+
+        q = numpy.arange(len(queries))
+        nodes = numpy.zeros(len(queries), dtype=numpy.int64)
+        out_q, out_l = [], []
+        while len(q):
+            cnt = size[nodes]
+            qq = numpy.repeat(q, cnt)
+            offs = numpy.arange(cnt.sum()) - numpy.repeat(numpy.cumsum(cnt) - cnt, cnt)
+            slots = numpy.repeat(first[nodes], cnt) + offs
+            lf = numpy.repeat(leafy[nodes], cnt)
+
+            lq, ls = qq[lf], slots[lf]
+            hit = hit_test(lbox[ls], queries[lq])
+            out_q.append(lq[hit])
+            out_l.append(lid[ls[hit]].astype(numpy.int64))
+
+            nq, ns = qq[~lf], slots[~lf]
+            hit = hit_test(box[ns], queries[nq])
+            q, nodes = nq[hit], ns[hit]
+
+        if not out_q:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        qi = numpy.concatenate(out_q)
+        li = numpy.concatenate(out_l)
+        boxes = queries if queries.shape[1] == 4 else numpy.hstack([ queries, queries ])
+        if self.exact_rects:
+            import rtree
+            qi,li = rtree._refine_batch(self, boxes, qi, li, closed)
+        if self.geometry is not None:
+            import geometry
+            qi,li = geometry._refine_pairs(self, boxes, qi, li)
+        order = numpy.argsort(qi, kind="mergesort")
+        return qi[order], li[order]
+
+def _exact_hit(e, x, y, xx, yy, closed):
+    w = min(e[2], xx) - max(e[0], x)
+    h = min(e[3], yy) - max(e[1], y)
+    return (w >= 0 and h >= 0) if closed else (w > 0 and h > 0)
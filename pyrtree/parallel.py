@@ -0,0 +1,125 @@
+## Parallel queries in worker processes.
+#
+# The tree is written once with RTree.share() (the RTree.save() format, in
+#  shared memory where there is some), and every worker RTree.open()s that
+#  file: the pools are mmapped, so all the processes read the same pages.
+#  Workers send back leaf ids only; they're refined against the tree's
+#  geometry store, if it has one, and turned into leaf objects here.
+
+import itertools, os
+import multiprocessing
+
+from rect import Rect
+from rtree import RTree
+
+_tree = None # the worker's own view of the shared file.
+_error = None # or why it couldn't open it.
+
+def _attach(path, split):
+    # An initializer that raises only gets the worker replaced, over and
+    #  over; so keep the error, for the tasks to raise instead.
+    global _tree, _error
+    try:
+        _tree = RTree.open(path, split=split)
+    except Exception, e:
+        _error = "%s: %s" % (type(e).__name__, e)
+
+def _ready(ignored=None):
+    if _tree is None:
+        raise RuntimeError("worker couldn't open the shared tree (%s)" % _error)
+
+def _rects(chunk):
+    _ready()
+    return [ list(_tree.search_rect(Rect(*q), ids=True)) for q in chunk ]
+
+def _points(chunk):
+    _ready()
+    return [ list(_tree.search_point(p, ids=True)) for p in chunk ]
+
+def _nearest(args):
+    k, chunk = args
+    _ready()
+    return [ [ c.first_child for c in _tree.nearest(p, k) ] for p in chunk ]
+
+class ParallelQueryExecutor(object):
+    """
+    Runs batches of queries against a read-only copy of 'tree' in a pool
+    of worker processes ('processes' of them; one per CPU by default).
+
+    Results come back as one list per query, in the order the queries
+    were given: leaf objects, or leaf_pool indices if 'ids'.  They reflect
+    the tree as it was when the executor was made (rect and point queries
+    are refined against its geometry store as it is now).  close() (or leaving a
+    with block) stops the workers and removes the shared file.
+    """
+
+    def __init__(self, tree, processes=None, chunksize=64):
+        with tree._write_lock: # the file and the snapshot must agree.
+            self.path = tree.share()
+            self.snapshot = tree.snapshot()
+        self.chunksize = chunksize
+        self.pool = None
+        try:
+            self.pool = multiprocessing.Pool(processes, _attach, (self.path, tree.split))
+            self.pool.apply(_ready) # fail now, not at the first query.
+        except:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+            os.unlink(self.path)
+            raise
+
+    def _chunks(self, qs):
+        n = self.chunksize
+        return [ qs[i:i+n] for i in range(0, len(qs), n) ]
+
+    def _run(self, fn, chunks, ids, boxes=None):
+        out = []
+        for res in self.pool.map(fn, chunks):
+            out.extend(res)
+        if boxes is not None and self.snapshot.geometry is not None:
+            out = self._refine(boxes, out)
+        if not ids:
+            lp = self.snapshot.leaf_pool
+            out = [ [ lp[i] for i in hits ] for hits in out ]
+        return out
+
+    def _refine(self, boxes, out):
+        """ Keep the hits whose shapes meet their query's box (the workers
+        only have the rects). """
+        import numpy, geometry
+        qi = numpy.repeat(numpy.arange(len(out)), [ len(h) for h in out ])
+        li = numpy.fromiter(itertools.chain.from_iterable(out), numpy.int64)
+        qi,li = geometry._refine_pairs(self.snapshot, boxes, qi, li)
+        res = [ [] for h in out ]
+        for (q,l) in zip(qi.tolist(), li.tolist()): res[q].append(l)
+        return res
+
+    def query_rects(self, rects, ids=False):
+        """ search_rect for each of 'rects' (Rects or (x,y,xx,yy) tuples). """
+        qs = [ r.coords() if hasattr(r, "coords") else tuple(r) for r in rects ]
+        return self._run(_rects, self._chunks(qs), ids, qs)
+
+    def query_points(self, points, ids=False):
+        """ search_point for each of 'points'. """
+        ps = [ tuple(p) for p in points ]
+        return self._run(_points, self._chunks(ps), ids, [ (x, y, x, y) for (x,y) in ps ])
+
+    def nearest(self, points, k=1, ids=False):
+        """ The k nearest entries to each of 'points', nearest first. """
+        chunks = [ (k, c) for c in self._chunks([ tuple(p) for p in points ]) ]
+        return self._run(_nearest, chunks, ids)
+
+    def close(self):
+        if self.pool is None: return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
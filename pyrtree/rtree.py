@@ -1,17 +1,364 @@
 ## R-tree.
 # see doc/ref/r-tree-clustering-split-algo.pdf
 
+# Defaults for the per-tree node capacities (see RTree.__init__):
 MAXCHILDREN=10
+MINCHILDREN=2 # fill that splits aim for; delete() dissolves nodes below it.
 MAX_KMEANS=5
-import math, random, sys
+import math, random, sys, os, tempfile
 import time
 import array
+import heapq
+import ctypes, mmap as _mmap, struct
+import cPickle as pickle
+import functools, itertools, threading
 
 from rect import Rect, union_all, NullRect
+from split import SplitPolicy, LinearSplit, QuadraticSplit, RStarSplit
+from cache import QueryCache
+
+SPLIT_ENGINES = ("python", "numpy")
+
+class _PoolReader(object):
+    """
+    Queries that only read the pools (rect_pool, node_pool, count_pool,
+    leaf_pool), shared by RTree and Snapshot.
+    """
+
+    # A metrics.Sink to report operations to, or None (see metrics.py).
+    metrics = None
+    # A cache.QueryCache of query_rect/query_point results, or None.
+    cache = None
+    # Exact coords of leaves whose rects float32 storage rounded, by
+    #  leaf_pool index; None unless coord_type is 'f' and exact (see RTree).
+    exact_rects = None
+    # A geometry.GeometryStore of leaf objects' exact shapes, or None.
+    geometry = None
+
+    def query_rects_batch(self, boxes):
+        """ Vectorized query_rect for many (x,y,xx,yy) boxes at once.
+
+        Needs numpy.  Returns (query_index, leaf_index) integer arrays,
+        sorted by query_index; leaf_index indexes leaf_pool.
+        """
+        import vectorized
+        qi,li = vectorized.query_rects(self, boxes)
+        if self.exact_rects: qi,li = _refine_batch(self, boxes, qi, li, False)
+        if self.geometry is not None:
+            import geometry
+            qi,li = geometry._refine_pairs(self, boxes, qi, li)
+        return qi,li
+
+    def query_points_batch(self, points):
+        """ Vectorized query_point for many (x,y) points; see query_rects_batch. """
+        import vectorized
+        qi,li = vectorized.query_points(self, points)
+        if self.exact_rects or self.geometry is not None:
+            boxes = [ (x, y, x, y) for (x,y) in points ]
+        if self.exact_rects: qi,li = _refine_batch(self, boxes, qi, li, True)
+        if self.geometry is not None:
+            import geometry
+            qi,li = geometry._refine_pairs(self, boxes, qi, li)
+        return qi,li
+
+    def search_rect(self, r, ids=False):
+        """ Like query_rect, but yields leaf objects (or leaf_pool indices,
+        if 'ids') and allocates nothing per node. """
+        npool = self.node_pool
+        hits = _hits(self, "query_rect", r.x, r.y, r.xx, r.yy, False)
+        if ids:
+            for i in hits: yield npool[i*2 + 1]
+        else:
+            lp = self.leaf_pool
+            for i in hits: yield lp[npool[i*2 + 1]]
+
+    def search_point(self, p, ids=False):
+        """ Like query_point; see search_rect. """
+        x,y = p
+        npool = self.node_pool
+        hits = _hits(self, "query_point", x, y, x, y, True)
+        if ids:
+            for i in hits: yield npool[i*2 + 1]
+        else:
+            lp = self.leaf_pool
+            for i in hits: yield lp[npool[i*2 + 1]]
+
+    def visit_rect(self, r, fn, ids=False):
+        """ Call fn(leaf object) -- or fn(leaf id), if 'ids' -- for every
+        entry intersecting 'r'.  Returns the number of hits. """
+        if self.metrics is not None or self.cache is not None or self.exact_rects \
+                or self.geometry is not None:
+            return _visit_via_hits(self, "query_rect", r.x, r.y, r.xx, r.yy, False, fn, ids)
+        return _visit_hits(self, r.x, r.y, r.xx, r.yy, False, fn, ids)
+
+    def visit_point(self, p, fn, ids=False):
+        """ Call fn for every entry containing point 'p'; see visit_rect. """
+        x,y = p
+        if self.metrics is not None or self.cache is not None or self.exact_rects \
+                or self.geometry is not None:
+            return _visit_via_hits(self, "query_point", x, y, x, y, True, fn, ids)
+        return _visit_hits(self, x, y, x, y, True, fn, ids)
+
+    def aquery_rect(self, r, ids=False, nodes=None, max_age=None):
+        """
+        query_rect for event loops, in steps: an iterator whose next()
+        expands at most 'nodes' internal nodes and returns the leaf
+        objects (or leaf_pool indices, if 'ids') found on the way.  Runs
+        on a fresh snapshot, or, given 'max_age', one up to that many
+        seconds old (see snapshot() and aio.py).
+        """
+        import aio
+        return aio.query_rect(self, r, ids, nodes or aio.NODES_PER_STEP, max_age)
+
+    def aquery_point(self, p, ids=False, nodes=None, max_age=None):
+        """ query_point in steps; see aquery_rect. """
+        import aio
+        return aio.query_point(self, p, ids, nodes or aio.NODES_PER_STEP, max_age)
+
+    def anearest(self, p, k=1, ids=False, nodes=None, max_age=None):
+        """ nearest in steps, as aquery_rect: leaf objects (or ids),
+        nearest first. """
+        import aio
+        return aio.nearest(self, p, k, ids, nodes or aio.NODES_PER_STEP, max_age)
+
+    def count(self, r=None):
+        """
+        Number of entries whose rects intersect or touch 'r' (all of them,
+        if 'r' is None).  Unlike query_rect, entries that only touch r's
+        edge count.
+
+        Uses the per-node entry counts in count_pool: a node whose rect
+        lies inside 'r' contributes its count without being descended.
+        """
+        rp = self.rect_pool
+        npool = self.node_pool
+        cp = self.count_pool
+        if r is None: return cp[0]
+        x,y,xx,yy = r.x,r.y,r.xx,r.yy
+        if self.metrics is not None: return _traced_count(self, x, y, xx, yy)
+        ex = self.exact_rects
+        n = 0
+        stack = [0]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            c = npool[pop()*2 + 1]
+            while c != 0:
+                ri = c*4
+                bx = rp[ri]
+                bxx = rp[ri+2]
+                leaf = bx > bxx
+                if leaf: bx,bxx = bxx,bx
+                by = rp[ri+1]
+                byy = rp[ri+3]
+                if bx >= x and by >= y and bxx <= xx and byy <= yy:
+                    n += cp[c]
+                elif (bxx if bxx < xx else xx) >= (bx if bx > x else x) and \
+                     (byy if byy < yy else yy) >= (by if by > y else y):
+                    if leaf:
+                        if not ex or _exact_touches(ex, npool[c*2 + 1], x, y, xx, yy): n += 1
+                    else: push(c)
+                c = npool[c*2]
+        return n
+
+    def join(self, other, predicate="intersects", ids=False):
+        """
+        Spatial join: (a, b) for every entry a of this tree and b of 'other'
+        such that predicate(a, b) holds.  Yields leaf objects, or leaf_pool
+        indices if 'ids'.  Joining a tree with itself is allowed (and
+        yields each pair both ways round, and (a, a)).
+
+        predicate: one of JOIN_PREDICATES -- "intersects" (as
+         Rect.does_intersect), "contains" (a's rect contains b's) or
+         "within" (b's rect contains a's).
+
+        Both trees are descended together (see _iter_join), so the upper
+        levels are walked once rather than once per entry.
+        """
+        if predicate not in JOIN_PREDICATES:
+            raise ValueError("unknown join predicate %r" % (predicate,))
+        na, nb = self.node_pool, other.node_pool
+        if self.metrics is not None:
+            pairs = _traced_join(self, other, predicate)
+        else:
+            pairs = _iter_join(self.rect_pool, na, other.rect_pool, nb, predicate)
+        if self.exact_rects or other.exact_rects:
+            pairs = _refine_join(self, other, pairs, predicate)
+        if ids:
+            for (a,b) in pairs: yield na[a*2 + 1], nb[b*2 + 1]
+        else:
+            la, lb = self.leaf_pool, other.leaf_pool
+            for (a,b) in pairs: yield la[na[a*2 + 1]], lb[nb[b*2 + 1]]
+
+    def analyze(self):
+        """
+        Tree quality report, from one breadth-first pass over the pools:
+
+        entries, nodes (internal ones), height (deepest leaf level).
+        levels: per level of internal nodes (the root is level 0), a dict:
+         nodes; fanout_min, fanout_mean, fanout_max; area (of the nodes);
+         overlap (area shared by pairs of siblings among their children);
+         dead_space (node area not covered by any child).
+        fanout: {children: number of nodes with that many}.
+        fill: mean fanout over max_children.
+        leaf_depth: {level: number of entries at that level}; all at one
+         level unless splits were pushed down (see SplitPolicy.propagate).
+        overlap, dead_space: totals over all levels.
+
+        Rising overlap and dead space mean queries descend more nodes than
+        they need to; a bulk_load() of the same entries is the baseline.
+        """
+        rp = self.rect_pool
+        npool = self.node_pool
+        fanout = {}
+        leaf_depth = {}
+        levels = []
+        level = [0]
+        lvl = 0
+        while level:
+            nxt = []
+            area = overlap = dead = 0.0
+            fmin = fmax = None
+            ftotal = 0
+            for idx in level:
+                boxes = []
+                leaves = 0
+                c = npool[idx*2 + 1]
+                while c != 0:
+                    ri = c*4
+                    bx = rp[ri]
+                    bxx = rp[ri+2]
+                    if bx > bxx:
+                        bx,bxx = bxx,bx
+                        leaves += 1
+                    else: nxt.append(c)
+                    boxes.append((bx, rp[ri+1], bxx, rp[ri+3]))
+                    c = npool[c*2]
+                n = len(boxes)
+                fanout[n] = fanout.get(n, 0) + 1
+                ftotal += n
+                if fmin is None or n < fmin: fmin = n
+                if fmax is None or n > fmax: fmax = n
+                if leaves: leaf_depth[lvl + 1] = leaf_depth.get(lvl + 1, 0) + leaves
+
+                covered = ov = 0.0
+                for i in range(n):
+                    x,y,xx,yy = boxes[i]
+                    covered += (xx - x) * (yy - y)
+                    for j in range(i + 1, n):
+                        bx,by,bxx,byy = boxes[j]
+                        w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+                        h = (byy if byy < yy else yy) - (by if by > y else y)
+                        if w > 0 and h > 0: ov += w * h
+                if ov > 0: covered = _union_area(boxes)
+                if n:
+                    x,y,xx,yy = _box(rp, idx)
+                    a = (xx - x) * (yy - y)
+                    area += a
+                    dead += max(a - covered, 0.0)
+                overlap += ov
+            levels.append({
+                "nodes" : len(level), "fanout_min" : fmin, "fanout_max" : fmax,
+                "fanout_mean" : ftotal / float(len(level)), "area" : area,
+                "overlap" : overlap, "dead_space" : dead })
+            level = nxt
+            lvl += 1
+
+        nodes = sum([ l["nodes"] for l in levels ])
+        children = sum([ n * k for (n,k) in fanout.items() ])
+        return {
+            "entries" : self.count_pool[0] if len(self.count_pool) else 0,
+            "nodes" : nodes,
+            "height" : max(leaf_depth) if leaf_depth else 0,
+            "levels" : levels,
+            "fanout" : fanout,
+            "fill" : children / float(nodes * self.max_children),
+            "leaf_depth" : leaf_depth,
+            "overlap" : sum([ l["overlap"] for l in levels ]),
+            "dead_space" : sum([ l["dead_space"] for l in levels ]),
+            }
 
-class RTree(object):
-    def __init__(self):
-        self.count = 0
+def _writer(method):
+    """ Decorator for RTree methods that change the tree: they hold the
+    write lock, which readers taking a snapshot() never wait on. """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._write_lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+class RTree(_PoolReader):
+    def __init__(self, split="cluster", split_engine="python",
+                 max_children=MAXCHILDREN, min_children=MINCHILDREN,
+                 max_kmeans=MAX_KMEANS, metrics=None, cache=None,
+                 coord_type='d', index_type='L', exact=True, geometry=None):
+        """
+        max_children: a node with more children than this is split.
+        min_children: the fill splits aim for, and below which delete()
+         dissolves a node; at most max_children // 2.  (When a split is
+         pushed down -- see SplitPolicy.propagate -- the node it happens
+         in is left with one child per group.)
+        max_kmeans: the clustering split tries k in [2, max_kmeans).
+
+        split: how overflowing nodes are split.  A SplitPolicy, or one of
+         the names in SPLIT_POLICIES: "cluster" (the default; k-means plus
+         silhouette scoring, see doc/ref), "linear", "quadratic", "rstar".
+        split_engine: how the "cluster" policy computes its clustering:
+         "python" (the reference implementation, below) or "numpy"
+         (vectorized.cluster_split; needs numpy).
+        metrics: a metrics.Sink that operations report to (see metrics.py);
+         None for no instrumentation.  Can be set later, as 'metrics'.
+        cache: a cache.QueryCache for query_rect/query_point results (and
+         search_* and visit_*), or a number of entries to make one with;
+         None for no caching.  Can be set later, as 'cache'.
+        geometry: a geometry.GeometryStore of exact shapes for leaf
+         objects, that query_rect/query_point hits are refined against
+         (see geometry.py); None for rects only.  Can be set later, as
+         'geometry'.  Keeping it in step with the tree is up to the caller.
+
+        coord_type: how rect_pool stores coordinates: 'd' (double) or 'f'
+         (float32, half the size).  With 'f', rects are rounded outward as
+         they come in, so every node still bounds what's under it and
+         queries see a superset; leaves that rounding changed keep their
+         exact coords in exact_rects, and hits on them are checked
+         against those.  (Cursors and walk() show the rounded rects.)
+        exact: with coord_type 'f', whether to keep exact_rects.  That
+         costs more than float32 saves when most coordinates need double
+         precision; without it, queries may also return entries that
+         miss them by less than float32 rounding.
+        index_type: how node_pool and count_pool store node indices and
+         counts: 'L' (unsigned long) or 'I' (unsigned int: 32 bits, so
+         half the size on 64-bit platforms, but at most 2**32 nodes).
+        """
+        if split_engine not in SPLIT_ENGINES:
+            raise ValueError("unknown split engine %r" % (split_engine,))
+        if max_children < 2:
+            raise ValueError("max_children must be at least 2")
+        if not (1 <= min_children <= max_children // 2):
+            raise ValueError("min_children must be in [1, max_children // 2]")
+        if max_kmeans < 3:
+            raise ValueError("max_kmeans must be at least 3")
+        if coord_type not in COORD_TYPES:
+            raise ValueError("unknown coord type %r" % (coord_type,))
+        if index_type not in INDEX_TYPES:
+            raise ValueError("unknown index type %r" % (index_type,))
+        self.max_children = max_children
+        self.min_children = min_children
+        self.max_kmeans = max_kmeans
+        self.split_engine = split_engine
+        self.metrics = metrics
+        if isinstance(cache, (int, long)): cache = QueryCache(cache)
+        self.cache = cache
+        self.geometry = geometry
+        if isinstance(split, SplitPolicy):
+            self.split = split
+        elif split == "cluster":
+            self.split = ClusterSplit(split_engine)
+        elif split in SPLIT_POLICIES:
+            self.split = SPLIT_POLICIES[split]()
+        else:
+            raise ValueError("unknown split policy %r" % (split,))
+        self.node_count = 0
         self.stats = { 
             "overflow_f" : 0,
             "avg_overflow_t_f" : 0.0,
@@ -28,37 +375,939 @@ class RTree(object):
         #  Less obviously: using object graph directly leads to really long GC
         #   pause times, too.
         # Instead, it uses pools of arrays:
-        self.count = 0
+        self.node_count = 0
         self.leaf_count = 0
-        self.rect_pool = array.array('d')
-        self.node_pool = array.array('L')
+        self.rect_pool = array.array(coord_type)
+        self.node_pool = array.array(index_type)
         self.leaf_pool = [] # leaf objects. 
+        # Entries (leaves) under each node, a leaf counting itself; see count().
+        self.count_pool = array.array(index_type)
+        self.coord_type = coord_type
+        self.exact_rects = {} if coord_type == 'f' and exact else None
+
+        # Slots given back by delete(), reused by _NodeCursor.create:
+        self.free_nodes = []
+        self.free_leaves = []
+
+        # Bumped on every change, so derived data (see vectorized.py)
+        #  knows when to rebuild:
+        self.generation = 0
+
+        # Forced reinsertion (see SplitPolicy.forced_reinsert): whether
+        #  the current insert may still do one, and what it took out.
+        self._may_reinsert = False
+        self._evicted = []
+
+        # Level of the node the last insert put its entry in (for metrics):
+        self._depth = 0
+
+        # (mmap, rect typecode, node typecode) while the pools are views
+        #  of a file from open():
+        self._mapped = None
+
+        # Snapshots (see snapshot()): the latest one, and whether it still
+        #  shares the pools, in which case the next write copies them first.
+        self._write_lock = threading.RLock()
+        self._snapshot = None
+        self._shared = False
 
         self.cursor = _NodeCursor.create(self, NullRect)
 
+    def _begin_write(self):
+        """ Called (under the write lock) before any change to the pools. """
+        self.generation += 1
+        if self._mapped is not None: self._unmap()
+        if self._shared: self._unshare()
+        self._shared = False
+
+    def _unshare(self):
+        """ Copy the pools, leaving the old ones to the last snapshot. """
+        self.rect_pool = self.rect_pool[:]
+        self.node_pool = self.node_pool[:]
+        self.count_pool = self.count_pool[:]
+        self.leaf_pool = list(self.leaf_pool)
+        if self.exact_rects is not None: self.exact_rects = dict(self.exact_rects)
+        self.cursor.rpool, self.cursor.npool = self.rect_pool, self.node_pool
+
+    def snapshot(self, max_age=None):
+        """
+        A Snapshot of the tree as it is now.  It doesn't see later
+        changes, and any number of threads can query it while one thread
+        goes on writing to the tree.
+
+        Readers don't wait for writers: while a write is in progress, this
+        returns the last snapshot taken, however many writes have finished
+        since.  (Only if none has been taken yet does it wait.)
+
+        Taking a snapshot shares the pools rather than copying them, but
+        this isn't copy-on-write by node: the first write after it copies
+        every pool whole, O(size of the tree), however little it changes.
+        A snapshot per query makes every write pay that.  So take one per
+        batch of queries, not per query; or pass 'max_age', in seconds, to
+        get the last snapshot taken if it's no older than that, even if
+        there have been writes since.  Then the pools are copied at most
+        once per max_age, at the price of views up to max_age out of date.
+        """
+        lock = self._write_lock
+        if not lock.acquire(False):
+            if self._snapshot is not None: return self._snapshot
+            lock.acquire() # nothing published yet: wait for the write.
+        try:
+            s = self._snapshot
+            if s is None or s.generation != self.generation and \
+               (max_age is None or time.time() - s.taken >= max_age):
+                s = self._snapshot = Snapshot(self)
+                self._shared = True
+            return s
+        finally:
+            lock.release()
+
+    def pack(self):
+        """
+        A packed.PackedTree of the tree as it is now: a read-only copy in
+        which each node's children (or leaf entries) are one contiguous
+        block, rather than a sibling list.  Queries on it scan slices, and
+        its batch queries need no layout built first.  Costs a pass over
+        the tree and a copy of the pools, so pack once per batch of
+        queries, not per query.
+        """
+        import packed
+        with self._write_lock:
+            return packed.PackedTree(self)
+
     def _ensure_pool(self, idx):
         if len(self.rect_pool) < (4*idx):
             self.rect_pool.extend([0,0,0,0] * idx)
             self.node_pool.extend([0,0] * idx)
+            self.count_pool.extend([0] * idx)
 
+    @classmethod
+    def bulk_load(cls, items, **kwargs):
+        """ Build a tree from a sequence of (obj, Rect) pairs.
+
+        Packs bottom-up with sort-tile-recursive (STR) grouping, so nodes
+        are filled to max_children and no splits are ever run.  Much faster
+        than calling insert() once per item on large inputs.  Keyword
+        arguments go to the constructor.
+        """
+        objs = []
+        boxes = array.array('d')
+        for (o,r) in items:
+            objs.append(o)
+            boxes.extend((r.x, r.y, r.xx, r.yy))
+        return cls.bulk_load_boxes(objs, boxes, **kwargs)
+
+    @classmethod
+    def bulk_load_boxes(cls, objs, boxes, **kwargs):
+        """ bulk_load, for entries given as a list of objects and a flat
+        sequence of their boxes (x,y,xx,yy for each, in order; an
+        array('d'), say), so that there needn't be a Rect per entry. """
+        tree = cls(**kwargs)
+        n = len(objs)
+        if len(boxes) != 4 * n:
+            raise ValueError("need 4 coordinates per object")
+        for i in range(0, 4 * n, 4): _check_width(boxes[i], boxes[i+2])
+        if not n: return tree
+
+        base = tree.node_count
+        tree.node_count += n
+        tree._ensure_pool(tree.node_count)
+
+        rp = tree.rect_pool
+        npool = tree.node_pool
+        cp = tree.count_pool
+        ex = tree.exact_rects
+        lbase = tree.leaf_count
+        level = []
+        for (i,o) in enumerate(objs):
+            idx = base + i
+            recti = idx * 4
+            x,y,xx,yy = boxes[i*4],boxes[i*4+1],boxes[i*4+2],boxes[i*4+3]
+            if tree.coord_type == 'f':
+                s = _round_out(x, y, xx, yy)
+                if s != (x, y, xx, yy):
+                    if ex is not None: ex[lbase + i] = (x, y, xx, yy)
+                    x,y,xx,yy = s
+            # Leaves are marked by storing x swapped:
+            rp[recti] = xx
+            rp[recti+1] = y
+            rp[recti+2] = x
+            rp[recti+3] = yy
+            npool[idx*2] = 0
+            npool[idx*2 + 1] = lbase + i
+            cp[idx] = 1
+            tree.leaf_pool.append(o)
+            level.append(idx)
+        tree.leaf_count += n
+
+        while len(level) > tree.max_children:
+            groups = _str_groups(rp, level, tree.max_children, tree.min_children)
+            pbase = tree.node_count
+            tree.node_count += len(groups)
+            tree._ensure_pool(tree.node_count)
+            level = []
+            for (i,g) in enumerate(groups):
+                tree._pack_node(pbase + i, g)
+                level.append(pbase + i)
+
+        tree._pack_node(0, level)
+        tree.cursor._become(0)
+        return tree
+
+    def _pack_node(self, idx, kids):
+        """ Make node 'idx' the parent of 'kids', bounding and counting them. """
+        npool = self.node_pool
+        cp = self.count_pool
+        n = 0
+        for (j,k) in enumerate(kids):
+            npool[k*2] = kids[j+1] if j + 1 < len(kids) else 0
+            n += cp[k]
+        npool[idx*2 + 1] = kids[0]
+        cp[idx] = n
+        self._refit(idx)
+
+    # Raw pool helpers: these work on node indices directly, without
+    #  going through (and disturbing) a _NodeCursor.
+    def _children(self, idx):
+        npool = self.node_pool
+        c = npool[idx*2 + 1]
+        while c != 0:
+            yield c
+            c = npool[c*2]
+
+    def _is_leaf(self, idx):
+        return self.rect_pool[idx*4] > self.rect_pool[idx*4 + 2]
+
+    def _stored_rect(self, r):
+        """ (r as it is stored, r's exact coords if that isn't r and
+        they're kept). """
+        if self.coord_type == 'd': return r, None
+        c = r.coords()
+        s = _round_out(*c)
+        if s == c: return r, None
+        return Rect(*s), (c if self.exact_rects is not None else None)
+
+    def _leaf_rect(self, idx):
+        """ The exact Rect of leaf node 'idx'. """
+        return Rect(*_exact_box(self, idx))
+
+    def _refit(self, idx):
+        """ Shrink/grow node 'idx' to exactly bound its children. """
+        rp = self.rect_pool
+        x = y = xx = yy = 0.0
+        first = True
+        for c in self._children(idx):
+            a,b,cc,d = _box(rp, c)
+            if first or a < x: x = a
+            if first or b < y: y = b
+            if first or cc > xx: xx = cc
+            if first or d > yy: yy = d
+            first = False
+        ri = idx * 4
+        rp[ri] = x
+        rp[ri+1] = y
+        rp[ri+2] = xx
+        rp[ri+3] = yy
+
+    def _recount(self):
+        """ Rebuild count_pool from scratch. """
+        cp = self.count_pool
+        order = [0]
+        for idx in order:
+            if not self._is_leaf(idx): order.extend(self._children(idx))
+        for idx in reversed(order):
+            if self._is_leaf(idx): cp[idx] = 1
+            else: cp[idx] = sum([ cp[c] for c in self._children(idx) ])
+
+    def _unlink(self, parent, child):
+        """ Cut 'child' out of the sibling chain of 'parent'. """
+        npool = self.node_pool
+        nxt = npool[child*2]
+        if npool[parent*2 + 1] == child:
+            npool[parent*2 + 1] = nxt
+            return
+        for c in self._children(parent):
+            if npool[c*2] == child:
+                npool[c*2] = nxt
+                return
+        assert(False)
+
+    def _free_node(self, idx):
+        """ Return node slot 'idx' (and its leaf slot, if any) to the free lists. """
+        if self._is_leaf(idx):
+            li = self.node_pool[idx*2 + 1]
+            self.leaf_pool[li] = None
+            self.free_leaves.append(li)
+            if self.exact_rects: self.exact_rects.pop(li, None)
+        ri = idx * 4
+        for i in range(ri, ri + 4): self.rect_pool[i] = 0.0
+        self.node_pool[idx*2] = 0
+        self.node_pool[idx*2 + 1] = 0
+        self.count_pool[idx] = 0
+        self.free_nodes.append(idx)
+
+    def _free_subtree(self, idx, orphans):
+        """ Free every node under (and including) 'idx'.
+
+        The (obj, rect) of each leaf found is appended to 'orphans' so that
+        it can be reinserted.
+        """
+        stack = [idx]
+        while stack:
+            i = stack.pop()
+            if self._is_leaf(i):
+                orphans.append((self.leaf_pool[self.node_pool[i*2 + 1]],
+                                self._leaf_rect(i)))
+            else:
+                stack.extend(self._children(i))
+            self._free_node(i)
+
+    def _find_leaf(self, o, orect):
+        """ Path of node indices from the root down to the leaf for (o, orect). """
+        r, exact = self._stored_rect(orect)
+        x,y,xx,yy = r.coords()
+        rp = self.rect_pool
+        ex = self.exact_rects
+        stack = [[0]]
+        while stack:
+            path = stack.pop()
+            for c in self._children(path[-1]):
+                cx,cy,cxx,cyy = _box(rp, c)
+                if self._is_leaf(c):
+                    if (cx == x and cy == y and cxx == xx and cyy == yy):
+                        li = self.node_pool[c*2 + 1]
+                        if ex is not None and ex.get(li) != exact: continue
+                        lo = self.leaf_pool[li]
+                        if lo is o or lo == o: return path + [c]
+                elif cx <= x and cy <= y and cxx >= xx and cyy >= yy:
+                    stack.append(path + [c])
+        return None
+
+    @_writer
+    def delete(self, o, orect):
+        """ Remove the entry 'o' that was inserted with rect 'orect'.
+
+        Ancestor rects are shrunk on the way back up; nodes left with fewer
+        than min_children children are dissolved and their leaves reinserted.
+        Freed slots go on free lists that later inserts reuse.  Returns
+        False if there was no such entry.
+        """
+        m = self.metrics
+        if m is not None: t,splits = time.time(),self.stats["overflow_f"]
+        path = self._find_leaf(o, orect)
+        if path is None:
+            if m is not None:
+                m.record("delete", { "wall_s" : time.time() - t, "found" : 0,
+                                     "splits" : 0, "reinserted" : 0 })
+            return False
+        self._begin_write()
+
+        leaf = path.pop()
+        self._unlink(path[-1], leaf)
+        self._free_node(leaf)
+        cp = self.count_pool
+        for p in path: cp[p] -= 1
+
+        orphans = []
+        for i in range(len(path) - 1, 0, -1):
+            node = path[i]
+            if len(list(self._children(node))) < self.min_children:
+                self._unlink(path[i-1], node)
+                for p in path[:i]: cp[p] -= cp[node]
+                self._free_subtree(node, orphans)
+            else:
+                self._refit(node)
+        self._refit(0)
+
+        # Don't leave a chain of single-child nodes at the top:
+        npool = self.node_pool
+        while True:
+            kids = list(self._children(0))
+            if len(kids) != 1 or self._is_leaf(kids[0]): break
+            npool[1] = npool[kids[0]*2 + 1]
+            self._free_node(kids[0])
+
+        self.cursor._become(0)
+        if self.cache is not None:
+            self.cache.invalidate(orect.x, orect.y, orect.xx, orect.yy)
+
+        # (insert() invalidates the cache for these:)
+        for (lo,lr) in orphans: self.insert(lo,lr)
+        if m is not None:
+            m.record("delete", { "wall_s" : time.time() - t, "found" : 1,
+                                 "splits" : self.stats["overflow_f"] - splits,
+                                 "reinserted" : len(orphans) })
+        return True
+
+    @_writer
+    def update(self, o, orect, nrect):
+        """
+        Move the entry 'o', inserted with rect 'orect', to 'nrect'.
+
+        If its node's rect still bounds nrect, only the leaf's rect is
+        rewritten (and ancestors shrunk, where that lets them).  Otherwise
+        the leaf is taken out and routed back in from the lowest ancestor
+        bounding nrect, rather than from the root.  A node that leaves
+        under min_children is dissolved, and its other leaves routed back
+        in the same way -- unless its parent would be left short too (where
+        delete() would dissolve whole subtrees): then the leaf stays, and
+        its ancestors are stretched to fit.  Returns False if there was no
+        such entry.
+        """
+        _check_width(nrect.x, nrect.xx)
+        m = self.metrics
+        if m is not None: t,splits = time.time(),self.stats["overflow_f"]
+        path = self._find_leaf(o, orect)
+        if path is None:
+            if m is not None:
+                m.record("update", { "wall_s" : time.time() - t, "found" : 0,
+                                     "in_place" : 0, "splits" : 0 })
+            return False
+        self._begin_write()
+        if self.cache is not None:
+            for r in (orect, nrect): self.cache.invalidate(r.x, r.y, r.xx, r.yy)
+
+        rp = self.rect_pool
+        r, exact = self._stored_rect(nrect)
+        x,y,xx,yy = r.coords()
+        leaf = path.pop()
+        parent = path[-1]
+        px,py,pxx,pyy = _box(rp, parent)
+        in_place = px <= x and py <= y and pxx >= xx and pyy >= yy
+        mc = self.min_children
+        dissolve = parent != 0 and len(list(self._children(parent))) <= mc
+        if not in_place and dissolve and path[-2] != 0:
+            in_place = len(list(self._children(path[-2]))) <= mc
+        if in_place:
+            ri = leaf * 4
+            rp[ri] = xx # leaf: x swapped.
+            rp[ri+1] = y
+            rp[ri+2] = x
+            rp[ri+3] = yy
+            ex = self.exact_rects
+            if ex is not None:
+                li = self.node_pool[leaf*2 + 1]
+                if exact is not None: ex[li] = exact
+                else: ex.pop(li, None)
+            self._refit_path(path)
+        else:
+            self._unlink(parent, leaf)
+            self._free_node(leaf)
+            cp = self.count_pool
+            for p in path: cp[p] -= 1
+            orphans = []
+            if dissolve:
+                path.pop()
+                self._unlink(path[-1], parent)
+                for p in path: cp[p] -= cp[parent]
+                self._free_subtree(parent, orphans)
+            self._refit_path(path)
+            self._reroute(path, [(o, nrect)] + orphans)
+            if self.cache is not None:
+                for (lo,lr) in orphans: self.cache.invalidate(lr.x, lr.y, lr.xx, lr.yy)
+        self.cursor._become(0)
+        if m is not None:
+            m.record("update", { "wall_s" : time.time() - t, "found" : 1,
+                                 "in_place" : int(in_place),
+                                 "splits" : self.stats["overflow_f"] - splits })
+        return True
+
+    def _reroute(self, path, entries):
+        """ _route each (obj, Rect) of 'entries' from the lowest node on
+        'path' (from the root) whose rect bounds it, then balance. """
+        rp = self.rect_pool
+        cp = self.count_pool
+        deferred = {}
+        try:
+            for (o,r) in entries:
+                x,y,xx,yy = self._stored_rect(r)[0].coords()
+                k = len(path) - 1
+                while k > 0:
+                    bx,by,bxx,byy = _box(rp, path[k])
+                    if bx <= x and by <= y and bxx >= xx and byy >= yy: break
+                    k -= 1
+                for p in path[:k]: cp[p] += 1
+                self._route(o, r.x, r.y, r.xx, r.yy, deferred, path[:k+1])
+        finally:
+            self._settle(deferred)
+
+    def _refit_path(self, path):
+        """ Refit the nodes on 'path', bottom up, until one doesn't change. """
+        rp = self.rect_pool
+        for idx in reversed(path):
+            ri = idx * 4
+            before = rp[ri:ri+4]
+            self._refit(idx)
+            if rp[ri:ri+4] == before: break
+
+    @_writer
+    def compact(self):
+        """
+        Rewrite the pools in breadth-first order, sized to fit.  Every node
+        and leaf slot is renumbered: siblings end up next to each other and
+        each level follows the one above it, the slots on the free lists
+        (and the pools' spare room) are given back, and leaf_pool loses
+        its holes.  Returns the number of node slots reclaimed.
+
+        Leaf ids (leaf_pool indices) change, so ids from earlier queries
+        are no longer valid; the query cache is cleared.
+        """
+        self._begin_write()
+        m = self.metrics
+        if m is not None: t = time.time()
+        rp, npool, cp = self.rect_pool, self.node_pool, self.count_pool
+        order = [0]
+        for idx in order:
+            if idx == 0 or rp[idx*4] <= rp[idx*4 + 2]: # not a leaf
+                order.extend(self._children(idx))
+        new = dict([ (idx, i) for (i,idx) in enumerate(order) ])
+        n = len(order)
+
+        nrp = array.array(_typecode(rp), [0]) * (4*n)
+        nnp = array.array(_typecode(npool), [0]) * (2*n)
+        ncp = array.array(_typecode(cp), [0]) * n
+        lp, ex = self.leaf_pool, self.exact_rects
+        nlp, nex = [], ({} if ex is not None else None)
+        for (i,idx) in enumerate(order):
+            ri, ni = idx*4, i*4
+            nrp[ni:ni+4] = rp[ri:ri+4]
+            ncp[i] = cp[idx]
+            nnp[i*2] = new[npool[idx*2]] if npool[idx*2] else 0
+            fc = npool[idx*2 + 1]
+            if idx != 0 and rp[ri] > rp[ri+2]:
+                nnp[i*2 + 1] = len(nlp)
+                if ex and fc in ex: nex[len(nlp)] = ex[fc]
+                nlp.append(lp[fc])
+            else:
+                nnp[i*2 + 1] = new[fc] if fc else 0
+
+        reclaimed = self.node_count - n
+        self.rect_pool, self.node_pool, self.count_pool = nrp, nnp, ncp
+        self.leaf_pool, self.exact_rects = nlp, nex
+        self.node_count, self.leaf_count = n, len(nlp)
+        self.free_nodes, self.free_leaves = [], []
+        self.cursor.rpool, self.cursor.npool = nrp, nnp
+        self.cursor._become(0)
+        if self.cache is not None: self.cache.clear()
+        if m is not None:
+            m.record("compact", { "wall_s" : time.time() - t,
+                                  "nodes" : n, "reclaimed" : reclaimed })
+        return reclaimed
+
+    @_writer
     def insert(self,o, orect):
-        self.cursor.insert(o,orect)
+        _check_width(orect.x, orect.xx)
+        self._begin_write()
+        m = self.metrics
+        if m is not None: t,splits = time.time(),self.stats["overflow_f"]
+        self._may_reinsert = self.split.forced_reinsert
+        try:
+            self.cursor.insert(o,orect)
+        finally:
+            self._may_reinsert = False
         assert(self.cursor.index == 0)
+        depth = self._depth
+
+        evicted,self._evicted = self._evicted,[]
+        for (lo,lr) in evicted: self.cursor.insert(lo,lr)
+        if self.cache is not None:
+            # The evicted entries got new leaf nodes, so results naming
+            #  the old ones go too.
+            for r in [orect] + [ lr for (lo,lr) in evicted ]:
+                self.cache.invalidate(r.x, r.y, r.xx, r.yy)
+        if m is not None:
+            m.record("insert", { "wall_s" : time.time() - t, "depth" : depth,
+                                 "splits" : self.stats["overflow_f"] - splits,
+                                 "reinserted" : len(evicted) })
+
+    @_writer
+    def insert_many(self, items):
+        """ Insert a batch of (obj, Rect) pairs.
+
+        Each entry is routed down to a leaf-holding node as insert() would,
+        but no node is split until the whole batch is in: then each one
+        that overflowed is split once, into as many groups as it needs.
+        """
+        items = list(items)
+        for (o,r) in items: _check_width(r.x, r.xx)
+        self._begin_write()
+        m = self.metrics
+        if m is not None: t,splits,n = time.time(),self.stats["overflow_f"],self.count()
+        deferred = {}
+        cache = self.cache
+        try:
+            for (o,r) in items:
+                self._route(o, r.x, r.y, r.xx, r.yy, deferred)
+                if cache is not None: cache.invalidate(r.x, r.y, r.xx, r.yy)
+        finally:
+            self._settle(deferred)
+            self.cursor._become(0)
+        if m is not None:
+            m.record("insert_many", { "wall_s" : time.time() - t,
+                                      "entries" : self.count() - n,
+                                      "splits" : self.stats["overflow_f"] - splits })
+
+    @_writer
+    def insert_boxes(self, objs, boxes):
+        """ insert_many, for entries given as bulk_load_boxes takes them: no
+        Rect per entry.  Reports "insert_many". """
+        if len(boxes) != 4 * len(objs):
+            raise ValueError("need 4 coordinates per object")
+        for i in range(0, len(boxes), 4): _check_width(boxes[i], boxes[i+2])
+        self._begin_write()
+        m = self.metrics
+        if m is not None: t,splits,n = time.time(),self.stats["overflow_f"],self.count()
+        deferred = {}
+        cache = self.cache
+        try:
+            for (i,o) in enumerate(objs):
+                x,y,xx,yy = boxes[i*4],boxes[i*4+1],boxes[i*4+2],boxes[i*4+3]
+                self._route(o, x, y, xx, yy, deferred)
+                if cache is not None: cache.invalidate(x, y, xx, yy)
+        finally:
+            self._settle(deferred)
+            self.cursor._become(0)
+        if m is not None:
+            m.record("insert_many", { "wall_s" : time.time() - t,
+                                      "entries" : self.count() - n,
+                                      "splits" : self.stats["overflow_f"] - splits })
+
+    def _route(self, o, lx, ly, lxx, lyy, deferred, start=None):
+        """
+        The first half of an insert, on the raw pools: walk down to a
+        leaf-holding node (growing rects and counts on the way, choosing
+        children as _NodeCursor.insert does), and add the leaf there.  The
+        node isn't balanced; it goes into 'deferred', mapped to its path.
+
+        'start', if given, is a path from the root to walk down from
+        instead; the nodes above its last are left as they are.
+        """
+        rp = self.rect_pool
+        npool = self.node_pool
+        cp = self.count_pool
+        exact = None
+        if self.coord_type == 'f':
+            s = _round_out(lx, ly, lxx, lyy)
+            if s != (lx, ly, lxx, lyy):
+                if self.exact_rects is not None: exact = (lx, ly, lxx, lyy)
+                lx,ly,lxx,lyy = s
+        path = list(start or [0])
+        idx = path.pop()
+        while True:
+            cp[idx] += 1
+            ri = idx * 4
+            fc = npool[idx*2 + 1]
+            if fc == 0:
+                rp[ri] = lx
+                rp[ri+1] = ly
+                rp[ri+2] = lxx
+                rp[ri+3] = lyy
+            else:
+                if lx < rp[ri]: rp[ri] = lx
+                if ly < rp[ri+1]: rp[ri+1] = ly
+                if lxx > rp[ri+2]: rp[ri+2] = lxx
+                if lyy > rp[ri+3]: rp[ri+3] = lyy
+            if fc == 0 or rp[fc*4] > rp[fc*4 + 2]:
+                break
+            # The child needing the least enlargement:
+            child = 0
+            minarea = -1.0
+            c = fc
+            while c != 0:
+                ci = c*4
+                x,y,xx,yy = rp[ci],rp[ci+1],rp[ci+2],rp[ci+3]
+                nx = x if x < lx else lx
+                nxx = xx if xx > lxx else lxx
+                ny = y if y < ly else ly
+                nyy = yy if yy > lyy else lyy
+                a = (nxx - nx) * (nyy - ny) - (xx - x) * (yy - y)
+                if minarea < 0 or a < minarea:
+                    minarea = a
+                    child = c
+                c = npool[c*2]
+            path.append(idx)
+            idx = child
+
+        if self.free_nodes:
+            leaf = self.free_nodes.pop()
+        else:
+            leaf = self.node_count
+            self.node_count += 1
+            self._ensure_pool(leaf + 1)
+        if self.free_leaves:
+            li = self.free_leaves.pop()
+            self.leaf_pool[li] = o
+        else:
+            li = self.leaf_count
+            self.leaf_count += 1
+            self.leaf_pool.append(o)
+        if exact is not None: self.exact_rects[li] = exact
+        ri = leaf * 4
+        rp[ri] = lxx # leaf: x swapped.
+        rp[ri+1] = ly
+        rp[ri+2] = lx
+        rp[ri+3] = lyy
+        npool[leaf*2] = npool[idx*2 + 1]
+        npool[leaf*2 + 1] = li
+        npool[idx*2 + 1] = leaf
+        cp[leaf] = 1
+        deferred[idx] = path
+
+    def _settle(self, deferred):
+        """ Balance the overflowing nodes in 'deferred' (node index ->
+        ancestor path), deepest first.  Splits that propagate land in the
+        parents, which are then balanced once, a level up. """
+        c = self.cursor
+        m = self.max_children
+        while deferred:
+            depth = max([ len(p) for p in deferred.values() ])
+            level = [ (i,p) for (i,p) in deferred.items() if len(p) == depth ]
+            for (i,p) in level:
+                del deferred[i]
+                if len(list(self._children(i))) <= m: continue
+                c._become(i)
+                c._balance(p, upward=False)
+                if p and len(list(self._children(p[-1]))) > m:
+                    deferred[p[-1]] = p[:-1]
+
+    def nearest(self, p, k=1):
+        """ Leaves closest to point 'p', nearest first (at most k of them;
+        all of them if k is None).
+
+        Best-first search: a node is only expanded once it is the closest
+        thing left on the queue, so results stream lazily and taking just
+        the first one is cheap.
+        """
+        px,py = p
+        rp = self.rect_pool
+        ex = self.exact_rects
+        t = time.time()
+        heap = [(0.0, 0, False, 0)] # (distance, node, is leaf, level)
+        found = visited = tested = depth = 0
+        try:
+            while heap and (k is None or found < k):
+                d,idx,leaf,lvl = heapq.heappop(heap)
+                if leaf:
+                    found += 1
+                    yield self._cursor_at(idx)
+                    continue
+                visited += 1
+                if lvl > depth: depth = lvl
+                for c in self._children(idx):
+                    leaf = self._is_leaf(c)
+                    if leaf: tested += 1
+                    x,y,xx,yy = _exact_box(self, c) if leaf and ex else _box(rp, c)
+                    dx = x - px if px < x else (px - xx if px > xx else 0.0)
+                    dy = y - py if py < y else (py - yy if py > yy else 0.0)
+                    heapq.heappush(heap, (dx*dx + dy*dy, c, leaf, lvl + 1))
+        finally:
+            if self.metrics is not None:
+                self.metrics.record("nearest", {
+                    "wall_s" : time.time() - t, "nodes_visited" : visited,
+                    "leaves_tested" : tested, "leaves_returned" : found,
+                    "depth" : depth })
+
+    def _cursor_at(self, idx):
+        c = _NodeCursor(self,0,NullRect,0,0)
+        c._become(idx)
+        return c
+
+    def save(self, path):
+        """ Write the tree to 'path' in the format read by RTree.open(). """
+        n = self.node_count
+        rp, npool, cp = self.rect_pool, self.node_pool, self.count_pool
+        rbytes = 4 * n * rp.itemsize
+        nbytes = 2 * n * npool.itemsize
+        cbytes = n * cp.itemsize
+        roff = _HEADER.size + _SETTINGS.size
+        noff = roff + rbytes
+        loff = noff + nbytes + cbytes
+        f = open(path, "wb")
+        try:
+            f.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION,
+                                 sys.byteorder == "big",
+                                 _typecode(rp), _typecode(npool),
+                                 rp.itemsize, npool.itemsize,
+                                 n, self.leaf_count, roff, noff, loff))
+            f.write(_SETTINGS.pack(self.max_children, self.min_children,
+                                   self.max_kmeans, _split_name(self.split)))
+            f.write(buffer(rp, 0, rbytes))
+            f.write(buffer(npool, 0, nbytes))
+            f.write(buffer(cp, 0, cbytes))
+            table = (self.leaf_pool, self.free_nodes, self.free_leaves)
+            if self.exact_rects is not None: table += (self.exact_rects,)
+            pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def share(self, dir=None):
+        """ save() the tree to a new file for other processes to open(),
+        in shared memory (/dev/shm) where there is some, else in 'dir' or
+        the temp directory.  Returns the path; removing it is up to the
+        caller.  See parallel.ParallelQueryExecutor. """
+        if dir is None and os.path.isdir("/dev/shm"): dir = "/dev/shm"
+        fd,path = tempfile.mkstemp(prefix="pyrtree-", dir=dir)
+        os.close(fd)
+        try:
+            with self._write_lock: self.save(path)
+        except:
+            os.unlink(path)
+            raise
+        return path
 
+    @classmethod
+    def open(cls, path, mmap=True, **kwargs):
+        """ Load a tree written by save().
+
+        With 'mmap', the pools are not read in: they are views straight
+        onto a private (copy-on-write) mmap of the file, so opening is
+        cheap and pages are shared between processes that open the same
+        file.  The first change to the tree copies the pools into
+        ordinary arrays.  Without it, they're read into ordinary arrays
+        to begin with.  Other keyword arguments go to the constructor.
+
+        The leaf object table is unpickled, and unpickling can run
+        arbitrary code: never open an index file from an untrusted source.
+
+        The tree's max_children, min_children, max_kmeans and split policy
+        come from the file (version 3 on); keyword arguments that say
+        otherwise are refused.  A tree saved with a split policy not in
+        SPLIT_POLICIES needs it passed again, as 'split'.
+        """
+        f = open(path, "rb")
+        try:
+            if mmap: mm = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_COPY)
+            else: mm = f.read()
+        finally:
+            f.close()
+
+        (magic, version, big, rtype, ntype, rsize, nsize,
+         n, leaf_count, roff, noff, loff) = _HEADER.unpack(mm[:_HEADER.size])
+        if magic != _MAGIC:
+            raise ValueError("%s: not a pyrtree index" % path)
+        if version not in (1, 2, _FORMAT_VERSION):
+            raise ValueError("%s: unsupported format version %d" % (path, version))
+        if bool(big) != (sys.byteorder == "big") or \
+           ctypes.sizeof(_CTYPES[rtype]) != rsize or \
+           ctypes.sizeof(_CTYPES[ntype]) != nsize:
+            raise ValueError("%s: written on an incompatible platform" % path)
+
+        if version >= 3:
+            mc, minc, mk, split = _SETTINGS.unpack(mm[_HEADER.size:roff])
+            saved = { "max_children" : mc, "min_children" : minc, "max_kmeans" : mk }
+            split = split.rstrip("\0")
+            if split: saved["split"] = split
+            elif "split" not in kwargs:
+                raise ValueError("%s: saved with a custom split policy; pass it as split" % path)
+            for (k,v) in saved.items():
+                given = kwargs.setdefault(k, v)
+                if isinstance(given, SplitPolicy): given = _split_name(given)
+                if given != v:
+                    raise ValueError("%s: saved with %s=%r, not %r" % (path, k, v, given))
+
+        tree = cls(**kwargs)
+        tree.node_count = n
+        tree.leaf_count = leaf_count
+        coff = noff + 2*n*nsize
+        if mmap:
+            tree.rect_pool = (_CTYPES[rtype] * (4*n)).from_buffer(mm, roff)
+            tree.node_pool = (_CTYPES[ntype] * (2*n)).from_buffer(mm, noff)
+            if version >= 2:
+                tree.count_pool = (_CTYPES[ntype] * n).from_buffer(mm, coff)
+            tree._mapped = (mm, rtype, ntype)
+        else:
+            tree.rect_pool = array.array(rtype, mm[roff:noff])
+            tree.node_pool = array.array(ntype, mm[noff:coff])
+            if version >= 2:
+                tree.count_pool = array.array(ntype, mm[coff:coff + n*nsize])
+        if version < 2:
+            tree.count_pool = array.array(ntype, [0] * n)
+        table = pickle.loads(mm[loff:])
+        tree.leaf_pool, tree.free_nodes, tree.free_leaves = table[:3]
+        tree.coord_type = rtype
+        tree.exact_rects = table[3] if len(table) > 3 else None
+        tree.cursor = _NodeCursor(tree,0,NullRect,0,0)
+        tree.cursor._become(0)
+        if version < 2: tree._recount()
+        return tree
+
+    def _unmap(self):
+        """ Swap mmap-backed pools for ordinary (growable) arrays. """
+        mm, rtype, ntype = self._mapped
+        rp = array.array(rtype)
+        rp.fromstring(buffer(self.rect_pool))
+        npool = array.array(ntype)
+        npool.fromstring(buffer(self.node_pool))
+        cp = self.count_pool
+        if not isinstance(cp, array.array):
+            cp = array.array(ntype)
+            cp.fromstring(buffer(self.count_pool))
+        self.rect_pool, self.node_pool, self.count_pool = rp, npool, cp
+        self._mapped = None
+        self.cursor.rpool, self.cursor.npool = rp, npool
+
+    # Queries.  These run on the raw pools (see _iter_hits below) rather
+    #  than through _NodeCursor.walk; only hits get a cursor.
     def query_rect(self, r):
-        for x in self.cursor.query_rect(r): yield x
+        """ Leaf cursors for entries that intersect with 'r'. """
+        for i in _hits(self, "query_rect", r.x, r.y, r.xx, r.yy, False):
+            yield self._cursor_at(i)
+
     def query_point(self, p):
-        for x in self.cursor.query_point(p): yield x
+        """ Leaf cursors for entries that contain point 'p'. """
+        x,y = p
+        for i in _hits(self, "query_point", x, y, x, y, True):
+            yield self._cursor_at(i)
+
     def walk(self,pred):
-        return self.cursor.walk(pred)
+        """ Pre-order walk, yielding nodes for which pred(cursor, leaf_obj)
+        holds and descending only below those.
+
+        Iterative, with a single cursor that is moved from node to node;
+        don't hold on to it past the next step.
+        """
+        c = _NodeCursor(self,0,NullRect,0,0)
+        stack = [0]
+        while stack:
+            c._become(stack.pop())
+            if not pred(c, c.leaf_obj()): continue
+            yield c
+            if not c.is_leaf():
+                kids = list(self._children(c.index))
+                kids.reverse()
+                stack.extend(kids)
+
+class Snapshot(_PoolReader):
+    """
+    An immutable read view of an RTree, from RTree.snapshot().  It has the
+    queries that run on the pools alone (search_*, visit_*, count, join,
+    the batch queries, the stepped aquery_*/anearest) and analyze(), and
+    is safe to use from any thread.
+    """
+    def __init__(self, tree):
+        self.generation = tree.generation
+        self.taken = time.time()
+        self.node_count = tree.node_count
+        self.leaf_count = tree.leaf_count
+        self.rect_pool = tree.rect_pool
+        self.node_pool = tree.node_pool
+        self.count_pool = tree.count_pool
+        self.leaf_pool = tree.leaf_pool
+        self.metrics = tree.metrics
+        self.max_children = tree.max_children
+        self.exact_rects = tree.exact_rects
+        self.geometry = tree.geometry
 
 class _NodeCursor(object):
     @classmethod
     def create(cls, rooto, rect):
-        idx = rooto.count
-        rooto.count += 1
-        
-        rooto._ensure_pool(idx + 1)
+        if rooto.free_nodes:
+            idx = rooto.free_nodes.pop()
+        else:
+            idx = rooto.node_count
+            rooto.node_count += 1
+            rooto._ensure_pool(idx + 1)
+        rooto.count_pool[idx] = 0
         #rooto.node_pool.extend([0,0])
         #rooto.rect_pool.extend([0,0,0,0])
 
@@ -78,16 +1327,22 @@ class _NodeCursor(object):
         return nc
 
     @classmethod
-    def create_leaf(cls, rooto, leaf_obj, leaf_rect):
+    def create_leaf(cls, rooto, leaf_obj, leaf_rect, exact=None):
         rect = Rect(leaf_rect.x,leaf_rect.y,leaf_rect.xx,leaf_rect.yy)
         rect.swapped_x = True # Mark as leaf by setting the xswap flag.
         res = _NodeCursor.create(rooto, rect)
         idx = res.index
-        res.first_child = rooto.leaf_count
-        rooto.leaf_count += 1
+        if rooto.free_leaves:
+            res.first_child = rooto.free_leaves.pop()
+            rooto.leaf_pool[res.first_child] = leaf_obj
+        else:
+            res.first_child = rooto.leaf_count
+            rooto.leaf_count += 1
+            rooto.leaf_pool.append(leaf_obj)
+        if exact is not None: rooto.exact_rects[res.first_child] = exact
         res.next_sibling = 0
-        rooto.leaf_pool.append(leaf_obj)
         res._save_back()
+        rooto.count_pool[idx] = 1
         res._become(idx)
         assert(res.is_leaf())
         return res
@@ -195,14 +1450,19 @@ class _NodeCursor(object):
 
     def insert(self, leafo, leafrect):
         index = self.index
+        path = [] # ancestors, for splits that propagate upwards.
+        cp = self.root.count_pool
+        leafrect, exact = self.root._stored_rect(leafrect)
 
         # tail recursion, made into loop:
         while True:
+            cp[self.index] += 1
             if self.holds_leaves():
                 self.rect = self.rect.union(leafrect)
-                self._insert_child(_NodeCursor.create_leaf(self.root,leafo,leafrect))
+                self._insert_child(_NodeCursor.create_leaf(self.root,leafo,leafrect,exact))
+                self.root._depth = len(path)
 
-                self._balance()
+                self._balance(path)
                 
                 # done: become the original again
                 self._become(index)
@@ -222,7 +1482,7 @@ class _NodeCursor(object):
                     nxx = xx if xx > lxx else lxx
                     ny = y if y < ly else ly
                     nyy = yy if yy > lyy else lyy
-                    a = (nxx - nx) * (nyy - ny)
+                    a = (nxx - nx) * (nyy - ny) - (xx - x) * (yy - y)
                     if minarea < 0 or a < minarea:
                         minarea = a
                         child = c.index
@@ -230,10 +1490,20 @@ class _NodeCursor(object):
 
                 self.rect = self.rect.union(leafrect)
                 self._save_back()
+                path.append(self.index)
                 self._become(child) # recurse.
             
-    def _balance(self):
-        if (self.nchildren() <= MAXCHILDREN):
+    def _balance(self, path=(), upward=True):
+        """ Split this node if it has overflowed.
+
+        'path' is its ancestors, root first.  Policies with 'propagate'
+        set (the classic ones) split the node into siblings, which may in
+        turn overflow the parent -- that is balanced next, unless not
+        'upward'.  Otherwise, and always at the top of the path, the
+        groups are pushed down a level instead: they become new children
+        of this node.
+        """
+        if (self.nchildren() <= self.root.max_children):
             return
 
 
@@ -243,14 +1513,26 @@ class _NodeCursor(object):
 
         s_children = [ c.lift() for c in self.children() ]
 
-        memo = {}
-
-        clusterings = [ k_means_cluster(self.root,k,s_children) for k in range(2,MAX_KMEANS) ]
-        score,bestcluster = max( [ (silhouette_coeff(c,memo),c) for c in clusterings ])
+        policy = self.root.split
+        if self.root._may_reinsert and self.holds_leaves():
+            out = policy.pick_reinsert(self.root, s_children)
+            if out:
+                self.root._may_reinsert = False
+                self._evict(out, path)
+                return
 
-        nodes = [ _NodeCursor.create_with_children(c,self.root) for c in bestcluster if len(c) > 0]
+        groups = self._partition(policy, s_children)
 
-        self._set_children(nodes)
+        if policy.propagate and path:
+            # This node keeps the first group; the others become its
+            #  siblings.
+            self.rect = union_all(groups[0])
+            self._set_children(groups[0])
+            siblings = [ _NodeCursor.create_with_children(c,self.root) for c in groups[1:] ]
+        else:
+            nodes = [ _NodeCursor.create_with_children(c,self.root) for c in groups ]
+            self._set_children(nodes)
+            siblings = []
         
         dur = (time.clock() - t)
         c = float(self.root.stats["overflow_f"]) 
@@ -258,15 +1540,68 @@ class _NodeCursor(object):
         self.root.stats["avg_overflow_t_f"] = (dur / (c + 1.0)) + (c * oa / (c + 1.0))
         self.root.stats["overflow_f"] += 1
         self.root.stats["longest_overflow"] = max(self.root.stats["longest_overflow"], dur)
-            
+        if self.root.metrics is not None:
+            self.root.metrics.record("split", { "cpu_s" : dur, "groups" : len(groups),
+                                                "children" : len(s_children) })
+
+        if siblings:
+            self._become(path[-1])
+            for n in siblings: self._insert_child(n)
+            if upward: self._balance(path[:-1])
+        elif len(groups) > self.root.max_children:
+            self._balance(path, upward) # too many groups to push down.
+
+    def _partition(self, policy, nodes):
+        """ Split 'nodes' with 'policy', and split the groups again, until
+        every group fits in a node.  (A node that got a batch of entries
+        -- see RTree.insert_many -- can be several nodes' worth.) """
+        m = self.root.max_children
+        out, todo = [], [nodes]
+        while todo:
+            g = todo.pop()
+            if len(g) <= m:
+                out.append(g)
+                continue
+            if len(g) > 2 * m:
+                # Too big for the policy (the quadratic and clustering
+                #  splits get slow); tile it as bulk_load does, leaving
+                #  some room in each group for the inserts that follow.
+                byidx = dict([ (c.index, c) for c in g ])
+                runs = _str_groups(self.rpool, list(byidx), m - m // 4,
+                                   self.root.min_children)
+                out.extend([ [ byidx[i] for i in r ] for r in runs ])
+                continue
+            parts = [ p for p in policy.split(self.root, g, self.root.min_children) if p ]
+            if len(parts) < 2:
+                h = len(g) // 2
+                parts = [ g[:h], g[h:] ]
+            todo.extend(reversed(parts))
+        return out
+
+    def _evict(self, leaves, path):
+        """ Take 'leaves' out, to be inserted again once the current insert
+        is done (forced reinsertion).  'path' is this node's ancestors. """
+        root = self.root
+        for p in path: root.count_pool[p] -= len(leaves)
+        root.count_pool[self.index] -= len(leaves)
+        for c in leaves:
+            root._unlink(self.index, c.index)
+            root._evicted.append((c.leaf_obj(), root._leaf_rect(c.index)))
+            root._free_node(c.index)
+        root._refit(self.index)
+        self._become(self.index)
+
     def _set_children(self, cs):
         self.first_child = 0
+        cp = self.root.count_pool
+        cp[self.index] = 0
 
         if 0 == len(cs): 
             return
 
         pred = None
         for c in cs:
+            cp[self.index] += cp[c.index]
             if pred is not None: 
                 pred.next_sibling = c.index
                 pred._save_back()
@@ -306,6 +1641,471 @@ class _NodeCursor(object):
         self.next_sibling = ns
         self.rect = r
 
+# On-disk format (see RTree.save): a header, then the raw rect, node and
+#  count pools in native byte order, then the pickled leaf table.  (The
+#  count pool has the node pool's type.  Version 1 files have no count
+#  pool; open() rebuilds it.)  From version 3 the header is followed by
+#  the tree's settings: max_children, min_children, max_kmeans, and the
+#  split policy's name in SPLIT_POLICIES (empty for any other policy).
+_MAGIC = "PYRTREE\0"
+_FORMAT_VERSION = 3
+_HEADER = struct.Struct("<8sBBccBB2xQQQQQ")
+_SETTINGS = struct.Struct("<III16s")
+_CTYPES = { 'd' : ctypes.c_double, 'f' : ctypes.c_float,
+            'L' : ctypes.c_ulong, 'I' : ctypes.c_uint }
+COORD_TYPES = ('d', 'f')
+INDEX_TYPES = ('L', 'I')
+
+_F32 = struct.Struct("f")
+_U32 = struct.Struct("I")
+
+def _f32_step(f, up):
+    """ The float32 next to float32 'f', upwards or downwards. """
+    if f == 0.0: return _F32.unpack(_U32.pack(1))[0] * (1 if up else -1)
+    u = _U32.unpack(_F32.pack(f))[0]
+    u += 1 if (f > 0) == up else -1
+    return _F32.unpack(_U32.pack(u))[0]
+
+def _round_out(x, y, xx, yy):
+    """ (x,y,xx,yy) rounded outward to float32 values: down for the low
+    corner, up for the high one. """
+    out = []
+    for (v, up) in ((x, False), (y, False), (xx, True), (yy, True)):
+        f = _F32.unpack(_F32.pack(v))[0] # nearest.
+        if (f < v) if up else (f > v): f = _f32_step(f, up)
+        out.append(f)
+    return tuple(out)
+
+def _typecode(pool):
+    if isinstance(pool, array.array): return pool.typecode
+    for (tc,ct) in _CTYPES.items():
+        if pool._type_ is ct: return tc
+
+def _check_width(x, xx):
+    """ Leaves are marked by storing x swapped, so a leaf's box must have
+    xx > x; writers check before they change anything. """
+    if not xx > x: # (NaNs fail too.)
+        raise ValueError("box has no width (x=%r, xx=%r): entries need xx > x" % (x, xx))
+
+def _box(rp, idx):
+    """ Normalized (x,y,xx,yy) of node 'idx', read straight from the pool. """
+    ri = idx * 4
+    x,xx = rp[ri],rp[ri+2]
+    if x > xx: x,xx = xx,x # leaf: x was swapped.
+    return x,rp[ri+1],xx,rp[ri+3]
+
+def _exact_box(tree, idx):
+    """ _box, but for a leaf whose rect float32 storage rounded, its
+    exact coords. """
+    ex = tree.exact_rects
+    if ex:
+        e = ex.get(tree.node_pool[idx*2 + 1])
+        if e is not None: return e
+    return _box(tree.rect_pool, idx)
+
+def _exact_touches(ex, li, x, y, xx, yy):
+    """ Whether leaf 'li' touches (x,y,xx,yy), going by its exact rect
+    if it has one in 'ex' (else it's taken to, the caller having
+    checked the stored one). """
+    e = ex.get(li)
+    return e is None or (e[0] <= xx and e[2] >= x and e[1] <= yy and e[3] >= y)
+
+def _refine(tree, hits, x, y, xx, yy, closed):
+    """ Drop the leaf node indices in 'hits' whose exact rects miss the
+    query (see RTree, coord_type). """
+    npool = tree.node_pool
+    ex = tree.exact_rects
+    for c in hits:
+        e = ex.get(npool[c*2 + 1])
+        if e is not None:
+            bx,by,bxx,byy = e
+            w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+            h = (byy if byy < yy else yy) - (by if by > y else y)
+            if not ((w >= 0 and h >= 0) if closed else (w > 0 and h > 0)): continue
+        yield c
+
+def _refine_batch(tree, boxes, qi, li, closed):
+    """ _refine for the (query index, leaf index) arrays of the batch
+    queries. """
+    import numpy
+    ex = tree.exact_rects
+    keep = numpy.ones(len(li), dtype=bool)
+    get = ex.get
+    es = [ get(l) for l in li.tolist() ]
+    js = [ j for (j,e) in enumerate(es) if e is not None ]
+    if not js: return qi, li
+    e = numpy.fromiter(itertools.chain.from_iterable([ es[j] for j in js ]),
+                       numpy.float64, 4 * len(js)).reshape(-1,4)
+    q = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1,4)[qi[js]]
+    w = numpy.minimum(e[:,2], q[:,2]) - numpy.maximum(e[:,0], q[:,0])
+    h = numpy.minimum(e[:,3], q[:,3]) - numpy.maximum(e[:,1], q[:,1])
+    keep[js] = ((w >= 0) & (h >= 0)) if closed else ((w > 0) & (h > 0))
+    return qi[keep], li[keep]
+
+def _union_area(boxes):
+    """ Area covered by (x,y,xx,yy) boxes that may overlap: a sweep over
+    the slabs between their x edges, merging the y spans in each. """
+    xs = sorted(set([ b[0] for b in boxes ] + [ b[2] for b in boxes ]))
+    total = 0.0
+    for i in range(len(xs) - 1):
+        x0,x1 = xs[i],xs[i+1]
+        spans = sorted([ (y,yy) for (x,y,xx,yy) in boxes if x <= x0 and xx >= x1 ])
+        cover = 0.0
+        lo = hi = None
+        for (y,yy) in spans:
+            if hi is None or y > hi:
+                if hi is not None: cover += hi - lo
+                lo,hi = y,yy
+            elif yy > hi: hi = yy
+        if hi is not None: cover += hi - lo
+        total += cover * (x1 - x0)
+    return total
+
+def _iter_hits(rp, npool, x, y, xx, yy, closed):
+    """
+    Leaf node indices whose rects overlap (x,y,xx,yy).  If 'closed', touching
+    counts (a point query); otherwise the overlap must have area, as in
+    Rect.does_intersect.
+
+    This is the query engine: an explicit stack of node indices, and the
+    four coords compared inline straight out of the pool.  No Rects, no
+    cursors, no nested generators.
+    """
+    stack = [0]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        c = npool[pop()*2 + 1]
+        while c != 0:
+            ri = c*4
+            bx = rp[ri]
+            bxx = rp[ri+2]
+            leaf = bx > bxx
+            if leaf: bx,bxx = bxx,bx
+            w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+            by = rp[ri+1]
+            byy = rp[ri+3]
+            h = (byy if byy < yy else yy) - (by if by > y else y)
+            if (w >= 0 and h >= 0) if closed else (w > 0 and h > 0):
+                if leaf: yield c
+                else: push(c)
+            c = npool[c*2]
+
+def _hits(tree, event, x, y, xx, yy, closed):
+    """ _iter_hits on tree's pools; cached and/or traced if it has a cache
+    or a metrics sink (cache hits aren't reported to the sink), refined
+    against exact_rects if it has any, and then against its geometry
+    store if it has one (after the cache: shapes can change under it). """
+    if tree.cache is not None:
+        key = (closed, x, y, xx, yy)
+        res = tree.cache.get(key)
+        if res is None:
+            res = tuple(_uncached_hits(tree, event, x, y, xx, yy, closed))
+            tree.cache.put(key, res)
+    else:
+        res = _uncached_hits(tree, event, x, y, xx, yy, closed)
+    if tree.geometry is not None:
+        import geometry
+        res = geometry._refine_hits(tree, res, x, y, xx, yy)
+    return res
+
+def _uncached_hits(tree, event, x, y, xx, yy, closed):
+    if tree.metrics is None:
+        hits = _iter_hits(tree.rect_pool, tree.node_pool, x, y, xx, yy, closed)
+    else:
+        hits = _traced_hits(tree, event, x, y, xx, yy, closed)
+    if tree.exact_rects: hits = _refine(tree, hits, x, y, xx, yy, closed)
+    return hits
+
+def _traced_hits(tree, event, x, y, xx, yy, closed):
+    """ _iter_hits, counting as it goes, and reporting 'event' at the end. """
+    rp = tree.rect_pool
+    npool = tree.node_pool
+    t = time.time()
+    visited = tested = returned = depth = 0
+    stack = [(0, 0)]
+    try:
+        while stack:
+            idx, lvl = stack.pop()
+            visited += 1
+            if lvl > depth: depth = lvl
+            c = npool[idx*2 + 1]
+            while c != 0:
+                ri = c*4
+                bx = rp[ri]
+                bxx = rp[ri+2]
+                leaf = bx > bxx
+                if leaf:
+                    bx,bxx = bxx,bx
+                    tested += 1
+                w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+                by = rp[ri+1]
+                byy = rp[ri+3]
+                h = (byy if byy < yy else yy) - (by if by > y else y)
+                if (w >= 0 and h >= 0) if closed else (w > 0 and h > 0):
+                    if leaf:
+                        returned += 1
+                        yield c
+                    else: stack.append((c, lvl + 1))
+                c = npool[c*2]
+    finally:
+        tree.metrics.record(event, {
+            "wall_s" : time.time() - t, "nodes_visited" : visited,
+            "leaves_tested" : tested, "leaves_returned" : returned,
+            "depth" : depth })
+
+def _visit_via_hits(tree, event, x, y, xx, yy, closed, fn, ids):
+    """ _visit_hits, by way of _hits (for the cache and metrics). """
+    npool = tree.node_pool
+    lp = tree.leaf_pool
+    n = 0
+    for c in _hits(tree, event, x, y, xx, yy, closed):
+        li = npool[c*2 + 1]
+        fn(li if ids else lp[li])
+        n += 1
+    return n
+
+def _traced_count(tree, x, y, xx, yy):
+    """ _PoolReader.count, counting as it goes; reports "count". """
+    rp = tree.rect_pool
+    npool = tree.node_pool
+    cp = tree.count_pool
+    ex = tree.exact_rects
+    t = time.time()
+    n = visited = tested = depth = 0
+    stack = [(0, 0)]
+    while stack:
+        idx, lvl = stack.pop()
+        visited += 1
+        if lvl > depth: depth = lvl
+        c = npool[idx*2 + 1]
+        while c != 0:
+            ri = c*4
+            bx = rp[ri]
+            bxx = rp[ri+2]
+            leaf = bx > bxx
+            if leaf:
+                bx,bxx = bxx,bx
+                tested += 1
+            by = rp[ri+1]
+            byy = rp[ri+3]
+            if bx >= x and by >= y and bxx <= xx and byy <= yy:
+                n += cp[c]
+            elif (bxx if bxx < xx else xx) >= (bx if bx > x else x) and \
+                 (byy if byy < yy else yy) >= (by if by > y else y):
+                if leaf:
+                    if not ex or _exact_touches(ex, npool[c*2 + 1], x, y, xx, yy): n += 1
+                else: stack.append((c, lvl + 1))
+            c = npool[c*2]
+    tree.metrics.record("count", {
+        "wall_s" : time.time() - t, "nodes_visited" : visited,
+        "leaves_tested" : tested, "leaves_returned" : n, "depth" : depth })
+    return n
+
+def _visit_hits(tree, x, y, xx, yy, closed, fn, ids):
+    """ _iter_hits, calling fn on each hit instead of yielding it. """
+    rp = tree.rect_pool
+    npool = tree.node_pool
+    lp = tree.leaf_pool
+    n = 0
+    stack = [0]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        c = npool[pop()*2 + 1]
+        while c != 0:
+            ri = c*4
+            bx = rp[ri]
+            bxx = rp[ri+2]
+            leaf = bx > bxx
+            if leaf: bx,bxx = bxx,bx
+            w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+            by = rp[ri+1]
+            byy = rp[ri+3]
+            h = (byy if byy < yy else yy) - (by if by > y else y)
+            if (w >= 0 and h >= 0) if closed else (w > 0 and h > 0):
+                if leaf:
+                    li = npool[c*2 + 1]
+                    fn(li if ids else lp[li])
+                    n += 1
+                else: push(c)
+            c = npool[c*2]
+    return n
+
+JOIN_PREDICATES = ("intersects", "contains", "within")
+
+def _join_side(rp, npool, idx, box, closed):
+    """
+    One side of a node pair in _iter_join: (index, is_leaf, x,y,xx,yy) for
+    each child of 'idx' that overlaps 'box' (the other side's rect; None
+    for no filter).  A leaf stands for itself.
+    """
+    ri = idx * 4
+    if idx and rp[ri] > rp[ri+2]:
+        return [ (idx, True) + _box(rp, idx) ]
+    out = []
+    c = npool[idx*2 + 1]
+    while c != 0:
+        ri = c*4
+        bx = rp[ri]
+        bxx = rp[ri+2]
+        leaf = bx > bxx
+        if leaf: bx,bxx = bxx,bx
+        by = rp[ri+1]
+        byy = rp[ri+3]
+        if box is None:
+            out.append((c, leaf, bx, by, bxx, byy))
+        else:
+            x,y,xx,yy = box
+            w = (bxx if bxx < xx else xx) - (bx if bx > x else x)
+            h = (byy if byy < yy else yy) - (by if by > y else y)
+            if (w >= 0 and h >= 0) if closed else (w > 0 and h > 0):
+                out.append((c, leaf, bx, by, bxx, byy))
+        c = npool[c*2]
+    return out
+
+def _iter_join(rpa, npa, rpb, npb, predicate, stats=None):
+    """
+    (leaf index in a, leaf index in b) for leaf pairs satisfying
+    'predicate' (see RTree.join).  If 'stats' is given (a dict, see
+    _traced_join), node pairs expanded, leaf pairs tested and the deepest
+    level reached are added up in it.
+
+    Synchronized traversal: a stack of node pairs whose rects overlap.
+    Each pair is expanded by crossing the children of both sides (a leaf
+    side stays as it is until the other reaches leaf level too), keeping
+    only the child pairs that overlap in turn.  Each side's children are
+    first cut down to those overlapping the other side's rect.
+    """
+    closed = predicate != "intersects" # containment can be on the edge.
+    contains = predicate == "contains"
+    within = predicate == "within"
+    stack = [(0, None, 0, None, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        a, abox, b, bbox, lvl = pop()
+        ea = _join_side(rpa, npa, a, bbox, closed)
+        if not ea: continue
+        eb = _join_side(rpb, npb, b, abox, closed)
+        if stats is not None:
+            stats["nodes_visited"] += 1
+            stats["leaves_tested"] += len([ e for e in ea if e[1] ]) * \
+                                      len([ e for e in eb if e[1] ])
+            if lvl > stats["depth"]: stats["depth"] = lvl
+        for (ca, la, ax, ay, axx, ayy) in ea:
+            for (cb, lb, bx, by, bxx, byy) in eb:
+                w = (bxx if bxx < axx else axx) - (bx if bx > ax else ax)
+                h = (byy if byy < ayy else ayy) - (by if by > ay else ay)
+                if not ((w >= 0 and h >= 0) if closed else (w > 0 and h > 0)):
+                    continue
+                if la and lb:
+                    if contains and not (ax <= bx and ay <= by and
+                                         axx >= bxx and ayy >= byy):
+                        continue
+                    if within and not (bx <= ax and by <= ay and
+                                       bxx >= axx and byy >= ayy):
+                        continue
+                    yield ca, cb
+                else:
+                    push((ca, (ax, ay, axx, ayy), cb, (bx, by, bxx, byy), lvl + 1))
+
+def _refine_join(a, b, pairs, predicate):
+    """ Drop the pairs from _iter_join that fail 'predicate' on their
+    exact rects (see RTree, coord_type).  Outward rounding keeps both
+    overlap and containment, so _iter_join misses nothing. """
+    for (ca, cb) in pairs:
+        ax,ay,axx,ayy = _exact_box(a, ca)
+        bx,by,bxx,byy = _exact_box(b, cb)
+        if predicate == "contains":
+            ok = ax <= bx and ay <= by and axx >= bxx and ayy >= byy
+        elif predicate == "within":
+            ok = bx <= ax and by <= ay and bxx >= axx and byy >= ayy
+        else:
+            ok = min(axx, bxx) > max(ax, bx) and min(ayy, byy) > max(ay, by)
+        if ok: yield ca, cb
+
+def _traced_join(a, b, predicate):
+    """ _iter_join with stats; reports "join" when done. """
+    t = time.time()
+    stats = { "nodes_visited" : 0, "leaves_tested" : 0, "leaves_returned" : 0,
+              "depth" : 0 }
+    try:
+        for pair in _iter_join(a.rect_pool, a.node_pool, b.rect_pool, b.node_pool,
+                               predicate, stats):
+            stats["leaves_returned"] += 1
+            yield pair
+    finally:
+        stats["wall_s"] = time.time() - t
+        a.metrics.record("join", stats)
+
+def _str_groups(rp, idxs, m, min_fill=1):
+    """ Sort-tile-recursive grouping of node indices into runs of at most m.
+
+    Sorts by center x, cuts into sqrt(#groups) vertical slabs, then sorts
+    each slab by center y and cuts it into runs.  A short last run in a
+    slab borrows from the one before it to reach min_fill.
+    """
+    ngroups = int(math.ceil(len(idxs) / float(m)))
+    slab = int(math.ceil(math.sqrt(ngroups))) * m
+
+    # (centers doubled: the sum is the same whether or not x is swapped)
+    xs = sorted(idxs, key=lambda i: rp[i*4] + rp[i*4 + 2])
+    groups = []
+    for s in range(0, len(xs), slab):
+        col = sorted(xs[s:s+slab], key=lambda i: rp[i*4 + 1] + rp[i*4 + 3])
+        runs = [ col[g:g+m] for g in range(0, len(col), m) ]
+        if len(runs) > 1 and len(runs[-1]) < min_fill:
+            short = min_fill - len(runs[-1])
+            runs[-1] = runs[-2][-short:] + runs[-1]
+            runs[-2] = runs[-2][:-short]
+        groups.extend(runs)
+    return groups
+
+class ClusterSplit(SplitPolicy):
+    """
+    The clustering split (doc/ref/r-tree-clustering-split-algo.pdf): runs
+    k-means for k in [2, tree.max_kmeans) and keeps the clustering with the
+    best silhouette coefficient.  'engine' is "python" or "numpy".
+
+    Clusterings with a group smaller than the minimum fill are passed
+    over; if every one of them has such a group, the quadratic split is
+    used instead.
+    """
+
+    propagate = False
+
+    def __init__(self, engine="python"):
+        self.engine = engine
+
+    def split(self, tree, nodes, min_fill):
+        if self.engine == "numpy":
+            import vectorized
+            res = vectorized.cluster_split(tree, nodes, tree.max_kmeans, min_fill)
+        else:
+            memo = {}
+            clusterings = [ k_means_cluster(tree,k,nodes) for k in range(2,tree.max_kmeans) ]
+            scored = [ (silhouette_coeff(c,memo),c) for c in clusterings
+                       if min([ len(g) for g in c ]) >= min_fill ]
+            res = max(scored)[1] if scored else None
+
+        if res is None:
+            return QuadraticSplit().split(tree, nodes, min_fill)
+        return res
+
+SPLIT_POLICIES = {
+    "cluster" : ClusterSplit,
+    "linear" : LinearSplit,
+    "quadratic" : QuadraticSplit,
+    "rstar" : RStarSplit,
+    }
+
+def _split_name(policy):
+    """ The name 'policy' goes by in SPLIT_POLICIES, or "". """
+    for (name, cls) in SPLIT_POLICIES.items():
+        if type(policy) is cls: return name
+    return ""
+
 def avg_diagonals(node, onodes, memo_tab):
     nidx = node.index
     sv = 0.0
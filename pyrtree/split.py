@@ -0,0 +1,196 @@
+## Node split policies.
+#
+# When a node overflows, _NodeCursor._balance hands its children (as
+#  cursors) to the tree's split policy, which partitions them into groups;
+#  each group becomes a new node (see SplitPolicy.propagate for where).
+#
+# The clustering split from doc/ref/r-tree-clustering-split-algo.pdf
+#  (rtree.ClusterSplit) is the default.  This module has the classic ones:
+#  Guttman's linear and quadratic splits, and the R*-tree split.
+
+class SplitPolicy(object):
+    """ Base class for split policies. """
+
+    # If true, an overflowing node is split into siblings under its parent
+    #  (and the split can carry on up the tree), as in Guttman's R-tree.
+    #  If false, the groups are pushed down to become new children of the
+    #  overflowing node, as the clustering split does.
+    propagate = True
+
+    # If true, the first overflow of a leaf-holding node during an insert
+    #  is handled by pick_reinsert() instead of a split.
+    forced_reinsert = False
+
+    def split(self, tree, nodes, min_fill):
+        """
+        Partition 'nodes' (child cursors of an overflowing node) into a
+        list of two or more groups.  Groups should have at least
+        'min_fill' members where that's possible.
+        """
+        raise NotImplementedError
+
+    def pick_reinsert(self, tree, nodes):
+        """ The subset of 'nodes' to take out and insert again. """
+        return []
+
+def _bbox(boxes, idxs):
+    x = y = xx = yy = None
+    for i in idxs:
+        a,b,c,d = boxes[i]
+        if x is None or a < x: x = a
+        if y is None or b < y: y = b
+        if xx is None or c > xx: xx = c
+        if yy is None or d > yy: yy = d
+    return x,y,xx,yy
+
+def _union(r, o):
+    return (r[0] if r[0] < o[0] else o[0], r[1] if r[1] < o[1] else o[1],
+            r[2] if r[2] > o[2] else o[2], r[3] if r[3] > o[3] else o[3])
+
+def _area(r):
+    return (r[2] - r[0]) * (r[3] - r[1])
+
+def _margin(r):
+    return (r[2] - r[0]) + (r[3] - r[1])
+
+def _overlap(r, o):
+    w = min(r[2], o[2]) - max(r[0], o[0])
+    h = min(r[3], o[3]) - max(r[1], o[1])
+    if w <= 0 or h <= 0: return 0.0
+    return w * h
+
+def _groups(nodes, idx_groups):
+    return [ [ nodes[i] for i in g ] for g in idx_groups ]
+
+class _GuttmanSplit(SplitPolicy):
+    """ Shared part of the linear and quadratic splits: pick two seeds,
+    then hand out the rest one at a time to the group it enlarges least. """
+
+    def split(self, tree, nodes, min_fill):
+        boxes = [ n.rect.coords() for n in nodes ]
+        m = max(1, min(min_fill, len(nodes) // 2))
+        s1,s2 = self.pick_seeds(boxes)
+        g1,g2 = [s1],[s2]
+        b1,b2 = boxes[s1],boxes[s2]
+        rest = [ i for i in range(len(boxes)) if i != s1 and i != s2 ]
+        while rest:
+            # A group that needs all of what's left to reach m gets it:
+            if len(g1) + len(rest) <= m:
+                g1.extend(rest)
+                break
+            if len(g2) + len(rest) <= m:
+                g2.extend(rest)
+                break
+            i = self.pick_next(boxes, rest, b1, b2)
+            rest.remove(i)
+            u1,u2 = _union(b1, boxes[i]),_union(b2, boxes[i])
+            d1 = _area(u1) - _area(b1)
+            d2 = _area(u2) - _area(b2)
+            if (d1,_area(b1),len(g1)) <= (d2,_area(b2),len(g2)):
+                g1.append(i)
+                b1 = u1
+            else:
+                g2.append(i)
+                b2 = u2
+        return _groups(nodes, [g1,g2])
+
+    def pick_next(self, boxes, rest, b1, b2):
+        return rest[0]
+
+class LinearSplit(_GuttmanSplit):
+    """ Guttman's linear-cost split. """
+
+    def pick_seeds(self, boxes):
+        n = len(boxes)
+        best = None
+        for axis in (0,1):
+            lo,hi = axis,axis+2
+            # The pair with the greatest separation along this axis,
+            #  normalized by the width of the whole set:
+            high_low = max(range(n), key=lambda i: boxes[i][lo])
+            low_high = min([ i for i in range(n) if i != high_low ],
+                           key=lambda i: boxes[i][hi])
+            width = (max([ b[hi] for b in boxes ]) -
+                     min([ b[lo] for b in boxes ]))
+            sep = boxes[high_low][lo] - boxes[low_high][hi]
+            if width > 0: sep = sep / width
+            if best is None or sep > best[0]: best = (sep, low_high, high_low)
+        return best[1],best[2]
+
+class QuadraticSplit(_GuttmanSplit):
+    """ Guttman's quadratic-cost split. """
+
+    def pick_seeds(self, boxes):
+        # The pair that would waste the most area in one node:
+        best = None
+        for i in range(len(boxes)):
+            for j in range(i+1, len(boxes)):
+                d = (_area(_union(boxes[i], boxes[j])) -
+                     _area(boxes[i]) - _area(boxes[j]))
+                if best is None or d > best[0]: best = (d, i, j)
+        return best[1],best[2]
+
+    def pick_next(self, boxes, rest, b1, b2):
+        # The entry with the strongest preference for one group:
+        a1,a2 = _area(b1),_area(b2)
+        best = None
+        for i in rest:
+            d1 = _area(_union(b1, boxes[i])) - a1
+            d2 = _area(_union(b2, boxes[i])) - a2
+            if best is None or abs(d1 - d2) > best[0]: best = (abs(d1 - d2), i)
+        return best[1]
+
+class RStarSplit(SplitPolicy):
+    """
+    The R*-tree split: choose the axis whose candidate distributions have
+    the smallest total margin, then the distribution along it with the
+    least overlap (then least total area).
+
+    With reinsert=True, the first overflow of a leaf-holding node in each
+    insert instead takes out the 'reinsert_fraction' of its entries
+    farthest from its center, and inserts them again.
+    """
+
+    def __init__(self, reinsert=False, reinsert_fraction=0.3):
+        self.forced_reinsert = reinsert
+        self.reinsert_fraction = reinsert_fraction
+
+    def split(self, tree, nodes, min_fill):
+        boxes = [ n.rect.coords() for n in nodes ]
+        n = len(boxes)
+        m = max(1, min(min_fill, n // 2))
+
+        best_axis = None
+        for axis in (0,1):
+            margins = 0.0
+            dists = []
+            # (sorted by lower, then by upper edge)
+            for key in (axis, axis+2):
+                order = sorted(range(n), key=lambda i: boxes[i][key])
+                pre = [ boxes[order[0]] ]
+                for i in order[1:]: pre.append(_union(pre[-1], boxes[i]))
+                suf = [ boxes[order[-1]] ]
+                for i in reversed(order[:-1]): suf.append(_union(suf[-1], boxes[i]))
+                suf.reverse()
+                for k in range(m, n - m + 1):
+                    a,b = pre[k-1],suf[k]
+                    margins += _margin(a) + _margin(b)
+                    dists.append((_overlap(a,b), _area(a) + _area(b), order, k))
+            if best_axis is None or margins < best_axis[0]:
+                best_axis = (margins, dists)
+
+        ignored,ignored,order,k = min(best_axis[1], key=lambda d: (d[0],d[1]))
+        return _groups(nodes, [ order[:k], order[k:] ])
+
+    def pick_reinsert(self, tree, nodes):
+        if not self.forced_reinsert: return []
+        boxes = [ n.rect.coords() for n in nodes ]
+        x,y,xx,yy = _bbox(boxes, range(len(boxes)))
+        cx,cy = (x + xx) * 0.5, (y + yy) * 0.5
+        def dist(b):
+            dx = (b[0] + b[2]) * 0.5 - cx
+            dy = (b[1] + b[3]) * 0.5 - cy
+            return dx*dx + dy*dy
+        p = max(1, int(round(self.reinsert_fraction * len(nodes))))
+        far = sorted(range(len(nodes)), key=lambda i: dist(boxes[i]), reverse=True)
+        return [ nodes[i] for i in far[:p] ]
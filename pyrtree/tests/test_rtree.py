@@ -5,13 +5,21 @@ if __name__ == "__main__":
     sys.path.append(os.path.abspath(os.path.join(mypath, "../../")))
 
 from pyrtree import Rect, RTree
+from pyrtree.split import LinearSplit, QuadraticSplit, RStarSplit
+from pyrtree import rtree
 #from pyrtree.rect import *
 
 import collections
 import unittest as ut
-import random, math
+import random, math, copy
+import os, tempfile, threading, array
 from testutil import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def rr():
     return random.uniform(0.0,10.0)
 
@@ -180,6 +188,10 @@ class RTreeTest(ut.TestCase):
         for c in node.children():
             assert r.does_contain(c.rect)
 
+        cp = node.root.count_pool
+        self.assertEquals(cp[idx], sum([ (1 if c.is_leaf() else cp[c.index])
+                                         for c in node.children() ]))
+
         self.assertEquals(idx,node.index)
 
         for c in node.children():
@@ -261,6 +273,1197 @@ class RTreeTest(ut.TestCase):
             rres = list([r.leaf_obj() for r in rt.query_rect(orect)])
             self.assertFalse(x in rres)
 
+    def testBulkLoad(self):
+        xs = [ TstO(r) for r in take(500, G.rect, 0.5) ]
+        bt = RTree.bulk_load([ (x,x.rect) for x in xs ])
+        self.invariants(bt)
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+
+        ws = [ w.leaf_obj() for w in bt.walk(lambda w,y: True) if w.is_leaf() ]
+        self.assertEquals(sorted(map(id,ws)), sorted(map(id,xs)))
+
+        for i in range(100):
+            q = G.rect(2.0)
+            a = set([ r.leaf_obj() for r in bt.query_rect(q) ]) - set([None])
+            b = set([ r.leaf_obj() for r in rt.query_rect(q) ]) - set([None])
+            self.assertEquals(a,b)
+            p = G.pointInside(q)
+            a = set([ r.leaf_obj() for r in bt.query_point(p) ]) - set([None])
+            b = set([ r.leaf_obj() for r in rt.query_point(p) ]) - set([None])
+            self.assertEquals(a,b)
+
+        # and it keeps working as an ordinary tree afterwards:
+        more = [ TstO(r) for r in take(50, G.rect, 0.5) ]
+        for x in more: bt.insert(x,x.rect)
+        self.invariants(bt)
+
+    def testDelete(self):
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+
+        gone, kept = xs[:200], xs[200:]
+        for x in gone:
+            self.assertTrue(rt.delete(x,x.rect))
+            self.invariants(rt)
+        self.assertFalse(rt.delete(gone[0],gone[0].rect))
+
+        ws = [ w.leaf_obj() for w in rt.walk(lambda w,y: True) if w.is_leaf() ]
+        self.assertEquals(sorted(map(id,ws)), sorted(map(id,kept)))
+        for x in kept:
+            res = [ r.leaf_obj() for r in rt.query_point(G.pointInside(x.rect)) ]
+            self.assertTrue(x in res)
+
+        # Churn reuses freed slots instead of growing the pools:
+        nodes, leaves = rt.node_count, rt.leaf_count
+        for x in gone[:100]: rt.insert(x,x.rect)
+        self.invariants(rt)
+        self.assertEquals(rt.leaf_count, leaves)
+        self.assertTrue(rt.node_count <= nodes + 20)
+
+    def testUpdate(self):
+        from pyrtree.metrics import HistogramSink
+        for kw in ({}, { "coord_type" : 'f' }, { "split" : "rstar" }):
+            xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+            sink = HistogramSink()
+            rt = RTree(metrics=sink, cache=64, **kw)
+            for x in xs: rt.insert(x,x.rect)
+            q = G.rect(3.0)
+            list(rt.search_rect(q)) # cached; updates must invalidate it.
+
+            for step in (0.01, 0.3, 5.0): # mostly in place .. mostly not.
+                for x in xs:
+                    dx, dy = random.uniform(-step, step), random.uniform(-step, step)
+                    r = x.rect
+                    nr = Rect(r.x + dx, r.y + dy, r.xx + dx, r.yy + dy)
+                    self.assertTrue(rt.update(x, r, nr))
+                    x.rect = nr
+                self.invariants(rt)
+                self.assertEquals(rt.count(), len(xs))
+                self.assertEquals(set(rt.search_rect(q)),
+                                  set([ x for x in xs if x.rect.does_intersect(q) ]))
+                for x in xs[::10]:
+                    self.assertTrue(x in rt.search_point(G.pointInside(x.rect)))
+            self.assertFalse(rt.update(xs[0], G.rect(), G.rect()))
+            self.assertEquals(rt.leaf_count, len(xs)) # leaf slots are reused.
+
+            h = sink.histogram("update", "in_place")
+            self.assertEquals(h.count, 3 * len(xs) + 1)
+            self.assertTrue(0 < h.total < 3 * len(xs))
+            for x in xs: # (with float32, by the exact rect as well)
+                self.assertTrue(rt._find_leaf(x, x.rect) is not None)
+
+    def testZeroWidth(self):
+        # Leaves are flagged by their x, so a box with no width can't be
+        #  stored; it's refused before anything is written.
+        items = [ (i, Rect(i, 0, i + 1, 1)) for i in range(8) ]
+        pt = ("pt", Rect(3.5, 0.5, 3.5, 0.5))
+        self.assertRaises(ValueError, RTree.bulk_load, items + [pt])
+        self.assertRaises(ValueError, RTree.bulk_load_boxes, [0, 1],
+                          array.array('d', [0, 0, 1, 1, 2, 0, 2, 1]))
+
+        rt = RTree.bulk_load(items)
+        self.assertRaises(ValueError, rt.insert, pt[0], pt[1])
+        self.assertRaises(ValueError, rt.insert_many, items[:3] + [pt])
+        self.assertRaises(ValueError, rt.insert_boxes, ["a", "b", "c"],
+                          array.array('d', [0, 0, 1, 1, 2, 0, 2, 1, 4, 0, 5, 1]))
+        self.assertRaises(ValueError, rt.update, 3, items[3][1], pt[1])
+        self.assertEquals(rt.count(), len(items))
+        self.assertEquals(sorted(rt.search_point((3.5, 0.5))), [3])
+
+    def testInsertMany(self):
+        xs = [ TstO(r) for r in take(600, G.rect, 0.5) ]
+        for split in ("cluster", "linear", "rstar"):
+            rt = RTree(split=split)
+            rt.insert_many([ (x,x.rect) for x in xs[:20] ])
+            self.invariants(rt)
+            rt.insert_many((x,x.rect) for x in xs[20:500])
+            for x in xs[500:550]: rt.insert(x,x.rect)
+            rt.insert_many([ (x,x.rect) for x in xs[550:] ])
+            rt.insert_many([])
+            self.invariants(rt)
+            fs,root = self.fanouts(rt)
+            self.assertTrue(max(fs + [root]) <= rt.max_children)
+            self.assertEquals(rt.count(), len(xs))
+            for x in xs:
+                self.assertTrue(x in rt.search_point(G.pointInside(x.rect)))
+
+            # Deletes free slots; a batch reuses them:
+            for x in xs[:100]: rt.delete(x,x.rect)
+            leaves = rt.leaf_count
+            rt.insert_many([ (x,x.rect) for x in xs[:100] ])
+            self.invariants(rt)
+            self.assertEquals(rt.leaf_count, leaves)
+            q = G.rect(3.0)
+            self.assertEquals(set(rt.search_rect(q)),
+                              set([ x for x in xs if x.rect.does_intersect(q) ]))
+
+    def testDeleteAll(self):
+        xs = [ TstO(r) for r in take(50, G.rect) ]
+        rt = RTree.bulk_load([ (x,x.rect) for x in xs ])
+        for x in xs: self.assertTrue(rt.delete(x,x.rect))
+        self.invariants(rt)
+        self.assertEquals(rt.cursor.nchildren(), 0)
+        self.assertEquals(list(rt.query_rect(G.rect())), [])
+
+    def testNearest(self):
+        def dist(p, r):
+            dx = max(r.x - p[0], 0.0, p[0] - r.xx)
+            dy = max(r.y - p[1], 0.0, p[1] - r.yy)
+            return dx*dx + dy*dy
+
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+
+        self.assertEquals(list(RTree().nearest((1.0,1.0), 3)), [])
+        for i in range(50):
+            p = (random.uniform(-5.0,15.0), random.uniform(-5.0,15.0))
+            res = [ c.leaf_obj() for c in rt.nearest(p, 10) ]
+            self.assertEquals(len(res), 10)
+            ds = [ dist(p, x.rect) for x in res ]
+            self.assertEquals(ds, sorted(ds))
+            self.assertEquals(ds, sorted([ dist(p, x.rect) for x in xs ])[:10])
+
+        self.assertEquals(len(list(rt.nearest((0.0,0.0), None))), len(xs))
+
+    def testAsyncSteps(self):
+        from pyrtree import aio
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree(coord_type='f')
+        for x in xs: rt.insert(x,x.rect)
+        s = rt.snapshot()
+        # The whole extent: every internal node, so many steps of 2.
+        steps = list(aio._rect_steps(s, -1.0, -1.0, 30.0, 30.0, False, 2))
+        self.assertTrue(len(steps) > 1)
+        self.assertEquals(sorted(sum(steps, [])), sorted(rt.search_rect(Rect(-1, -1, 30, 30), ids=True)))
+        for i in range(20):
+            q = G.rect(3.0)
+            steps = list(aio._rect_steps(s, q.x, q.y, q.xx, q.yy, False, 2))
+            self.assertEquals(sorted(sum(steps, [])),
+                              sorted(rt.search_rect(q, ids=True)))
+            p = G.pointInside(xs[i].rect)
+            steps = list(aio._rect_steps(s, p[0], p[1], p[0], p[1], True, 1))
+            self.assertEquals(sorted(sum(steps, [])),
+                              sorted(rt.search_point(p, ids=True)))
+            steps = list(aio._nearest_steps(s, p[0], p[1], 10, 1))
+            self.assertEquals(sum(steps, []),
+                              [ c.first_child for c in rt.nearest(p, 10) ])
+
+    def testAsync(self):
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+        q = G.rect(5.0)
+        p = G.pointInside(xs[0].rect)
+        everything = Rect(-1, -1, 30, 30)
+        steps = list(rt.aquery_rect(everything, nodes=1))
+        self.assertTrue(len(steps) > 1)
+        self.assertEquals(set(sum(steps, [])), set(xs))
+        steps = list(rt.aquery_rect(q, nodes=1))
+        self.assertEquals(set(sum(steps, [])), set(rt.search_rect(q)))
+        self.assertEquals(set(sum(rt.aquery_point(p), [])), set(rt.search_point(p)))
+        self.assertEquals(sum(rt.anearest(p, 5, ids=True), []),
+                          [ c.first_child for c in rt.nearest(p, 5) ])
+
+        # Queries run on a snapshot...
+        expect = set(rt.search_rect(q))
+        it = rt.aquery_rect(q, nodes=1)
+        for x in xs[:150]: rt.delete(x,x.rect)
+        self.assertEquals(set(sum(it, [])), expect)
+        # ...taken fresh by default, so they see the writes before them:
+        rt.insert(xs[0], xs[0].rect)
+        self.assertTrue(xs[0] in sum(rt.aquery_point(G.pointInside(xs[0].rect)), []))
+        rt.delete(xs[0], xs[0].rect)
+        # ...shared by those started within max_age of each other:
+        a = rt.aquery_rect(q, max_age=3600)
+        rt.insert(xs[0], xs[0].rect)
+        rp = rt.rect_pool
+        b = rt.aquery_rect(q, max_age=3600)
+        rt.insert(xs[1], xs[1].rect)
+        self.assertTrue(rt.rect_pool is rp) # no copy for b.
+        self.assertEquals(set(sum(a, [])), set(sum(b, [])))
+        self.assertTrue(xs[1] in sum(rt.aquery_point(G.pointInside(xs[1].rect)), []))
+        s = rt.snapshot()
+        self.assertEquals(set(sum(s.aquery_rect(q), [])), set(s.search_rect(q)))
+
+    @ut.skipIf(numpy is None, "needs numpy")
+    def testBatchQueries(self):
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+        rt.delete(xs[0], xs[0].rect)
+
+        qs = [ G.rect(2.0) for i in range(50) ] + [ xs[0].rect ]
+        qi,li = rt.query_rects_batch([ q.coords() for q in qs ])
+        self.assertEquals(len(qi), len(li))
+        for (i,q) in enumerate(qs):
+            got = set([ rt.leaf_pool[l] for l in li[qi == i] ])
+            want = set([ r.leaf_obj() for r in rt.query_rect(q) ]) - set([None])
+            self.assertEquals(got, want)
+
+        ps = [ G.pointInside(x.rect) for x in xs[1:50] ]
+        qi,li = rt.query_points_batch(ps)
+        for (i,p) in enumerate(ps):
+            got = set([ rt.leaf_pool[l] for l in li[qi == i] ])
+            want = set([ r.leaf_obj() for r in rt.query_point(p) ]) - set([None])
+            self.assertEquals(got, want)
+            self.assertTrue(xs[i+1] in got)
+
+        # The cached layout follows later writes:
+        extra = TstO(G.rect())
+        rt.insert(extra, extra.rect)
+        qi,li = rt.query_points_batch([ G.pointInside(extra.rect) ])
+        self.assertTrue(extra in [ rt.leaf_pool[l] for l in li ])
+
+    @ut.skipIf(numpy is None, "needs numpy")
+    def testGeometry(self):
+        from pyrtree.geometry import GeometryStore
+        from pyrtree import geometry
+        # Each entry's shape is the lower left half of its rect; every
+        #  third has none, so counts as its rect.
+        xs = [ TstO(r) for r in take(300, G.rect, 2.0) ]
+        gs = GeometryStore()
+        for x in xs[:200]:
+            r = x.rect
+            gs.add_polygon(x, [[(r.x, r.y), (r.xx, r.y), (r.x, r.yy)]])
+        def meets(x, q):
+            r = x.rect
+            if x not in gs: return True
+            px, py = max(q.x, r.x), max(q.y, r.y) # q's point nearest r's corner.
+            return (px - r.x) / (r.xx - r.x) + (py - r.y) / (r.yy - r.y) <= 1.0
+        rt = RTree(geometry=gs)
+        for x in xs: rt.insert(x,x.rect)
+
+        old = geometry.REFINE_BATCH
+        geometry.REFINE_BATCH = 7 # several batches per query.
+        try:
+            qs = [ G.rect(3.0) for i in range(50) ]
+            for q in qs:
+                want = set([ x for x in xs if x.rect.does_intersect(q) and meets(x, q) ])
+                self.assertEquals(set(rt.search_rect(q)), want)
+                self.assertEquals(set([ c.leaf_obj() for c in rt.query_rect(q) ]), want)
+                got = []
+                self.assertEquals(rt.visit_rect(q, got.append), len(want))
+                self.assertEquals(set(got), want)
+            ps = [ G.pointInside(x.rect) for x in xs[::3] ]
+            for p in ps:
+                q = Rect(p[0], p[1], p[0], p[1])
+                want = set([ x for x in xs if x.rect.does_containpoint(p) and meets(x, q) ])
+                self.assertEquals(set(rt.snapshot().search_point(p)), want)
+        finally:
+            geometry.REFINE_BATCH = old
+
+        qi,li = rt.query_rects_batch([ q.coords() for q in qs ])
+        for (i,q) in enumerate(qs):
+            self.assertEquals(set([ rt.leaf_pool[l] for l in li[qi == i] ]),
+                              set(rt.search_rect(q)))
+        qi,li = rt.query_points_batch(ps)
+        for (i,p) in enumerate(ps):
+            self.assertEquals(set([ rt.leaf_pool[l] for l in li[qi == i] ]),
+                              set(rt.search_point(p)))
+
+        # A packed copy refines as the tree does:
+        pt = rt.pack()
+        pi,pl = pt.query_rects_batch([ q.coords() for q in qs ])
+        qi,li = rt.query_rects_batch([ q.coords() for q in qs ])
+        self.assertEquals(sorted(zip(pi, pl)), sorted(zip(qi, li)))
+        for q in qs: self.assertEquals(set(pt.search_rect(q)), set(rt.search_rect(q)))
+        for p in ps: self.assertEquals(set(pt.search_point(p)), set(rt.search_point(p)))
+        tri = RTree(geometry=GeometryStore())
+        tri.insert("tri", Rect(0, 0, 10, 10))
+        tri.geometry.add_polygon("tri", [[(0, 0), (10, 0), (0, 10)]])
+        q = Rect(8, 8, 9, 9)
+        self.assertEquals(list(tri.search_rect(q)), [])
+        self.assertEquals(list(tri.pack().search_rect(q)), [])
+        self.assertEquals(len(tri.pack().query_rects_batch([ q.coords() ])[0]), 0)
+
+        # Holes, lines, and replacing and removing shapes:
+        o, l = TstO(Rect(0, 0, 10, 10)), TstO(Rect(0, 0, 10, 10))
+        gs.add_polygon(o, [[(0, 0), (10, 0), (10, 10), (0, 10)], [(2, 2), (8, 2), (8, 8), (2, 8)]])
+        gs.add_line(l, [(0, 0), (10, 10)])
+        self.assertEquals(list(gs.test_points([o, o, l, l], [(1, 1), (5, 5), (5, 5), (6, 5)])),
+                          [True, False, True, False])
+        self.assertEquals(list(gs.test_rects([o, l, l], [(3, 3, 7, 7), (6, 0, 9, 3), (6, 0, 9, 6)])),
+                          [False, False, True])
+        gs.add_polygon(o, [[(0, 0), (1, 0), (0, 1)]])
+        self.assertFalse(gs.test_points([o], [(5, 5)])[0])
+        for x in xs[:200]: self.assertTrue(gs.remove(x))
+        self.assertFalse(gs.remove(xs[0]))
+        self.assertEquals(len(gs), 2)
+        self.assertTrue(len(gs.edges) < 4 * 4 * 10) # repacked along the way.
+        q = qs[0]
+        self.assertEquals(set(rt.search_rect(q)),
+                          set([ x for x in xs if x.rect.does_intersect(q) ]))
+
+    def testSaveOpen(self):
+        xs = [ TstO(r) for r in take(200, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x.rect.coords(), x.rect)
+        rt.delete(xs[0].rect.coords(), xs[0].rect)
+
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            rt.save(path)
+            ot = RTree.open(path)
+            self.assertEquals(ot.node_count, rt.node_count)
+            self.assertEquals(ot.free_nodes, rt.free_nodes)
+            for i in range(50):
+                q = G.rect(2.0)
+                self.assertEquals(sorted([ r.leaf_obj() for r in ot.query_rect(q) if r.is_leaf() ]),
+                                  sorted([ r.leaf_obj() for r in rt.query_rect(q) if r.is_leaf() ]))
+
+            # An opened tree is still writable:
+            for x in xs[:20]:
+                self.assertTrue(ot.delete(x.rect.coords(), x.rect) or x is xs[0])
+            for x in xs[:50]: ot.insert(x.rect.coords(), x.rect)
+            found = [ r.leaf_obj() for r in ot.walk(lambda r,o: True) if r.is_leaf() ]
+            self.assertEquals(len(found), len(xs) - 20 + 50)
+
+            # ...without touching the file.
+            self.assertEquals(RTree.open(path).node_count, rt.node_count)
+
+            # Read in, rather than mapped:
+            ot = RTree.open(path, mmap=False)
+            self.assertTrue(isinstance(ot.rect_pool, array.array))
+            self.assertEquals(list(ot.node_pool), list(rt.node_pool[:rt.node_count*2]))
+            self.assertEquals(list(ot.count_pool), list(rt.count_pool[:rt.node_count]))
+            for i in range(20):
+                q = G.rect(2.0)
+                self.assertEquals(sorted(ot.search_rect(q)), sorted(rt.search_rect(q)))
+            ot.insert(xs[0].rect.coords(), xs[0].rect)
+            self.assertEquals(ot.count(), rt.count() + 1)
+
+            # The tree's settings are saved with it:
+            st = RTree(max_children=20, min_children=5, max_kmeans=4, split="rstar")
+            for x in xs: st.insert(x, x.rect)
+            st.save(path)
+            ot = RTree.open(path)
+            self.assertEquals((ot.max_children, ot.min_children, ot.max_kmeans),
+                              (20, 5, 4))
+            self.assertTrue(isinstance(ot.split, RStarSplit))
+            self.assertEquals(ot.analyze()["fill"], st.analyze()["fill"])
+            self.assertTrue(RTree.open(path, max_children=20, split=RStarSplit()))
+            self.assertRaises(ValueError, RTree.open, path, max_children=10)
+            self.assertRaises(ValueError, RTree.open, path, split="linear")
+            class MySplit(LinearSplit): pass
+            RTree(split=MySplit()).save(path)
+            self.assertRaises(ValueError, RTree.open, path)
+            self.assertTrue(isinstance(RTree.open(path, split=MySplit()).split, MySplit))
+
+            open(path, "wb").write("garbage" * 20)
+            self.assertRaises(ValueError, RTree.open, path)
+        finally:
+            os.unlink(path)
+
+    def testIngest(self):
+        from pyrtree import ingest
+        import json, shutil, struct
+        rs = list(take(200, G.rect, 0.5))
+        ref = RTree.bulk_load(enumerate(rs))
+        d = tempfile.mkdtemp()
+        try:
+            p = os.path.join(d, "boxes.csv")
+            with open(p, "wb") as f:
+                f.write("name,minx,miny,maxx,maxy\n")
+                for (i,r) in enumerate(rs): f.write("%d,%r,%r,%r,%r\n" % ((i,) + r.coords()))
+                f.write("200,,1,2,3\n201,1,1,1,3\n") # no coords; no width.
+            csvr = ingest.CSVReader(p, id_column="name", chunk=7)
+
+            p = os.path.join(d, "boxes.geojson")
+            with open(p, "wb") as f:
+                for (i,(x,y,xx,yy)) in enumerate([ r.coords() for r in rs ]):
+                    ring = [[x,y],[xx,y],[xx,yy],[x,yy],[x,y]]
+                    if i % 3 == 0: g = { "type" : "Polygon", "coordinates" : [ring] }
+                    else: g = { "type" : "GeometryCollection", "geometries" : [
+                            { "type" : "MultiPoint", "coordinates" : ring } ] }
+                    feat = { "type" : "Feature", "id" : i, "geometry" : g }
+                    if i % 5 == 0: feat["bbox"] = [x, y, xx, yy]
+                    f.write(json.dumps(feat) + "\n")
+                f.write('{"type": "Feature", "geometry": null}\n\n')
+            geor = ingest.GeoJSONReader(p, chunk=50)
+
+            p = os.path.join(d, "boxes.wkb")
+            with open(p, "wb") as f:
+                for (i,(x,y,xx,yy)) in enumerate([ r.coords() for r in rs ]):
+                    bo = "<>"[i % 2]
+                    if i % 3 == 0: # ISO Polygon Z.
+                        f.write(struct.pack(bo + "BIII", i % 2 == 0, 1003, 1, 5))
+                        f.write(struct.pack(bo + "15d", x,y,0, xx,y,0, xx,yy,0, x,yy,0, x,y,0))
+                    else: # EWKB MultiLineString, with an SRID, of one LineString.
+                        f.write(struct.pack(bo + "BIII", i % 2 == 0, 5 | 0x20000000, 4326, 1))
+                        f.write(struct.pack(bo + "BII8d", i % 2 == 0, 2, 4, x,y, xx,y, xx,yy, x,yy))
+                f.write(struct.pack("<BI2d", 1, 1, float("nan"), float("nan"))) # POINT EMPTY
+            wkbr = ingest.WKBReader(p, chunk=64)
+
+            for (reader, skipped) in ((csvr, 2), (geor, 1), (wkbr, 1)):
+                rt,stats = ingest.build(reader, coord_type='f')
+                self.assertEquals((stats["records"], stats["loaded"], stats["skipped"]),
+                                  (200 + skipped, 200, skipped))
+                self.assertEquals(stats["chunks"], -(-200 // reader.chunk))
+                ot = RTree()
+                ingest.load(ot, reader)
+                for i in range(30):
+                    q = G.rect(2.0)
+                    want = sorted(ref.search_rect(q))
+                    self.assertEquals(sorted([ int(o) for o in rt.search_rect(q) ]), want)
+                    self.assertEquals(sorted([ int(o) for o in ot.search_rect(q) ]), want)
+                self.assertEquals(ot.count(), 200)
+
+            # Points only get in padded:
+            p = os.path.join(d, "points.csv")
+            with open(p, "wb") as f: f.write("1,1,1,1\n2,2,2,2\n")
+            r = ingest.CSVReader(p, columns=(0,1,2,3), header=False)
+            self.assertEquals(ingest.build(r)[1]["loaded"], 0)
+            r = ingest.CSVReader(p, columns=(0,1,2,3), header=False, pad=0.5)
+            self.assertEquals(sorted(ingest.build(r)[0].search_point((1.2,0.8))), [0])
+        finally:
+            shutil.rmtree(d)
+
+    def testFloat32(self):
+        import struct
+        f32 = lambda v: struct.unpack("f", struct.pack("f", v))[0]
+        for v in [ 0.1, -0.1, 1.0, 1e-40, -3.3e38, 1e300 ] + [ rr() for i in range(100) ]:
+            x,y,xx,yy = rtree._round_out(v, v, v, v)
+            self.assertTrue(x <= v <= xx)
+            self.assertEquals((f32(x), f32(xx)), (x, xx))
+            self.assertTrue(x == xx or rtree._f32_step(x, True) == xx)
+        self.assertEquals(rtree._round_out(0.5, 1, 2, 3), (0.5, 1, 2, 3))
+
+        xs = [ TstO(r) for r in take(400, G.rect, 0.5) ]
+        rd = RTree()
+        rf = RTree(coord_type='f', index_type='I')
+        self.assertEquals((rf.rect_pool.itemsize, rf.node_pool.itemsize), (4, 4))
+        for x in xs[:300]:
+            rd.insert(x,x.rect)
+            rf.insert(x,x.rect)
+        rf.insert_many([ (x, x.rect) for x in xs[300:] ])
+        rd.insert_many([ (x, x.rect) for x in xs[300:] ])
+        rb = RTree.bulk_load([ (x, x.rect) for x in xs ], coord_type='f')
+        self.invariants(rf)
+        self.assertTrue(rf.exact_rects)
+
+        # Same answers as doubles, including for queries right on the
+        #  entries' edges (where float32 rounding would let extra ones in):
+        for i in range(100):
+            q = G.rect(2.0) if i % 2 else xs[i].rect
+            want = sorted(rd.search_rect(q))
+            self.assertEquals(sorted(rf.search_rect(q)), want)
+            self.assertEquals(sorted(rb.search_rect(q)), want)
+            self.assertEquals(rf.count(q), rd.count(q))
+            p = (xs[i].rect.xx, xs[i].rect.y)
+            self.assertEquals(sorted(rf.search_point(p)), sorted(rd.search_point(p)))
+            q = Rect(xs[i].rect.xx, xs[i].rect.y, xs[i].rect.xx + 1, xs[i].rect.yy)
+            self.assertEquals(rf.visit_rect(q, lambda o: None), rd.visit_rect(q, lambda o: None))
+        p = (5.0, 5.0)
+        self.assertEquals(set([ c.leaf_obj() for c in rf.nearest(p, 1) ]),
+                          set([ c.leaf_obj() for c in rd.nearest(p, 1) ]))
+        self.assertEquals(sorted(rf.join(rb, "within", ids=False)),
+                          sorted(rd.join(rd, "within", ids=False)))
+        if numpy is not None:
+            qi,li = rf.query_rects_batch([ x.rect.coords() for x in xs[:20] ])
+            for i in range(20):
+                self.assertEquals(sorted([ rf.leaf_pool[l] for l in li[qi == i] ]),
+                                  sorted(rd.search_rect(xs[i].rect)))
+
+        # Deletes take exact rects, and reinserted orphans keep theirs:
+        for x in xs[:200]:
+            self.assertTrue(rf.delete(x, x.rect))
+            self.assertTrue(rd.delete(x, x.rect))
+        self.assertFalse(rf.delete(xs[0], xs[0].rect))
+        self.assertEquals(len(rf.exact_rects), len([ x for x in xs[200:]
+            if rtree._round_out(*x.rect.coords()) != x.rect.coords() ]))
+        for x in xs[200:220]:
+            self.assertEquals(sorted(rf.search_rect(x.rect)), sorted(rd.search_rect(x.rect)))
+
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            rf.save(path)
+            ot = RTree.open(path)
+            self.assertEquals(ot.exact_rects, rf.exact_rects)
+            self.assertEquals(ot.rect_pool._type_, rtree._CTYPES['f'])
+            coords = lambda os: sorted([ o.rect.coords() for o in os ]) # (unpickled copies)
+            for x in xs[200:220]:
+                self.assertEquals(coords(ot.search_rect(x.rect)), coords(rd.search_rect(x.rect)))
+        finally:
+            os.unlink(path)
+
+        # Without exact rects: a superset, off by no more than rounding.
+        rn = RTree.bulk_load([ (x, x.rect) for x in xs[200:] ], coord_type='f', exact=False)
+        self.assertEquals(rn.exact_rects, None)
+        for x in xs[200:250]:
+            want = set(rd.search_rect(x.rect))
+            got = set(rn.search_rect(x.rect))
+            self.assertTrue(got >= want)
+            for o in got - want:
+                w = min(o.rect.xx, x.rect.xx) - max(o.rect.x, x.rect.x)
+                h = min(o.rect.yy, x.rect.yy) - max(o.rect.y, x.rect.y)
+                self.assertTrue(min(w, h) > -1e-5)
+        for x in xs[200:250]: self.assertTrue(rn.delete(x, x.rect))
+        self.assertRaises(ValueError, RTree, coord_type='h')
+        self.assertRaises(ValueError, RTree, index_type='B')
+
+    def testCompact(self):
+        xs = [ TstO(r) for r in take(500, G.rect, 0.5) ]
+        for kw in ({}, { "coord_type" : 'f' }):
+            rt = RTree(max_children=6, min_children=2, cache=16, **kw)
+            for x in xs: rt.insert(x,x.rect)
+            for x in xs[:200]: rt.delete(x,x.rect)
+            qs = [ G.rect(2.0) for i in range(30) ]
+            want = [ sorted(rt.search_rect(q)) for q in qs ]
+            nodes, free = rt.node_count, len(rt.free_nodes)
+            self.assertTrue(free > 0)
+            snap = rt.snapshot()
+
+            self.assertEquals(rt.compact(), free)
+            self.assertEquals(rt.node_count, nodes - free)
+            self.assertEquals(len(rt.rect_pool), 4 * rt.node_count)
+            self.assertEquals((rt.leaf_count, len(rt.leaf_pool)), (300, 300))
+            self.assertEquals((rt.free_nodes, rt.free_leaves), ([], []))
+            self.assertEquals(len(rt.cache), 0)
+            self.invariants(rt)
+            self.assertEquals([ sorted(rt.search_rect(q)) for q in qs ], want)
+            self.assertEquals([ sorted(snap.search_rect(q)) for q in qs ], want)
+            if rt.exact_rects is not None:
+                self.assertEquals(len(rt.exact_rects), len([ x for x in xs[200:]
+                    if rtree._round_out(*x.rect.coords()) != x.rect.coords() ]))
+            self.assertEquals(rt.count(), 300)
+
+            # Breadth first: each node's children follow each other, after it.
+            last = 0
+            for i in [0] + [ c for c in range(1, rt.node_count) if not rt._is_leaf(c) ]:
+                kids = list(rt._children(i))
+                self.assertEquals(kids, range(kids[0], kids[0] + len(kids)))
+                self.assertTrue(kids[0] > last)
+                last = kids[-1]
+
+            # Still a working tree:
+            for x in xs[200:300]: self.assertTrue(rt.delete(x,x.rect))
+            for x in xs[:200]: rt.insert(x,x.rect)
+            self.invariants(rt)
+            self.assertEquals(rt.count(), 400)
+            free = len(rt.free_nodes)
+            self.assertEquals(rt.compact(), free)
+            self.assertEquals(rt.compact(), 0)
+        self.assertEquals(RTree().compact(), 0)
+
+    def testPacked(self):
+        xs = [ TstO(r) for r in take(400, G.rect, 0.5) ]
+        for kw in ({}, { "coord_type" : 'f', "index_type" : 'I' }):
+            rt = RTree(max_children=6, min_children=2, **kw)
+            for x in xs: rt.insert(x,x.rect)
+            for x in xs[:100]: rt.delete(x,x.rect)
+            pk = rt.pack()
+            self.assertEquals((pk.leaf_count, pk.count()), (300, 300))
+
+            # Blocks: every node but the root is in exactly one node's
+            #  block, as is every entry; entry counts add up.
+            nodes, leaves = [], []
+            for i in range(pk.node_count):
+                leafy, sl = pk.children(i)
+                kids = range(sl.start, sl.stop)
+                (leaves if leafy else nodes).extend(kids)
+                self.assertEquals(pk.entries[i], len(kids) if leafy else
+                                  sum([ pk.entries[k] for k in kids ]))
+                x,y,xx,yy = pk.box[i*4:i*4+4]
+                for k in kids:
+                    b = (pk.leaf_box if leafy else pk.box)[k*4:k*4+4]
+                    self.assertTrue(x <= b[0] <= b[2] <= xx and y <= b[1] <= b[3] <= yy)
+            self.assertEquals(sorted(nodes), range(1, pk.node_count))
+            self.assertEquals(sorted(leaves), range(300))
+            self.assertEquals(sorted([ pk.leaf_pool[l] for l in pk.leaf_id ]), sorted(xs[100:]))
+
+            for i in range(50):
+                q = G.rect(2.0) if i % 2 else xs[100 + i].rect
+                self.assertEquals(sorted(pk.search_rect(q)), sorted(rt.search_rect(q)))
+                self.assertEquals(pk.count(q), rt.count(q))
+                got = []
+                self.assertEquals(pk.visit_rect(q, got.append, ids=True), rt.count(q) and len(got))
+                self.assertEquals(sorted(got), sorted(rt.search_rect(q, ids=True)))
+                p = G.pointInside(xs[100 + i].rect)
+                self.assertEquals(sorted(pk.search_point(p)), sorted(rt.search_point(p)))
+            if numpy is not None:
+                pairs = lambda (qi,li): sorted(zip(qi.tolist(), li.tolist()))
+                qs = [ G.rect(2.0).coords() for i in range(30) ]
+                self.assertEquals(pairs(pk.query_rects_batch(qs)),
+                                  pairs(rt.query_rects_batch(qs)))
+                ps = [ G.pointInside(x.rect) for x in xs[100:130] ]
+                self.assertEquals(pairs(pk.query_points_batch(ps)),
+                                  pairs(rt.query_points_batch(ps)))
+                for (qi,li) in (pk.query_rects_batch([]), pk.query_points_batch([])):
+                    self.assertEquals((len(qi), len(li)), (0, 0))
+
+            # A copy: later writes don't show.
+            q = xs[0].rect
+            before = sorted(pk.search_rect(q))
+            rt.insert(xs[0], xs[0].rect)
+            self.assertEquals(sorted(pk.search_rect(q)), before)
+        self.assertEquals(RTree().pack().count(G.rect()), 0)
+
+    def testAnalyze(self):
+        # Three entries in the root: one overlapping pair, nothing else.
+        rt = RTree.bulk_load([ ("a", Rect(0,0,1,1)), ("b", Rect(0.5,0.5,1.5,1.5)),
+                               ("c", Rect(2,2,3,3)) ])
+        q = rt.analyze()
+        self.assertEquals((q["entries"], q["nodes"], q["height"]), (3, 1, 1))
+        self.assertEquals(q["fanout"], {3 : 1})
+        self.assertEquals(q["leaf_depth"], {1 : 3})
+        self.assertAlmostEquals(q["overlap"], 0.25)
+        self.assertAlmostEquals(q["dead_space"], 9 - 2.75)
+        self.assertAlmostEquals(q["fill"], 0.3)
+        self.assertAlmostEquals(rtree._union_area([ (0,0,2,2), (1,1,3,3), (1,1,2,2) ]), 7)
+
+        xs = [ TstO(r) for r in take(500, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+        q = rt.analyze()
+        self.assertEquals(q["entries"], 500)
+        self.assertEquals(sum(q["leaf_depth"].values()), 500)
+        self.assertEquals(q["height"], max(q["leaf_depth"]))
+        self.assertEquals(len(q["levels"]), q["height"])
+        self.assertEquals(q["nodes"], sum(q["fanout"].values()))
+        # Every node but the root is some node's child:
+        self.assertEquals(sum([ n * k for (n,k) in q["fanout"].items() ]), q["nodes"] - 1 + 500)
+        self.assertEquals(q["levels"][0]["nodes"], 1)
+        self.assertTrue(q["fanout"].keys() and max(q["fanout"]) <= rt.max_children)
+        for l in q["levels"]:
+            self.assertTrue(l["overlap"] >= 0 and 0 <= l["dead_space"] <= l["area"])
+        self.assertEquals(rt.snapshot().analyze(), q)
+
+        # Dead space, checked by sampling the root's rect:
+        rt = RTree.bulk_load([ (x, x.rect) for x in xs[:8] ])
+        x,y,xx,yy = rtree._box(rt.rect_pool, 0)
+        rng = random.Random(1)
+        n = 20000
+        empty = 0
+        for i in range(n):
+            p = (rng.uniform(x, xx), rng.uniform(y, yy))
+            if not [ o for o in xs[:8] if o.rect.does_containpoint(p) ]: empty += 1
+        dead = rt.analyze()["dead_space"] / ((xx - x) * (yy - y))
+        self.assertTrue(abs(empty / float(n) - dead) < 0.02)
+
+    def testCount(self):
+        def brute(xs, q):
+            return len([ x for x in xs if
+                         max(x.rect.x, q.x) <= min(x.rect.xx, q.xx) and
+                         max(x.rect.y, q.y) <= min(x.rect.yy, q.yy) ])
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        for rt in (RTree(), RTree(split=RStarSplit(reinsert=True))):
+            for x in xs: rt.insert(x,x.rect)
+            self.assertEquals(rt.count(), len(xs))
+            for i in range(50):
+                q = G.rect(4.0)
+                self.assertEquals(rt.count(q), brute(xs, q))
+            for x in xs[:100]: rt.delete(x,x.rect)
+            self.invariants(rt)
+            self.assertEquals(rt.count(), len(xs) - 100)
+            self.assertEquals(rt.count(Rect(-1,-1,30,30)), len(xs) - 100)
+            q = G.rect(4.0)
+            self.assertEquals(rt.count(q), brute(xs[100:], q))
+
+        rt = RTree.bulk_load([ (x,x.rect) for x in xs ])
+        self.invariants(rt)
+        self.assertEquals(rt.count(), len(xs))
+        self.assertEquals(RTree().count(G.rect()), 0)
+
+        # Counts survive save() and open(), and are rebuilt for version 1
+        #  files, which don't have them:
+        fd,path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            rt.save(path)
+            q = G.rect(4.0)
+            self.assertEquals(RTree.open(path).count(q), brute(xs, q))
+
+            data = open(path, "rb").read()
+            h = rtree._HEADER
+            fields = list(h.unpack(data[:h.size]))
+            n,noff,loff = fields[7],fields[10],fields[11]
+            cend = noff + 2 * n * rt.node_pool.itemsize
+            fields[1] = 1
+            fields[11] = cend
+            open(path, "wb").write(h.pack(*fields) + data[h.size:cend] + data[loff:])
+            ot = RTree.open(path)
+            self.assertEquals(ot.count(q), brute(xs, q))
+            ot.insert(xs[0], xs[0].rect)
+            self.invariants(ot)
+        finally:
+            os.unlink(path)
+
+        # Touching counts:
+        rt = RTree()
+        rt.insert("a", Rect(0,0,1,1))
+        self.assertEquals(rt.count(Rect(1,0,2,1)), 1)
+        self.assertEquals(rt.count(Rect(1.5,0,2,1)), 0)
+
+    def testSnapshot(self):
+        xs = [ TstO(r) for r in take(400, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs[:200]: rt.insert(x,x.rect)
+        q = G.rect(5.0)
+
+        s = rt.snapshot()
+        self.assertTrue(rt.snapshot() is s)
+        before = set(s.search_rect(q))
+        self.assertEquals(before, set(rt.search_rect(q)))
+        for x in xs[200:]: rt.insert(x,x.rect)
+        for x in xs[:100]: rt.delete(x,x.rect)
+        self.invariants(rt)
+
+        # The old snapshot doesn't see any of that; a new one does:
+        self.assertEquals(set(s.search_rect(q)), before)
+        self.assertEquals(s.count(), 200)
+        t = rt.snapshot()
+        self.assertTrue(t is not s)
+        self.assertEquals(set(t.search_rect(q)), set(rt.search_rect(q)))
+        self.assertEquals(t.count(), 300)
+        self.assertEquals(set(t.join(rt)), set(rt.join(rt)))
+
+        # With max_age, a recent snapshot is handed out again, stale or
+        #  not, and the writes after it don't copy the pools again:
+        rt.insert(xs[0], xs[0].rect)
+        rp = rt.rect_pool
+        self.assertTrue(rt.snapshot(max_age=3600) is t)
+        rt.delete(xs[0], xs[0].rect)
+        self.assertTrue(rt.rect_pool is rp)
+        self.assertEquals(t.count(), 300)
+        self.assertTrue(rt.snapshot(max_age=0) is not t)
+        self.assertTrue(rt.snapshot(max_age=3600) is rt.snapshot())
+
+        # Readers on snapshots alongside a writer:
+        errors = []
+        done = threading.Event()
+        def reader():
+            try:
+                while not done.is_set():
+                    snap = rt.snapshot()
+                    for x in xs[100:300]:
+                        if x not in snap.search_point(G.pointInside(x.rect)):
+                            errors.append(x)
+                    if snap.count() != len(list(snap.search_rect(Rect(-1,-1,30,30)))):
+                        errors.append(snap)
+            except Exception, e:
+                errors.append(e)
+        readers = [ threading.Thread(target=reader) for i in range(3) ]
+        for r in readers: r.start()
+        try:
+            for x in xs[300:]: rt.delete(x,x.rect)
+            for x in xs[300:]: rt.insert(x,x.rect)
+        finally:
+            done.set()
+            for r in readers: r.join()
+        self.assertEquals(errors, [])
+        self.invariants(rt)
+
+    def testParallel(self):
+        from pyrtree.parallel import ParallelQueryExecutor
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+        rects = [ G.rect(3.0) for i in range(40) ]
+        points = [ G.pointInside(x.rect) for x in xs[:40] ]
+
+        with ParallelQueryExecutor(rt, processes=2, chunksize=7) as ex:
+            path = ex.path
+            self.assertTrue(os.path.exists(path))
+            got = ex.query_rects(rects)
+            self.assertEquals(len(got), len(rects))
+            for (q,res) in zip(rects, got):
+                self.assertEquals(res, list(rt.search_rect(q)))
+            self.assertEquals(ex.query_rects([ q.coords() for q in rects ], ids=True),
+                              [ list(rt.search_rect(q, ids=True)) for q in rects ])
+            got = ex.query_points(points)
+            for (i,res) in enumerate(got):
+                self.assertTrue(xs[i] in res)
+                self.assertEquals(res, list(rt.search_point(points[i])))
+            self.assertEquals(ex.nearest(points, 3),
+                              [ [ c.leaf_obj() for c in rt.nearest(p, 3) ] for p in points ])
+
+            # Later changes to the tree don't reach the workers:
+            rt.delete(xs[0], xs[0].rect)
+            self.assertTrue(xs[0] in ex.query_points(points[:1])[0])
+        self.assertFalse(os.path.exists(path))
+
+        # Hits are refined against the tree's geometry store:
+        if numpy is not None:
+            from pyrtree.geometry import GeometryStore
+            gs = GeometryStore()
+            for x in xs[::2]:
+                r = x.rect
+                gs.add_polygon(x, [[(r.x, r.y), (r.xx, r.y), (r.x, r.yy)]])
+            rt.geometry = gs
+            rt.insert("tri", Rect(100, 100, 110, 110)) # away from the rest.
+            gs.add_polygon("tri", [[(100, 100), (110, 100), (100, 110)]])
+            with ParallelQueryExecutor(rt, processes=2, chunksize=7) as ex:
+                self.assertEquals(ex.query_rects([ Rect(108, 108, 109, 109), Rect(101, 101, 102, 102) ]),
+                                  [ [], [ "tri" ] ])
+                self.assertEquals(ex.query_rects(rects),
+                                  [ list(rt.search_rect(q)) for q in rects ])
+                self.assertEquals(ex.query_points(points),
+                                  [ list(rt.search_point(p)) for p in points ])
+            rt.delete("tri", Rect(100, 100, 110, 110))
+            rt.geometry = None
+
+        # A tree with a split policy of its own:
+        class MySplit(QuadraticSplit): pass
+        mt = RTree(split=MySplit())
+        for x in xs: mt.insert(x,x.rect)
+        with ParallelQueryExecutor(mt, processes=2) as ex:
+            self.assertEquals(ex.query_rects(rects[:5]),
+                              [ list(mt.search_rect(q)) for q in rects[:5] ])
+
+        # Workers that can't open the file fail the executor at once, and
+        #  the file goes:
+        import glob
+        d = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        before = set(glob.glob(os.path.join(d, "pyrtree-*")))
+        old = RTree.open
+        def broken(path, **kwargs): raise ValueError("broken")
+        RTree.open = staticmethod(broken)
+        try:
+            self.assertRaises(RuntimeError, ParallelQueryExecutor, rt, processes=2)
+        finally:
+            RTree.open = old
+        self.assertEquals(set(glob.glob(os.path.join(d, "pyrtree-*"))), before)
+
+    def testBenchRunner(self):
+        from pyrtree.bench import runner
+        names = [ "build_bulk", "window_query_0.001", "join", "mixed" ]
+        rep = runner.run(names, isolate=False, size=300, queries=20, repeat=2)
+        self.assertEquals(sorted(rep["scenarios"]), sorted(names))
+        self.assertEquals(rep["meta"]["size"], 300)
+        res = rep["scenarios"]["window_query_0.001"]
+        self.assertEquals(res["ops"], 20)
+        self.assertTrue(res["min_s"] <= res["p50_s"] <= res["p99_s"] <= res["max_s"])
+        self.assertTrue(res["index_bytes"] > 0)
+        self.assertRaises(ValueError, runner.run, ["nope"], isolate=False)
+
+        # compare flags what got slower, and nothing else:
+        self.assertEquals(set([ r[5] for r in runner.compare(rep, rep) ]), set(["ok"]))
+        slow = copy.deepcopy(rep)
+        slow["scenarios"]["join"]["p50_s"] *= 2
+        rows = runner.compare(rep, slow)
+        self.assertEquals([ (r[0], r[1]) for r in rows if r[5] == "REGRESSION" ],
+                          [ ("join", "p50_s") ])
+        self.assertEquals([ r[0] for r in runner.compare(slow, rep) if r[5] == "improved" ],
+                          [ "join" ])
+        # ...and what failed:
+        broken = { "scenarios" : { "join" : { "error" : "boom" } } }
+        self.assertEquals(runner.compare(rep, broken),
+                          [ ("join", "error", None, "boom", None, "REGRESSION") ])
+        self.assertEquals([ r[5] for r in runner.compare(broken, rep) ], [ "improved" ])
+
+        # A scenario run in a worker process that dies reports an error:
+        old = runner.run_scenario
+        runner.run_scenario = lambda name, **kw: os._exit(3)
+        try:
+            res = runner.run(["join"])["scenarios"]["join"]
+        finally:
+            runner.run_scenario = old
+        self.assertTrue("exit code 3" in res["error"])
+
+    def testCache(self):
+        from pyrtree.cache import QueryCache
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree(max_children=6, min_children=2, split="rstar", cache=64)
+        self.assertTrue(isinstance(rt.cache, QueryCache))
+        for x in xs[:200]: rt.insert(x,x.rect)
+        live = set(xs[:200])
+
+        # A few viewports, asked for again and again while the tree
+        #  changes under them (with forced reinsertion, and deletes that
+        #  reinsert orphans): answers must always be current.
+        views = list(take(10, G.rect, 3.0))
+        points = [ G.pointInside(x.rect) for x in xs[:10] ]
+        rng = random.Random(3)
+        fresh = xs[200:]
+        for step in range(300):
+            q = rng.choice(views)
+            want = set([ x for x in live if x.rect.does_intersect(q) ])
+            self.assertEquals(set(rt.search_rect(q)), want)
+            self.assertEquals(set([ c.leaf_obj() for c in rt.query_rect(q) ]), want)
+            got = []
+            self.assertEquals(rt.visit_rect(q, got.append), len(want))
+            self.assertEquals(set(got), want)
+            p = rng.choice(points)
+            self.assertEquals(set(rt.search_point(p)),
+                              set([ x for x in live if x.rect.does_containpoint(p) ]))
+            if step % 3 == 0:
+                if fresh and rng.random() < 0.6:
+                    x = fresh.pop()
+                    rt.insert(x,x.rect)
+                    live.add(x)
+                else:
+                    x = rng.choice(list(live))
+                    self.assertTrue(rt.delete(x,x.rect))
+                    live.remove(x)
+        st = rt.cache.stats()
+        self.assertTrue(st["hits"] > 300)
+        self.assertTrue(st["invalidations"] > 0)
+        self.invariants(rt)
+
+        # Writes only drop the queries they touch:
+        rt = RTree(cache=QueryCache(max_entries=3))
+        rt.insert("a", Rect(0,0,1,1))
+        rt.insert("b", Rect(10,10,11,11))
+        near, far = Rect(0,0,2,2), Rect(9,9,12,12)
+        self.assertEquals(list(rt.search_rect(near)), ["a"])
+        self.assertEquals(list(rt.search_rect(far)), ["b"])
+        rt.insert("c", Rect(1.5,1.5,3,3))
+        self.assertEquals(rt.cache.stats()["invalidations"], 1)
+        self.assertEquals(list(rt.search_rect(far)), ["b"])
+        self.assertEquals(sorted(rt.search_rect(near)), ["a", "c"])
+        self.assertEquals((rt.cache.hits, rt.cache.misses), (1, 3))
+        rt.insert_many([ ("d", Rect(10.5,10.5,10.6,10.6)) ])
+        self.assertEquals(sorted(rt.search_rect(far)), ["b", "d"])
+        self.assertEquals(sorted(rt.search_rect(near)), ["a", "c"])
+        self.assertEquals(rt.cache.hits, 2)
+
+        # Bounded: least recently used goes first.
+        for i in range(3): list(rt.search_rect(Rect(i, 20, i + 1, 21)))
+        self.assertEquals(len(rt.cache), 3)
+        self.assertEquals(rt.cache.evictions, 2)
+        list(rt.search_rect(near))
+        self.assertEquals(rt.cache.misses, 8)
+        c = QueryCache(max_entries=10, max_ids=5)
+        c.put("big", tuple(range(5)))
+        c.put("a", (1, 2))
+        c.put("b", (3, 4))
+        self.assertEquals((len(c), c.get("a"), c.evictions), (1, None, 1))
+        self.assertRaises(ValueError, QueryCache, 0)
+
+    def testMetrics(self):
+        from pyrtree import metrics
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        sink = metrics.HistogramSink()
+        rt = RTree(max_children=6, min_children=2, split="quadratic", metrics=sink)
+        for x in xs: rt.insert(x,x.rect)
+        self.assertEquals(sink.events["insert"], 300)
+        self.assertEquals(sink.events["split"], rt.stats["overflow_f"])
+        self.assertEquals(sink.histogram("insert", "splits").total, rt.stats["overflow_f"])
+        self.assertTrue(sink.histogram("insert", "depth").max >= 2)
+        self.assertTrue(sink.histogram("split", "children").min > 6)
+
+        # Query events count what the query did:
+        seen = []
+        rt.metrics = metrics.CallbackSink(lambda e,f: seen.append((e,f)))
+        for i in range(20):
+            q = G.rect(2.0)
+            hits = list(rt.search_rect(q))
+            self.assertEquals(seen[-1][0], "query_rect")
+            f = seen[-1][1]
+            self.assertEquals(f["leaves_returned"], len(hits))
+            self.assertTrue(f["nodes_visited"] > 0)
+            self.assertTrue(f["leaves_tested"] >= len(hits))
+            self.assertEquals(rt.visit_rect(q, lambda o: None), len(hits))
+            self.assertEquals(seen[-1][1]["leaves_returned"], len(hits))
+            n = rt.count(q)
+            self.assertEquals(seen[-1], ("count", seen[-1][1]))
+            self.assertEquals(seen[-1][1]["leaves_returned"], n)
+            p = G.pointInside(xs[i].rect)
+            self.assertEquals(len(list(rt.search_point(p))), seen[-1][1]["leaves_returned"])
+            self.assertEquals(seen[-1][0], "query_point")
+        list(rt.nearest((0.5, 0.5), 3))
+        self.assertEquals((seen[-1][0], seen[-1][1]["leaves_returned"]), ("nearest", 3))
+        pairs = list(rt.join(rt))
+        self.assertEquals((seen[-1][0], seen[-1][1]["leaves_returned"]), ("join", len(pairs)))
+        self.assertTrue(rt.delete(xs[0], xs[0].rect))
+        self.assertEquals((seen[-1][0], seen[-1][1]["found"]), ("delete", 1))
+        rt.insert_many([ (x, x.rect) for x in xs[:50] ])
+        self.assertEquals((seen[-1][0], seen[-1][1]["entries"]), ("insert_many", 50))
+        self.assertEquals(rt.snapshot().metrics, rt.metrics)
+
+        # Off by default, and then nothing is reported:
+        rt.metrics = None
+        n = len(seen)
+        list(rt.search_rect(G.rect(2.0)))
+        rt.insert(xs[0], xs[0].rect)
+        self.assertEquals(len(seen), n)
+        self.assertEquals(RTree().metrics, None)
+
+        h = metrics.Histogram()
+        for v in (0, 1, 3, 5, 100): h.add(v)
+        self.assertEquals((h.count, h.min, h.max), (5, 0, 100))
+        self.assertEquals(h.percentile(50), 4.0)
+        self.assertEquals(h.percentile(100), 100)
+
+    def testQueryEngine(self):
+        """ The raw-pool query engine agrees with the cursor walk. """
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+
+        def legacy(it): return set([ c.leaf_obj() for c in it if c.is_leaf() ])
+        for i in range(100):
+            q = G.rect(2.0)
+            want = legacy(rt.cursor.query_rect(q))
+            self.assertEquals(set([ c.leaf_obj() for c in rt.query_rect(q) ]), want)
+            self.assertEquals(set(rt.search_rect(q)), want)
+            self.assertEquals(set([ rt.leaf_pool[i] for i in rt.search_rect(q, ids=True) ]), want)
+            got = []
+            self.assertEquals(rt.visit_rect(q, got.append), len(want))
+            self.assertEquals(set(got), want)
+
+            p = G.pointInside(xs[i].rect)
+            want = legacy(rt.cursor.query_point(p))
+            self.assertTrue(xs[i] in want)
+            self.assertEquals(set([ c.leaf_obj() for c in rt.query_point(p) ]), want)
+            self.assertEquals(set(rt.search_point(p)), want)
+            got = []
+            rt.visit_point(p, got.append, ids=True)
+            self.assertEquals(set([ rt.leaf_pool[i] for i in got ]), want)
+
+        # Touching isn't intersecting, but a point on an edge is inside:
+        rt = RTree()
+        rt.insert("a", Rect(0,0,1,1))
+        self.assertEquals(list(rt.search_rect(Rect(1,0,2,1))), [])
+        self.assertEquals(list(rt.search_point((1,0.5))), ["a"])
+
+        # walk() still visits nodes in pre-order, pruning on the predicate:
+        rt = RTree()
+        for x in xs: rt.insert(x,x.rect)
+        def idxs(it): return [ c.index for c in it ]
+        self.assertEquals(idxs(rt.walk(lambda c,o: True)),
+                          idxs(rt.cursor.walk(lambda c,o: True)))
+        q = G.rect(2.0)
+        self.assertEquals(idxs(rt.walk(lambda c,o: q.does_intersect(c.rect))),
+                          idxs(rt.cursor.walk(lambda c,o: q.does_intersect(c.rect))))
+
+    def testJoin(self):
+        xs = [ TstO(r) for r in take(200, G.rect, 1.0) ]
+        ys = [ TstO(r) for r in take(40, G.rect, 3.0) ]
+        # Nested rects, so containment actually happens:
+        ys += [ TstO(Rect(x.rect.x, x.rect.y, x.rect.xx, x.rect.yy)) for x in xs[:20] ]
+        ys += [ TstO(x.rect.grow(0.5)) for x in xs[20:40] ]
+        a, b = RTree(), RTree.bulk_load([ (y,y.rect) for y in ys ])
+        for x in xs: a.insert(x,x.rect)
+
+        tests = { "intersects" : lambda p,q: p.does_intersect(q),
+                  "contains" : lambda p,q: p.does_contain(q),
+                  "within" : lambda p,q: q.does_contain(p) }
+        for (name,test) in tests.items():
+            want = set([ (x,y) for x in xs for y in ys if test(x.rect, y.rect) ])
+            got = list(a.join(b, name))
+            self.assertEquals(len(got), len(want))
+            self.assertEquals(set(got), want)
+            self.assertTrue(len(want) > 0)
+        self.assertEquals(set(a.join(b, "within")),
+                          set([ (x,y) for (y,x) in b.join(a, "contains") ]))
+
+        got = set(a.join(b, ids=True))
+        self.assertEquals(set([ (a.leaf_pool[i], b.leaf_pool[j]) for (i,j) in got ]),
+                          set(a.join(b)))
+
+        # Self-join, and trees with nothing in them:
+        self.assertEquals(set(a.join(a)),
+                          set([ (x,y) for x in xs for y in xs if x.rect.does_intersect(y.rect) ]))
+        self.assertEquals(list(a.join(RTree())), [])
+        self.assertEquals(list(RTree().join(a)), [])
+        self.assertRaises(ValueError, list, a.join(b, "near"))
+
+    @ut.skipIf(numpy is None, "needs numpy")
+    def testNumpySplitEngine(self):
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        rt = RTree(split_engine="numpy")
+        for x in xs:
+            rt.insert(x,x.rect)
+        self.invariants(rt)
+        self.assertTrue(rt.stats["overflow_f"] > 0)
+        for x in xs:
+            self.assertTrue(x in rt.search_point(G.pointInside(x.rect)))
+
+        self.assertRaises(ValueError, RTree, split_engine="fortran")
+
+    def testSplitEnginesAgree(self):
+        """ Two far-apart blobs get split apart, whichever engine runs. """
+        engines = ["python"] + ([ "numpy" ] if numpy is not None else [])
+        for e in engines:
+            rt = RTree(split_engine=e)
+            left = [ TstO(Rect(i, i, i+1, i+1)) for i in range(6) ]
+            right = [ TstO(Rect(100+i, 100+i, 101+i, 101+i)) for i in range(5) ]
+            for x in left + right: rt.insert(x,x.rect)
+            self.invariants(rt)
+            groups = [ set([ c.leaf_obj() for c in rt._cursor_at(n).children() ])
+                       for n in rt._children(0) ]
+            for g in groups:
+                self.assertTrue(g <= set(left) or g <= set(right))
+
+    def testSplitPolicies(self):
+        xs = [ TstO(r) for r in take(300, G.rect, 0.5) ]
+        for split in [ "linear", "quadratic", "rstar", RStarSplit(reinsert=True) ]:
+            rt = RTree(split=split)
+            for x in xs: rt.insert(x,x.rect)
+            self.invariants(rt)
+            for x in xs:
+                self.assertTrue(x in rt.search_point(G.pointInside(x.rect)))
+            for x in xs[::2]: self.assertTrue(rt.delete(x,x.rect))
+            self.invariants(rt)
+            self.assertEquals(len([ c for c in rt.walk(lambda c,o: True) if c.is_leaf() ]), 150)
+
+        self.assertRaises(ValueError, RTree, split="random")
+
+    def testSplitMinFill(self):
+        rt = RTree()
+        nodes = [ rt.cursor.create_leaf(rt, i, G.rect()) for i in range(11) ]
+        for policy in [ LinearSplit(), QuadraticSplit(), RStarSplit() ]:
+            groups = policy.split(rt, nodes, 4)
+            self.assertEquals(len(groups), 2)
+            self.assertEquals(sorted([ n.index for g in groups for n in g ]),
+                              sorted([ n.index for n in nodes ]))
+            for g in groups: self.assertTrue(len(g) >= 4)
+
+    def fanouts(self, tree):
+        """ Child counts of every non-root internal node, and the root's. """
+        res = []
+        stack = list(tree._children(0))
+        while stack:
+            i = stack.pop()
+            if tree._is_leaf(i): continue
+            kids = list(tree._children(i))
+            res.append(len(kids))
+            stack.extend(kids)
+        return res, len(list(tree._children(0)))
+
+    def testCapacity(self):
+        xs = [ TstO(r) for r in take(200, G.rect, 0.5) ]
+        engines = [ "python" ] + ([ "numpy" ] if numpy is not None else [])
+        trees = [ RTree(split=s, max_children=4, min_children=2)
+                  for s in ("linear", "quadratic", "rstar") ]
+        trees += [ RTree(split_engine=e, max_children=4, min_children=2, max_kmeans=4)
+                   for e in engines ]
+        for rt in trees:
+            for x in xs: rt.insert(x,x.rect)
+            self.invariants(rt)
+            fans, root = self.fanouts(rt)
+            self.assertTrue(root <= 4)
+            self.assertTrue(max(fans) <= 4 and min(fans) >= 2, repr(rt.split))
+
+        bt = RTree.bulk_load([ (x,x.rect) for x in xs ], split="rstar",
+                             max_children=6, min_children=3)
+        self.invariants(bt)
+        fans, root = self.fanouts(bt)
+        self.assertTrue(root <= 6)
+        self.assertTrue(max(fans) <= 6 and min(fans) >= 3)
+
+        for x in xs[:150]: bt.delete(x,x.rect)
+        self.invariants(bt)
+        fans, root = self.fanouts(bt)
+        self.assertTrue(min(fans + [3]) >= 3)
+
+        self.assertRaises(ValueError, RTree, max_children=1)
+        self.assertRaises(ValueError, RTree, max_children=8, min_children=5)
+        self.assertRaises(ValueError, RTree, max_kmeans=2)
+
+    def testBulkLoadSmall(self):
+        self.invariants(RTree.bulk_load([]))
+        xs = [ TstO(r) for r in take(3, G.rect) ]
+        bt = RTree.bulk_load([ (x,x.rect) for x in xs ])
+        self.invariants(bt)
+        self.assertEquals(bt.cursor.nchildren(), 3)
+
 
 if __name__ == '__main__':
     ut.main()
@@ -0,0 +1,246 @@
+## NumPy-vectorized operations over an RTree's array pools.
+#
+# numpy is optional: nothing else in pyrtree imports this module, and the
+#  RTree methods that need it import it lazily.
+
+import array, random, time
+import numpy
+
+class _Layout(object):
+    """
+    Array views of a tree, rebuilt whenever the tree changes:
+     box: (N,4) normalized x,y,xx,yy per node (leaf x-swap undone).
+     leaf: bool per node.
+     leaf_id: leaf_pool index per node (only meaningful for leaves).
+     children/start/end: CSR form of the sibling lists -- the children of
+      node i are children[start[i]:end[i]].
+    """
+    __slots__ = ("box","leaf","leaf_id","children","start","end")
+
+def _view(pool):
+    if isinstance(pool, array.array):
+        # (array typecodes are C types, same as numpy's character codes)
+        return numpy.frombuffer(pool, dtype=pool.typecode)
+    return numpy.ctypeslib.as_array(pool) # mmap-backed, see RTree.open
+
+def pool_views(tree):
+    """ (rects, nodes) as (N,4) and (N,2) arrays, sharing the pools' memory. """
+    n = tree.node_count
+    rects = _view(tree.rect_pool)
+    nodes = _view(tree.node_pool)
+    return rects[:4*n].reshape(n,4), nodes[:2*n].reshape(n,2)
+
+def layout(tree):
+    cached = getattr(tree, "_vec_layout", None)
+    if cached is not None and cached[0] == (tree.generation, tree.node_count):
+        return cached[1]
+
+    rects, nodes = pool_views(tree)
+    n = tree.node_count
+    L = _Layout()
+    L.leaf = rects[:,0] > rects[:,2]
+    L.box = rects.copy()
+    L.box[:,0] = numpy.minimum(rects[:,0], rects[:,2])
+    L.box[:,2] = numpy.maximum(rects[:,0], rects[:,2])
+
+    ns = nodes[:,0].astype(numpy.int64)
+    fc = nodes[:,1].astype(numpy.int64)
+    L.leaf_id = fc
+
+    # Who owns each node? First children know their parent directly;
+    #  the rest find it by pointer-jumping back along the sibling chain.
+    owner = numpy.empty(n, dtype=numpy.int64)
+    owner.fill(-1)
+    parents = numpy.nonzero((fc != 0) & ~L.leaf)[0]
+    owner[fc[parents]] = parents
+    link = numpy.empty(n, dtype=numpy.int64)
+    link.fill(-1)
+    preds = numpy.nonzero(ns != 0)[0]
+    link[ns[preds]] = preds
+    while True:
+        m = (owner < 0) & (link >= 0)
+        if not m.any(): break
+        l = link[m]
+        owner[m] = owner[l]
+        link[m] = link[l]
+
+    kids = numpy.nonzero(owner >= 0)[0]
+    order = numpy.argsort(owner[kids], kind="mergesort")
+    L.children = kids[order]
+    sowner = owner[L.children]
+    ids = numpy.arange(n)
+    L.start = numpy.searchsorted(sowner, ids, side="left")
+    L.end = numpy.searchsorted(sowner, ids, side="right")
+
+    tree._vec_layout = ((tree.generation, tree.node_count), L)
+    return L
+
+def _expand(L, q, nodes):
+    """ All (query, child) pairs for the given (query, node) pairs. """
+    cnt = L.end[nodes] - L.start[nodes]
+    total = cnt.sum()
+    qq = numpy.repeat(q, cnt)
+    offs = numpy.arange(total) - numpy.repeat(numpy.cumsum(cnt) - cnt, cnt)
+    kids = L.children[numpy.repeat(L.start[nodes], cnt) + offs]
+    return qq, kids
+
+def _search(tree, queries, hit_test):
+    """
+    Level-synchronous descent for many queries at once.  Every step takes
+    the whole frontier of (query, node) pairs, expands it to all of their
+    children and tests them in one go.
+    """
+    L = layout(tree)
+    m = len(queries)
+    q = numpy.arange(m)
+    nodes = numpy.zeros(m, dtype=numpy.int64)
+    out_q, out_l = [], []
+    while len(q):
+        qq, kids = _expand(L, q, nodes)
+        hit = hit_test(L.box[kids], queries[qq])
+        qq = qq[hit]
+        kids = kids[hit]
+        lf = L.leaf[kids]
+        out_q.append(qq[lf])
+        out_l.append(L.leaf_id[kids[lf]])
+        q = qq[~lf]
+        nodes = kids[~lf]
+
+    if not out_q:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+    qi = numpy.concatenate(out_q)
+    li = numpy.concatenate(out_l)
+    order = numpy.argsort(qi, kind="mergesort")
+    return qi[order], li[order]
+
+def _rects_hit(b, r):
+    # Same test as Rect.does_intersect: the overlap must have area.
+    w = numpy.minimum(b[:,2], r[:,2]) - numpy.maximum(b[:,0], r[:,0])
+    h = numpy.minimum(b[:,3], r[:,3]) - numpy.maximum(b[:,1], r[:,1])
+    return (w > 0) & (h > 0)
+
+def _points_hit(b, p):
+    return ((p[:,0] >= b[:,0]) & (p[:,0] <= b[:,2]) &
+            (p[:,1] >= b[:,1]) & (p[:,1] <= b[:,3]))
+
+def query_rects(tree, boxes):
+    boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1,4)
+    return _search(tree, boxes, _rects_hit)
+
+def query_points(tree, points):
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1,2)
+    return _search(tree, points, _points_hit)
+
+# Node splitting: the same k-means + silhouette clustering as
+#  rtree.k_means_cluster/silhouette_coeff, on arrays instead of cursors.
+
+def _gather(tree, nodes):
+    """ (n,4) normalized boxes of the given cursors, straight from the pool. """
+    rects = _view(tree.rect_pool).reshape(-1,4)
+    b = rects[numpy.array([ n.index for n in nodes ])].astype(numpy.float64)
+    x = numpy.minimum(b[:,0], b[:,2])
+    b[:,2] = numpy.maximum(b[:,0], b[:,2])
+    b[:,0] = x
+    return b
+
+def _centers(b):
+    """ Centers and areas of each box. """
+    w = b[:,2] - b[:,0]
+    h = b[:,3] - b[:,1]
+    c = numpy.empty((len(b),2))
+    c[:,0] = b[:,0] + 0.5 * w
+    c[:,1] = b[:,1] + 0.5 * h
+    return c, w * h
+
+def _cluster_centers(c, a, labels, k):
+    """ Area-weighted center of gravity of each cluster. """
+    wsum = numpy.bincount(labels, a, k)
+    cx = numpy.bincount(labels, a * c[:,0], k)
+    cy = numpy.bincount(labels, a * c[:,1], k)
+    # Degenerate (zero-area) clusters: fall back to the plain mean.
+    flat = wsum <= 0
+    if flat.any():
+        cnt = numpy.bincount(labels, None, k).astype(numpy.float64)
+        cx[flat] = numpy.bincount(labels, c[:,0], k)[flat] / cnt[flat]
+        cy[flat] = numpy.bincount(labels, c[:,1], k)[flat] / cnt[flat]
+        wsum[flat] = 1.0
+    return numpy.column_stack((cx / wsum, cy / wsum))
+
+def _closest(c, centers):
+    d = ((c[:,None,:] - centers[None,:,:]) ** 2).sum(axis=2)
+    return d, d.argmin(axis=1)
+
+def k_means(root, k, c, a):
+    """ Cluster labels for k-means over the centers 'c' (areas 'a'). """
+    n = len(c)
+    if n <= k: return numpy.arange(n)
+
+    t = time.clock()
+    root.stats["count_kmeans_iter_f"] += 1
+    centers = c[numpy.array(random.sample(range(n), k))]
+    while True:
+        root.stats["sum_kmeans_iter_f"] += 1
+        d, labels = _closest(c, centers)
+        # Drop empty clusters, renumbering the rest:
+        used = numpy.unique(labels)
+        labels = numpy.searchsorted(used, labels)
+        new_centers = _cluster_centers(c, a, labels, len(used))
+        if new_centers.shape == centers.shape and (new_centers == centers).all():
+            root.stats["avg_kmeans_iter_f"] = float(root.stats["sum_kmeans_iter_f"] / root.stats["count_kmeans_iter_f"])
+            root.stats["longest_kmeans"] = max(root.stats["longest_kmeans"], (time.clock() - t))
+            return labels
+        centers = new_centers
+
+def union_diagonals(b):
+    """ (n,n) matrix of the diagonal of the union of each pair of boxes. """
+    w = (numpy.maximum(b[:,None,2], b[None,:,2]) -
+         numpy.minimum(b[:,None,0], b[None,:,0]))
+    h = (numpy.maximum(b[:,None,3], b[None,:,3]) -
+         numpy.minimum(b[:,None,1], b[None,:,1]))
+    return numpy.sqrt(w*w + h*h)
+
+def silhouette(diag, c, a, labels):
+    k = labels.max() + 1
+    if k == 1: return 1.0
+    sizes = numpy.bincount(labels, None, k).astype(numpy.float64)
+
+    # mean diagonal from each node to each cluster:
+    onehot = numpy.zeros((len(labels), k))
+    onehot[numpy.arange(len(labels)), labels] = 1.0
+    means = diag.dot(onehot) / sizes
+
+    # ...compared against the other cluster whose center is closest:
+    d, ignored = _closest(c, _cluster_centers(c, a, labels, k))
+    d[numpy.arange(len(labels)), labels] = numpy.inf
+    other = d.argmin(axis=1)
+
+    idx = numpy.arange(len(labels))
+    ndist = means[idx, labels]
+    sdist = means[idx, other]
+    top = numpy.maximum(ndist, sdist)
+    w = numpy.where(top > 0, (sdist - ndist) / numpy.where(top > 0, top, 1.0), 0.0)
+    return (numpy.bincount(labels, w, k) / sizes).mean()
+
+def cluster_split(root, nodes, max_kmeans, min_fill=1):
+    """
+    Split 'nodes' (cursors) into clusters: k-means for each k in
+    [2, max_kmeans), keeping the clustering with the best silhouette
+    coefficient among those whose clusters all have at least 'min_fill'
+    members.  Returns a list of lists of the given cursors, or None if
+    no clustering was acceptable.
+    """
+    b = _gather(root, nodes)
+    c, a = _centers(b)
+    diag = union_diagonals(b)
+    best = None
+    for k in range(2, max_kmeans):
+        labels = k_means(root, k, c, a)
+        if numpy.bincount(labels).min() < min_fill: continue
+        score = silhouette(diag, c, a, labels)
+        if best is None or score > best[0]: best = (score, labels)
+
+    if best is None: return None
+    labels = best[1]
+    clusters = [ [] for i in range(labels.max() + 1) ]
+    for (n,l) in zip(nodes, labels): clusters[l].append(n)
+    return clusters
@@ -13,8 +13,8 @@ setup(
     long_description = """\
 Two-dimensional RTree spatial index.
 
-This is a simple pure python implemenation of a 2D RTree. For the
-moment, it is insert-only, and aimed at creating indexes to speed
-queries over mostly-static datasets.
+This is a simple pure python implemenation of a 2D RTree. It supports
+bulk loading, insertion and deletion, and is aimed at creating indexes
+to speed queries over mostly-static datasets.
 """
 )